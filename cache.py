@@ -5,20 +5,50 @@
 #Flexible schema
 #Cache can expire 
 
+import asyncio
+import atexit
+import collections
+import functools
 import json 
 import os 
+import pickle
 import datetime
-from threading import Thread, Event 
+import gc
+import io
+import heapq
+import itertools
+import struct
+import sys
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock, RLock
 
+#Expiry times are naive UTC datetimes, snapshots and journal records keep them 
+#as seconds since the epoch. 
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def _timestamp(expiryTime):
+    return (expiryTime - _EPOCH).total_seconds()
+    
+def _fromTimestamp(seconds):
+    return _EPOCH + datetime.timedelta(seconds=seconds)
+    
 class CacheEntry():
     """
         Internal class that keeps track of linked list entries.
         Can be accessed externally but generally not needed 
     """
+    #Used by SievePolicy. A class attribute so entries only pay for it once set. 
+    visited = False
+    #The ttl the entry was added with, if it had its own. 
+    ttl = None
+    
     def __init__(self, key, previous, next, duration):
         self.key = key
         self.previous = previous 
         self.next = next 
+        self.weight = 0
         self.creationTime = datetime.datetime.utcnow()
         if duration:
             self.expiryTime = self.creationTime + datetime.timedelta(seconds=duration)
@@ -27,33 +57,787 @@ class CacheEntry():
             #the maximum possible time. 
             self.expiryTime = datetime.datetime.max 
         
+
+#Eviction policies decide which entry leaves the cache when it is full and what 
+#a hit does to the order. The cache calls these hooks while holding its lock, 
+#the policy works directly on the cache's linked list (head is the newest). 
+#Subclass EvictionPolicy and override the hooks you need. 
+class EvictionPolicy():
+    #Whether victim can pick the candidate over the rest (admission, see TinyLFUPolicy). 
+    #addMany then evicts after each new entry instead of once for the whole batch. 
+    admission = False
+    
+    #Called once when the cache is created.
+    def attach(self, cache):
+        pass
+        
+    #Called when the cache is emptied (expireAll or loadFromDisk).
+    def clear(self, cache):
+        pass
+        
+    #A new entry was added at the head of the list.
+    def inserted(self, cache, entry):
+        pass
+        
+    #An entry in the cache was read or added again. Returns True if 
+    #the order of the list changed. 
+    def touch(self, cache, entry):
+        return False
+        
+    #A get for a key that isn't in the cache.
+    def missed(self, cache, key):
+        pass
+        
+    #Returns the entry to remove. candidate is the entry that was just added 
+    #and caused the overflow, or None. 
+    def victim(self, cache, candidate):
+        return cache.tail
+        
+    #An entry is about to be unlinked from the list, for any reason. 
+    def removed(self, cache, entry):
+        pass
+        
+#Least recently used, the default. A hit moves the entry to the head
+#and the tail is always the one removed.
+class LRUPolicy(EvictionPolicy):
+    def touch(self, cache, entry):
+        if cache.head is entry:
+            return False
+        cache._updateLatest(entry.key)
+        return True
+        
+#SIEVE (Zhang et al. 2024). A hit only sets the entry's visited bit so reads 
+#never relink the list. To evict, a hand walks from the tail towards the head 
+#clearing visited bits and removes the first entry that wasn't visited, 
+#then carries on from there next time. 
+class SievePolicy(EvictionPolicy):
+    def attach(self, cache):
+        self.hand = None
+        
+    def clear(self, cache):
+        self.hand = None
+        
+    def touch(self, cache, entry):
+        entry.visited = True
+        return False
+        
+    def victim(self, cache, candidate):
+        hand = self.hand if self.hand is not None else cache.tail
+        while hand.visited:
+            hand.visited = False
+            hand = hand.previous if hand.previous is not None else cache.tail
+        #removed() moves the hand on once the entry is taken out. 
+        self.hand = hand
+        return hand
+        
+    def removed(self, cache, entry):
+        if self.hand is entry:
+            self.hand = entry.previous
+            
+#LRU with TinyLFU admission (Einziger et al.). Every access, hit or miss, is counted
+#in a small count-min sketch whose counters are halved every so often so old 
+#popularity fades. When a new entry overflows the cache it only stays if it has been
+#asked for more often than the tail it would replace, otherwise it is the one removed.
+#This keeps one-off keys from a scan from flushing the frequently used ones out.
+#Note: there is no separate admission window as in W-TinyLFU.
+class TinyLFUPolicy(LRUPolicy):
+    admission = True
+    
+    def attach(self, cache):
+        #Four rows of 4 bit counters (kept in bytes), each a few times wider than 
+        #the cache so keys that aren't cached can be counted without colliding much.
+        self.width = 1 << max(6, (4 * cache.size).bit_length())
+        self.mask = self.width - 1
+        self.counters = array("B", bytes(self.width * 4))
+        self.additions = 0
+        self.sampleSize = 10 * self.width
+        
+    #The counter of key in each row, one hash spread four ways. 
+    def _indexes(self, key):
+        h = hash(key)
+        mask = self.mask
+        width = self.width
+        return (((h * 0x9E3779B1) >> 16) & mask, 
+            width + (((h * 0x85EBCA77) >> 16) & mask),
+            2 * width + (((h * 0xC2B2AE3D) >> 16) & mask),
+            3 * width + (((h * 0x27D4EB2F) >> 16) & mask))
+            
+    def _increment(self, key):
+        counters = self.counters
+        for index in self._indexes(key):
+            if counters[index] < 15:
+                counters[index] += 1
+        self.additions += 1
+        if self.additions >= self.sampleSize:
+            self.counters = array("B", (count >> 1 for count in counters))
+            self.additions //= 2
+            
+    def frequency(self, key):
+        counters = self.counters
+        return min(counters[index] for index in self._indexes(key))
+            
+    def inserted(self, cache, entry):
+        self._increment(entry.key)
+        
+    def touch(self, cache, entry):
+        self._increment(entry.key)
+        return LRUPolicy.touch(self, cache, entry)
+        
+    def missed(self, cache, key):
+        self._increment(key)
+        
+    def victim(self, cache, candidate):
+        tail = cache.tail
+        if candidate is not None and candidate is not tail:
+            if self.frequency(candidate.key) <= self.frequency(tail.key):
+                return candidate
+        return tail
+        
+EVICTION_POLICIES = {
+    "lru": LRUPolicy,
+    "sieve": SievePolicy,
+    "tinylfu": TinyLFUPolicy,
+}
+
+#Counters kept by a Cache created with metrics=True, see Cache.stats(). 
+#Every call is made while holding the cache's lock. 
+#Latencies are only measured for one in latencySampleEvery get/add calls
+#and are kept as histograms of power of two microsecond buckets. 
+class _Metrics():
+    def __init__(self, latencySampleEvery=0, hook=None):
+        self.hits = 0
+        self.misses = 0
+        self.adds = 0
+        self.capacityEvictions = 0
+        self.expiryEvictions = 0
+        self.sweeps = 0
+        self.sweepSeconds = 0.0
+        self.lastSweepSeconds = 0.0
+        self.lastExpiryLag = 0.0
+        self.maxExpiryLag = 0.0
+        self.writes = 0
+        self.writeSeconds = 0.0
+        self.lastWriteSeconds = 0.0
+        self.lastWriteBytes = 0
+        
+        self.hook = hook
+        self.latencySampleEvery = latencySampleEvery
+        self.countdown = {"get": latencySampleEvery, "add": latencySampleEvery}
+        self.latencies = {"get": {}, "add": {}}
+        
+    #Returns the start time if this call's latency should be measured, else None. 
+    def start(self, operation):
+        if not self.latencySampleEvery:
+            return None
+        self.countdown[operation] -= 1
+        if self.countdown[operation] > 0:
+            return None
+        self.countdown[operation] = self.latencySampleEvery
+        return time.perf_counter()
+        
+    def _latency(self, operation, start):
+        microseconds = (time.perf_counter() - start) * 1000000
+        bucket = 1 << max(0, int(microseconds)).bit_length()
+        histogram = self.latencies[operation]
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+        
+    def _event(self, event, value):
+        if self.hook is not None:
+            self.hook(event, value)
+        
+    def got(self, key, hit, start):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if start is not None:
+            self._latency("get", start)
+        self._event("hit" if hit else "miss", key)
+        
+    def added(self, key, start):
+        self.adds += 1
+        if start is not None:
+            self._latency("add", start)
+        self._event("add", key)
+        
+    def evicted(self, key):
+        self.capacityEvictions += 1
+        self._event("evict", key)
+        
+    def expired(self, key, lag):
+        self.expiryEvictions += 1
+        self.lastExpiryLag = max(self.lastExpiryLag, lag)
+        self.maxExpiryLag = max(self.maxExpiryLag, lag)
+        self._event("expire", key)
+        
+    def swept(self, seconds):
+        self.sweeps += 1
+        self.sweepSeconds += seconds
+        self.lastSweepSeconds = seconds
+        self._event("sweep", seconds)
+        
+    def wrote(self, seconds, size):
+        self.writes += 1
+        self.writeSeconds += seconds
+        self.lastWriteSeconds = seconds
+        self.lastWriteBytes = size
+        self._event("write", seconds)
+        
+    def snapshot(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": self.hits / float(lookups) if lookups else 0.0,
+            "adds": self.adds,
+            "capacityEvictions": self.capacityEvictions,
+            "expiryEvictions": self.expiryEvictions,
+            "sweeps": self.sweeps,
+            "sweepSeconds": self.sweepSeconds,
+            "lastSweepSeconds": self.lastSweepSeconds,
+            "lastExpiryLag": self.lastExpiryLag,
+            "maxExpiryLag": self.maxExpiryLag,
+            "writes": self.writes,
+            "writeSeconds": self.writeSeconds,
+            "lastWriteSeconds": self.lastWriteSeconds,
+            "lastWriteBytes": self.lastWriteBytes,
+            "getLatency": dict(self.latencies["get"]),
+            "addLatency": dict(self.latencies["add"]),
+        }
+
+#Used in place of a real lock when the cache is only touched from one thread.
+#Entering it is a Python call and costs about as much as an uncontended RLock, 
+#so get and add don't go through it at all without threadSafe (see Cache.__init__), 
+#it only stands in for the lock in the less frequent calls. 
+class _NoLock():
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *args):
+        return False
+       
+#One load in progress for Cache.getOrLoad. The thread doing the load fills in 
+#the value (or the error) and sets done, the other threads asking for the same 
+#key wait on done and share the result. 
+class _Flight():
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+        
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
        
 #Threading Reference:
 #https://stackoverflow.com/a/12435256
-#This thread is just a timer that checks the cache every second or so
-#and removes any entries that have gone past their expiry time. 
+#This thread is just a timer that wakes up every second or so (the resolution)
+#and asks the cache to remove any entries that have gone past their expiry time. 
 class _CacheThread(Thread):
     """
         Cache threading helper class. Expires entry when their time is past.
     """
-    def __init__(self, event, cache):
+    def __init__(self, event, cache, resolution=1.0):
         Thread.__init__(self)
         self.stopped = event
         self.cache = cache
+        self.resolution = resolution
+        
+    def run(self):
+        while not self.stopped.wait(self.resolution):
+            self.cache.expireDue()
+
+#Stands for every key in Cache.dirtyKeys once the whole cache was cleared.
+_EVERYTHING = object()
+
+#Calls cache._autosave every interval seconds (or only when woken if interval is None)
+#and one last time when stopped. 
+class _AutosaveThread(Thread):
+    def __init__(self, stopEvent, wakeEvent, cache, interval):
+        Thread.__init__(self)
+        self.stopped = stopEvent
+        self.wake = wakeEvent
+        self.cache = cache
+        self.interval = interval
+        
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            #Checked before saving so changes made while stopping are still saved. 
+            stopping = self.stopped.is_set()
+            self.cache._autosave()
+            if stopping:
+                break
+
+#How often journal records get forced onto the disk. 
+#"always" syncs after every record, "interval" syncs every fsyncInterval milliseconds 
+#from a background thread and "os" hands every record to the operating system 
+#but leaves it to decide when it reaches the disk. 
+FSYNC_POLICIES = ("always", "interval", "os")
+
+#The journal (write ahead log) is a set of files next to the cache file, named
+#<fileName>.journal.<generation>. Every change to the cache is appended to the 
+#current one as a pickled record with its length in front (like the blocks of the 
+#binary snapshots), see the record types below. Pickle rather than json so keys and 
+#values come back as they went in, tuples as tuples and bytes as bytes. Each file 
+#starts with JOURNAL_MAGIC, files without it are the json lines older versions wrote. 
+#Each writeToDisk starts a new generation and the snapshot remembers which generation 
+#follows it, so loading only replays the journals written after the snapshot. 
+#Records:
+#   ["a", key, value]   add, with the weight as a fourth item if one was passed to add.
+#                       An entry that expires also has its ttl (None for expiryTime's) 
+#                       as a fifth and its deadline, in seconds since the epoch, as a sixth
+#   ["g", key]          get that moved the key to the front
+#   ["e", key]          expire
+#   ["x"]               expireAll
+class _Journal():
+    def __init__(self, fileName, fsyncPolicy="os", fsyncInterval=100):
+        if fsyncPolicy not in FSYNC_POLICIES:
+            raise ValueError("fsyncPolicy must be one of %s" % (FSYNC_POLICIES,))
+        self.fileName = fileName
+        self.fsyncPolicy = fsyncPolicy
+        self.fsyncInterval = fsyncInterval
+        self.lock = Lock()
+        self.dirty = False
+        #Records appended since the last rotate, used to decide when to compact. 
+        self.records = 0
+        
+        #We never append to a journal from a previous run since it may end 
+        #with a half written record, a new run always starts a new generation.
+        generations = self.generations()
+        self.generation = generations[-1] + 1 if generations else 0
+        self.file = self._open(self.generation)
+        
+        self.stopSignal = Event()
+        if fsyncPolicy == "interval":
+            self.timer = _JournalThread(self.stopSignal, self)
+            self.timer.daemon = True
+            self.timer.start()
+            
+    def path(self, generation):
+        return "%s.journal.%d" % (self.fileName, generation)
+        
+    def _open(self, generation):
+        f = open(self.path(generation), "ab")
+        f.write(JOURNAL_MAGIC)
+        return f
+        
+    #The generations of the journal files on disk, oldest first. 
+    def generations(self):
+        directory = os.path.dirname(self.fileName) or "."
+        prefix = os.path.basename(self.fileName) + ".journal."
+        found = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                found.append(int(name[len(prefix):]))
+        return sorted(found)
+        
+    #Turns a record into what append writes. Done separately so a record that 
+    #can't be written is found out before the cache is changed. 
+    def encode(self, record):
+        data = pickle.dumps(record, _PICKLE_PROTOCOL)
+        return _SNAPSHOT_BLOCK.pack(len(data)) + data
+        
+    #Appends a record, or one already encoded. 
+    def append(self, record, line=None):
+        if line is None:
+            line = self.encode(record)
+        with self.lock:
+            self.file.write(line)
+            self.records += 1
+            if self.fsyncPolicy == "interval":
+                self.dirty = True
+            else:
+                self.file.flush()
+                if self.fsyncPolicy == "always":
+                    os.fsync(self.file.fileno())
+                    
+    def sync(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.dirty = False
+            
+    #Switches to a new generation and returns its number and the old file. 
+    #Everything appended before this belongs to the old one. The old file is 
+    #only flushed here, retire syncs and closes it once the cache's lock is let go. 
+    def rotate(self):
+        with self.lock:
+            old = self.file
+            old.flush()
+            self.generation += 1
+            self.file = self._open(self.generation)
+            self.dirty = False
+            self.records = 0
+        return self.generation, old
+        
+    def retire(self, f):
+        os.fsync(f.fileno())
+        f.close()
+        
+    #Deletes the journal files older than generation, 
+    #once a snapshot covering them is safely on disk. 
+    def removeBefore(self, generation):
+        for old in self.generations():
+            if old < generation:
+                os.remove(self.path(old))
+                
+    #Yields the records of every journal from generation onwards, in order.
+    #A record that is cut short or doesn't parse can only be the last one of a 
+    #journal that was being written when we crashed, so the rest of that file is skipped. 
+    def replay(self, generation):
+        for current in self.generations():
+            if current < generation:
+                continue
+            with open(self.path(current), "rb") as f:
+                if f.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+                    f.seek(0)
+                    for record in self._replayJson(f):
+                        yield record
+                    continue
+                while True:
+                    header = f.read(_SNAPSHOT_BLOCK.size)
+                    if len(header) < _SNAPSHOT_BLOCK.size:
+                        break
+                    length = _SNAPSHOT_BLOCK.unpack(header)[0]
+                    data = f.read(length)
+                    if len(data) < length:
+                        break
+                    try:
+                        record = pickle.loads(data)
+                    except Exception:
+                        break
+                    yield record
+                    
+    #The records of a journal written as json lines. 
+    def _replayJson(self, f):
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            yield record
+                    
+    def close(self):
+        self.stopSignal.set()
+        self.sync()
+        with self.lock:
+            self.file.close()
+            
+#Syncs the journal every fsyncInterval milliseconds if anything was written. 
+class _JournalThread(Thread):
+    def __init__(self, event, journal):
+        Thread.__init__(self)
+        self.stopped = event
+        self.journal = journal
         
-    #We run this timer thread with a roughly 1 second interval. 
     def run(self):
-        while not self.stopped.wait(1.0):
-            for entry in self.cache.iterate():
-                if entry.expiryTime <= datetime.datetime.utcnow():
-                    self.cache.expire(entry.key)
+        while not self.stopped.wait(self.journal.fsyncInterval / 1000.0):
+            if self.journal.dirty:
+                self.journal.sync()
+
+#The binary snapshot formats share a header of the magic bytes, the format id and 
+#the journal generation that follows the snapshot, then blocks of records. 
+#Records are written least recently used first so loading can push each one on to 
+#the front of the list as it is read, in one pass and without holding the whole file.
+#Unlike the json snapshot these don't need the values (or keys) to be json compliant.
+#loadFromDisk tells the formats apart by their first bytes so it reads any of them.
+#Entries with an expiry time follow the last block, behind a block length of 
+#_EXPIRY_BLOCK, as one pickled list of [key, ttl, deadline]. 
+#Note: only load snapshots you wrote yourself, unpickling can run arbitrary code.
+SNAPSHOT_MAGIC = b"LRUC"
+JOURNAL_MAGIC = b"LRUJ"
+_SNAPSHOT_HEADER = struct.Struct("<HQ")
+_SNAPSHOT_BLOCK = struct.Struct("<I")
+_SNAPSHOT_BLOCK_ENTRIES = 4096
+_EXPIRY_BLOCK = 0xFFFFFFFF
+_PICKLE_PROTOCOL = 4
+
+#How writeToDisk writes a snapshot and loadFromDisk reads it back. 
+#write gets the keys and values from the most to the least recently used, 
+#the journal generation that follows the snapshot (None without a journal) and 
+#a [key, ttl, deadline] for each entry that expires (deadline in seconds since the epoch). 
+#read gets the file from its start and returns the generation and an iterator 
+#of (key, value) pairs from the least to the most recently used. Once the pairs 
+#are used up, expiries holds what was passed to write. 
+class SnapshotSerializer():
+    #The id in the header of a binary format, None for formats without the header. 
+    formatId = None
+    expiries = ()
+    _EXPIRY_MARKER = _SNAPSHOT_BLOCK.pack(_EXPIRY_BLOCK)
+    
+    def write(self, f, keys, values, generation, expiries=()):
+        raise NotImplementedError
+        
+    def read(self, f):
+        raise NotImplementedError
+        
+    def _writeHeader(self, f, generation):
+        f.write(SNAPSHOT_MAGIC + _SNAPSHOT_HEADER.pack(self.formatId, generation or 0))
+        
+    def _readHeader(self, f):
+        f.read(len(SNAPSHOT_MAGIC))
+        return _SNAPSHOT_HEADER.unpack(f.read(_SNAPSHOT_HEADER.size))[1]
+        
+    #Yields the blocks of a binary snapshot, each as the length prefixed bytes written by _writeBlock.
+    def _readBlocks(self, f):
+        while True:
+            header = f.read(_SNAPSHOT_BLOCK.size)
+            if not header:
+                break
+            length = _SNAPSHOT_BLOCK.unpack(header)[0]
+            if length == _EXPIRY_BLOCK:
+                self._readExpiries(f)
+                break
+            yield f.read(length)
+            
+    def _writeBlock(self, f, block):
+        f.write(_SNAPSHOT_BLOCK.pack(len(block)))
+        f.write(block)
+        
+    def _writeExpiries(self, f, expiries):
+        if expiries:
+            f.write(self._EXPIRY_MARKER)
+            self._writeBlock(f, pickle.dumps(expiries, _PICKLE_PROTOCOL))
+            
+    def _readExpiries(self, f):
+        length = _SNAPSHOT_BLOCK.unpack(f.read(_SNAPSHOT_BLOCK.size))[0]
+        self.expiries = pickle.loads(f.read(length))
+        
+#The original snapshot: {"keys": [...], "values": [...], "journal": generation, 
+#"expiries": [...]}, most recently used first. Keys have to be strings to come back as they went in. 
+class JsonSerializer(SnapshotSerializer):
+    def write(self, f, keys, values, generation, expiries=()):
+        backup = {
+            'keys': keys,
+            'values': values
+        }
+        if generation is not None:
+            backup['journal'] = generation
+        if expiries:
+            backup['expiries'] = expiries
+        text = io.TextIOWrapper(f, encoding="utf-8")
+        json.dump(backup, text)
+        text.flush()
+        text.detach()
+        
+    def read(self, f):
+        data = json.load(f)
+        self.expiries = data.get('expiries', ())
+        return data.get('journal', 0), zip(reversed(data['keys']), reversed(data['values']))
+        
+#Each block is a pickled flat list of key, value, key, value... of up to 
+#_SNAPSHOT_BLOCK_ENTRIES entries. Unpickling a few thousand entries at once is 
+#much faster than one at a time, while only one block is ever held in memory. 
+class PickleSerializer(SnapshotSerializer):
+    formatId = 1
+    
+    def write(self, f, keys, values, generation, expiries=()):
+        self._writeHeader(f, generation)
+        for block in self._blocks(keys, values):
+            self._writeBlock(f, pickle.dumps(block, _PICKLE_PROTOCOL))
+        self._writeExpiries(f, expiries)
+            
+    #The flat lists of key, value... from the least recently used. 
+    def _blocks(self, keys, values):
+        end = len(keys)
+        while end > 0:
+            start = max(0, end - _SNAPSHOT_BLOCK_ENTRIES)
+            block = [None] * ((end - start) * 2)
+            block[0::2] = keys[start:end][::-1]
+            block[1::2] = values[start:end][::-1]
+            yield block
+            end = start
+            
+    def read(self, f):
+        return self._readHeader(f), self._pairs(f)
+        
+    def _pairs(self, f):
+        for block in self._readBlocks(f):
+            block = pickle.loads(block)
+            yield from zip(block[0::2], block[1::2])
+            
+#Like PickleSerializer but with pickle protocol 5, where bytes, bytearray and memoryview 
+#values are kept out of the pickle and written to the file straight from their own memory
+#instead of being copied into it. A block is the pickle followed by those buffers, 
+#each with its length. Values that were memoryviews come back as bytes. 
+class Pickle5Serializer(PickleSerializer):
+    formatId = 2
+    _BLOCK = struct.Struct("<II")
+    _BUFFER = struct.Struct("<Q")
+    _EXPIRY_MARKER = _BLOCK.pack(_EXPIRY_BLOCK, 0)
+    
+    def write(self, f, keys, values, generation, expiries=()):
+        self._writeHeader(f, generation)
+        for block in self._blocks(keys, values):
+            #bytearrays go out of band by themselves, bytes and memoryviews need wrapping. 
+            for i in range(1, len(block), 2):
+                if type(block[i]) in (bytes, memoryview):
+                    block[i] = pickle.PickleBuffer(block[i])
+            buffers = []
+            data = pickle.dumps(block, 5, buffer_callback=buffers.append)
+            f.write(self._BLOCK.pack(len(data), len(buffers)))
+            f.write(data)
+            for buffer in buffers:
+                raw = buffer.raw()
+                f.write(self._BUFFER.pack(raw.nbytes))
+                f.write(raw)
+        self._writeExpiries(f, expiries)
+                
+    def _pairs(self, f):
+        while True:
+            header = f.read(self._BLOCK.size)
+            if not header:
+                break
+            length, bufferCount = self._BLOCK.unpack(header)
+            if length == _EXPIRY_BLOCK:
+                self._readExpiries(f)
+                break
+            data = f.read(length)
+            buffers = [f.read(self._BUFFER.unpack(f.read(self._BUFFER.size))[0]) for i in range(0, bufferCount)]
+            block = pickle.loads(data, buffers=buffers)
+            yield from zip(block[0::2], block[1::2])
+            
+#A compact codec without pickle for the common types. Every key and value is a one byte 
+#tag followed by its data: None, True and False are just the tag, ints that fit in 
+#64 bits and floats take 8 bytes, str (utf-8) and bytes their length (in one byte
+#when it is under 256) and their bytes. memoryviews are written as bytes and come
+#back as bytes. Anything else is pickled with a length in front. Blocks hold _SNAPSHOT_BLOCK_ENTRIES entries.
+class StructSerializer(SnapshotSerializer):
+    formatId = 3
+    _NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _BYTES, _PICKLE, _SHORT_STR, _SHORT_BYTES = range(0, 10)
+    _NUMBER = {_INT: struct.Struct("<Bq"), _FLOAT: struct.Struct("<Bd")}
+    _SIZED = struct.Struct("<BI")
+    _SHORT = struct.Struct("<BB")
+    
+    def write(self, f, keys, values, generation, expiries=()):
+        self._writeHeader(f, generation)
+        block = bytearray()
+        count = 0
+        for i in range(len(keys) - 1, -1, -1):
+            self._encode(block, keys[i])
+            self._encode(block, values[i])
+            count += 1
+            if count == _SNAPSHOT_BLOCK_ENTRIES:
+                self._writeBlock(f, block)
+                block = bytearray()
+                count = 0
+        if count:
+            self._writeBlock(f, block)
+        self._writeExpiries(f, expiries)
+            
+    def _encode(self, block, item):
+        kind = type(item)
+        if kind is str:
+            data = item.encode("utf-8")
+            if len(data) < 256:
+                block += self._SHORT.pack(self._SHORT_STR, len(data))
+            else:
+                block += self._SIZED.pack(self._STR, len(data))
+            block += data
+        elif item is None:
+            block.append(self._NONE)
+        elif kind is bool:
+            block.append(self._TRUE if item else self._FALSE)
+        elif kind is int and -(1 << 63) <= item < (1 << 63):
+            block += self._NUMBER[self._INT].pack(self._INT, item)
+        elif kind is float:
+            block += self._NUMBER[self._FLOAT].pack(self._FLOAT, item)
+        elif kind is bytes or kind is memoryview:
+            length = item.nbytes if kind is memoryview else len(item)
+            if length < 256:
+                block += self._SHORT.pack(self._SHORT_BYTES, length)
+            else:
+                block += self._SIZED.pack(self._BYTES, length)
+            block += item
+        else:
+            data = pickle.dumps(item, _PICKLE_PROTOCOL)
+            block += self._SIZED.pack(self._PICKLE, len(data))
+            block += data
+            
+    def read(self, f):
+        return self._readHeader(f), self._pairs(f)
+        
+    def _pairs(self, f):
+        for block in self._readBlocks(f):
+            decoded = self._decode(block)
+            yield from zip(decoded, decoded)
+            
+    #Yields the items of a block in order. Reading keys and values from the 
+    #same iterator with zip pairs them back up. 
+    def _decode(self, block):
+        offset = 0
+        end = len(block)
+        sizeLength = self._SIZED.size - 1
+        while offset < end:
+            tag = block[offset]
+            offset += 1
+            if tag == self._SHORT_STR or tag == self._SHORT_BYTES:
+                length = block[offset]
+                offset += 1
+                data = block[offset:offset + length]
+                offset += length
+                yield data.decode("utf-8") if tag == self._SHORT_STR else data
+            elif tag == self._STR or tag == self._BYTES or tag == self._PICKLE:
+                length = _SNAPSHOT_BLOCK.unpack_from(block, offset)[0]
+                offset += sizeLength
+                data = block[offset:offset + length]
+                offset += length
+                if tag == self._STR:
+                    yield data.decode("utf-8")
+                elif tag == self._BYTES:
+                    yield data
+                else:
+                    yield pickle.loads(data)
+            elif tag == self._INT:
+                yield struct.unpack_from("<q", block, offset)[0]
+                offset += 8
+            elif tag == self._FLOAT:
+                yield struct.unpack_from("<d", block, offset)[0]
+                offset += 8
+            elif tag == self._NONE:
+                yield None
+            elif tag == self._TRUE:
+                yield True
+            elif tag == self._FALSE:
+                yield False
+            else:
+                raise ValueError("Unknown tag %s in snapshot" % tag)
+                
+SNAPSHOT_FORMATS = {
+    "json": JsonSerializer,
+    "binary": PickleSerializer,
+    "pickle5": Pickle5Serializer,
+    "struct": StructSerializer,
+}
+
+#The serializer that can read the snapshot in f, going by its header. 
+def _snapshotSerializer(f):
+    start = f.read(len(SNAPSHOT_MAGIC) + _SNAPSHOT_HEADER.size)
+    f.seek(0)
+    if start[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        return JsonSerializer()
+    formatId = _SNAPSHOT_HEADER.unpack(start[len(SNAPSHOT_MAGIC):])[0]
+    for serializer in SNAPSHOT_FORMATS.values():
+        if serializer.formatId == formatId:
+            return serializer()
+    raise ValueError("Unsupported snapshot format %s" % formatId)
 
 class Cache():
 
     #Cache size is number of objects to store. 
     #Expiry Time is in seconds. If none, items don't expire 
     #but get removed once the cache fills up. 
-    def __init__(self, cacheSize=10, expiryTime=None, fileName="cache.json"):
+    def __init__(self, cacheSize=10, expiryTime=None, fileName="cache.json", threadSafe=False,
+        tickResolution=1.0, sweep=True, journal=False, fsyncPolicy="os", fsyncInterval=100,
+        snapshotFormat="json", compactThreshold=None, maxBytes=None, sizer=sys.getsizeof,
+        policy="lru", metrics=False, latencySampleEvery=0, metricsHook=None,
+        autosaveInterval=None, autosaveChanges=None, evictionHook=None, changeHook=None,
+        loader=None, refreshAhead=None, staleWhileRevalidate=None, refreshWorkers=4):
         """
             The main class. Can be initialized like so
             from cache import Cache
@@ -67,6 +851,71 @@ class Cache():
             on disk. By default this is never written to, but any time 
             the external cache user can call Cache.WriteToDisk(), Cache.loadFromDisk()
             can be used to reload cached values. 
+            threadSafe guards every operation with a lock so the cache can be 
+            shared between threads (see ShardedCache for spreading that lock out). 
+            A cache with expiryTime and sweep always has the lock, since the expiry 
+            thread changes it from another thread. 
+            tickResolution is how often, in seconds, the expiry thread wakes up. 
+            sweep can be set to False to not start the expiry thread at all, 
+            expireDue() can then be called whenever the caller wants. get treats 
+            entries past their expiry time as missing either way, so with large 
+            caches the thread can be left off and expired entries are removed as 
+            they are read or pushed out. add(key, value, ttl=seconds) gives an entry 
+            its own expiry time, with or without expiryTime. Without expiryTime the 
+            expiry thread is only started for ttls with threadSafe. 
+            journal turns on the write ahead log: every change is appended to 
+            fileName.journal.<n> as it happens and loadFromDisk replays it on top of
+            the last writeToDisk, so a crash loses at most what wasn't synced yet. 
+            fsyncPolicy is one of "always", "interval" (every fsyncInterval 
+            milliseconds) or "os", see FSYNC_POLICIES. 
+            snapshotFormat decides how writeToDisk writes, a name from SNAPSHOT_FORMATS 
+            ("json", "binary", "pickle5" or "struct"), a SnapshotSerializer subclass 
+            or an instance of one. loadFromDisk reads any of them. 
+            compactThreshold is a number of journal records after which the journal 
+            is folded into a fresh snapshot in the background. 
+            maxBytes also limits the cache by the total weight of its entries, 
+            removing the oldest ones until it fits. An entry's weight is given to 
+            add(key, value, weight) or comes from sizer(value), by default sys.getsizeof
+            (which does not count what a value refers to, pass a deeper sizer for
+            containers). A value heavier than maxBytes on its own is not added.
+            totalWeight is the running total. Only sizer weights are recreated 
+            by loadFromDisk. 
+            policy is the eviction policy, a name from EVICTION_POLICIES ("lru", 
+            "sieve" or "tinylfu"), an EvictionPolicy subclass or an instance of one. 
+            metrics turns on the counters returned by stats(): hits, misses, adds, 
+            evictions (for space or expiry), expiry sweeps and disk writes. 
+            latencySampleEvery times one in that many get/add calls into histograms.
+            metricsHook, if given, is called as metricsHook(event, value) for each 
+            "hit", "miss", "add", "evict", "expire" (value is the key), "sweep" and 
+            "write" (value is the time taken in seconds). With metrics off none of 
+            this is done. 
+            autosaveInterval (seconds) and autosaveChanges turn on autosave: a background
+            thread calls writeToDisk every autosaveInterval seconds and as soon as 
+            autosaveChanges keys have been added or removed, if anything changed since 
+            the last write. Changes to the same key in between count once and are 
+            saved once. Reads that only reorder the cache are saved with the next write.
+            Autosave needs threadSafe. flush() writes any changes right away, 
+            stopTimer() flushes and stops the autosave thread with the expiry thread. 
+            evictionHook, if given, is called as evictionHook(key, value, expiryTime) 
+            for every entry removed to make space (not for expired entries), while 
+            holding the lock. TieredCache uses it to move them to its disk tier. 
+            changeHook, if given, is called with every change as a journal record 
+            (see _Journal), while holding the lock, journal or not. cacheReplication 
+            uses it to send the changes to replicas. 
+            loader(key) is used by getOrLoad when it isn't given one and by the 
+            refreshes below, which need it. 
+            refreshAhead (seconds): a get of an entry that expires within this long 
+            reloads it with loader in the background, so keys that are read keep 
+            being fresh instead of expiring and missing. 
+            staleWhileRevalidate (seconds): for this long after an entry's expiry time 
+            get still returns its value, reloading it in the background. After that
+            it is removed as usual. 
+            Reloads run on a pool of refreshWorkers threads (or on refreshWorkers 
+            itself if it is an executor), at most one per key at a time. They only 
+            replace the value if the entry wasn't added again or removed meanwhile,
+            and give it a new expiry time. A loader that raises is kept in 
+            refreshErrors under its key until a reload of that key succeeds, the 
+            most recent one also in refreshError, and the old value stays until it expires. 
             
             This cache does not auto retrieve any non present values. It just returns None.
             External code can catch this and act accordingly
@@ -74,19 +923,48 @@ class Cache():
             if value is None:
                 value = REMOTE_CALL(key)
                 cache.add(key, value)
+            or let getOrLoad do the same while making sure that threads missing the 
+            same key at the same time only make one remote call between them
+            value = cache.getOrLoad(key, REMOTE_CALL)
                 
             test.py
         """
     
     
+        #Every argument is checked before anything is started or opened. 
+        threadSafe = threadSafe or bool(expiryTime and sweep)
+        if (autosaveInterval is not None or autosaveChanges is not None) and not threadSafe:
+            raise ValueError("autosave writes from another thread so it needs threadSafe=True")
+        if (refreshAhead is not None or staleWhileRevalidate is not None) and loader is None:
+            raise ValueError("refreshAhead and staleWhileRevalidate need a loader")
+        if (refreshAhead is not None or staleWhileRevalidate is not None) and not threadSafe:
+            raise ValueError("Refreshes run on other threads so they need threadSafe=True")
+        
         self.size = cacheSize
         self.duration = expiryTime
         self.fileName = fileName
         
+        #The lock is reentrant because public methods call each other 
+        #e.g. add calls updateLatest. The expiry thread also takes it. 
+        self.lock = RLock() if threadSafe else _NoLock()
+        
         #We use a dictionary to contain the actual data values 
         #We can return elements if their key is passed in 
         self.elements = {}
         
+        self.maxBytes = maxBytes
+        self.sizer = sizer
+        self.totalWeight = 0
+        self.evictionHook = evictionHook
+        
+        if isinstance(policy, str):
+            policy = EVICTION_POLICIES[policy]
+        if isinstance(policy, type):
+            policy = policy()
+        self.policy = policy
+        #Looked up once here rather than on every hit. 
+        self.touch = policy.touch
+        
         #We use a linked list to keep track of the order of elements 
         #in the cache. Original idea inspired by this 
         #article https://medium.com/@krishankantsinghal/my-first-blog-on-medium-583159139237
@@ -96,67 +974,579 @@ class Cache():
         #this is for tracking the linked list entries 
         self.entries = {}
         
-        if expiryTime:
-            self.stopSignal = Event()
-            self.timer = _CacheThread(self.stopSignal, self)
-            self.timer.daemon = True
-            self.timer.start()
+        #A min heap of (expiryTime, sequence, entry) so the expiry thread only 
+        #looks at entries that are actually due instead of walking the whole list.
+        #Entries that leave the cache early are left in the heap and skipped 
+        #when they come up, they are gone within one expiry duration anyway.
+        #The sequence number breaks ties so entries themselves are never compared. 
+        self.expiryHeap = []
+        self.expirySequence = itertools.count()
+        
+        self.policy.attach(self)
+        
+        self.metrics = None
+        if metrics:
+            self.metrics = _Metrics(latencySampleEvery, metricsHook)
+        
+        if isinstance(snapshotFormat, str):
+            if snapshotFormat not in SNAPSHOT_FORMATS:
+                raise ValueError("snapshotFormat must be one of %s" % (tuple(SNAPSHOT_FORMATS),))
+            snapshotFormat = SNAPSHOT_FORMATS[snapshotFormat]
+        if isinstance(snapshotFormat, type):
+            snapshotFormat = snapshotFormat()
+        self.serializer = snapshotFormat
         
+        self.journal = None
+        if journal:
+            self.journal = _Journal(fileName, fsyncPolicy, fsyncInterval)
+        self.changeHook = changeHook
+        #Whether changes are turned into records at all. 
+        self.recording = bool(journal) or changeHook is not None
+        self.replaying = False
+            
+        #The loads getOrLoad currently has in progress, by key. 
+        #This always has a real lock since it only matters with several threads.
+        self.flights = {}
+        self.flightLock = Lock()
+        
+        #Only one snapshot is written at a time since they share the temporary file. 
+        self.compactThreshold = compactThreshold
+        self.snapshotLock = Lock()
+        self.compacting = False
+        
+        self.tickResolution = tickResolution
+        self.sweep = sweep
+        self.timer = None
+        if expiryTime and sweep:
+            self._startTimer()
+        #Whether any entry can expire, only then does get check expiry times. 
+        self.expiring = bool(expiryTime)
+        
+        self.loader = loader
+        self.refreshAhead = None if refreshAhead is None else datetime.timedelta(seconds=refreshAhead)
+        self.staleWindow = None if staleWhileRevalidate is None else datetime.timedelta(seconds=staleWhileRevalidate)
+        #The keys being reloaded, the pool is only started on the first reload. 
+        self.refreshing = set()
+        self.refreshWorkers = refreshWorkers
+        self.refresher = None
+        self.refreshError = None
+        self.refreshErrors = {}
+            
+        #The keys added or removed since the last write, None without autosave.
+        #Clearing the cache is recorded as _EVERYTHING. 
+        self.dirtyKeys = None
+        self.autosaveInterval = autosaveInterval
+        self.autosaveChanges = autosaveChanges
+        self.autosaver = None
+        self.autosaveError = None
+        if autosaveInterval is not None or autosaveChanges is not None:
+            self.dirtyKeys = set()
+            self._startAutosave()
+            
+        #Without threadSafe there is nothing to lock, so the two most frequent calls 
+        #go straight to their bodies instead of entering _NoLock every time. 
+        if not threadSafe:
+            self.get = self._get
+            self.add = self._add
+            
+    #Stops the expiry and autosave threads and syncs and closes the journal if there is one. 
+    def close(self):
+        self.stopTimer()
+        if self.journal is not None:
+            self.journal.close()
+        if self.refresher is not None and self.refresher is not self.refreshWorkers:
+            self.refresher.shutdown(wait=False)
+            
+    def _startTimer(self):
+        self.stopSignal = Event()
+        self.timer = _CacheThread(self.stopSignal, self, self.tickResolution)
+        self.timer.daemon = True
+        self.timer.start()
+        
+    def _startAutosave(self):
+        self.autosaveStop = Event()
+        self.autosaveWake = Event()
+        self.autosaver = _AutosaveThread(self.autosaveStop, self.autosaveWake, self, self.autosaveInterval)
+        self.autosaver.daemon = True
+        self.autosaver.start()
+        
+    #Stops the expiry thread and the autosave thread, which writes anything 
+    #still unsaved before stopping. 
     def stopTimer(self):
-        if self.duration is not None:
+        if self.timer is not None:
             self.stopSignal.set()
+            self.timer = None
+        if self.autosaver is not None:
+            self.autosaveStop.set()
+            self.autosaveWake.set()
+            self.autosaver.join()
+            self.autosaver = None
 
+    #Starts the expiry thread again if anything can expire, with expiryTime 
+    #or with entries that were given a ttl (only with threadSafe, see _setExpiry). 
     def restartTimer(self):
-        if self.duration is not None:
-            self.stopSignal = Event()
-            self.timer = _CacheThread(self.stopSignal, self)
-            self.timer.daemon = True
-            self.timer.start()
+        if self.expiring and self.sweep and self.timer is None and not isinstance(self.lock, _NoLock):
+            self._startTimer()
+        if self.dirtyKeys is not None and self.autosaver is None:
+            self._startAutosave()
+            
+    #Records a change for autosave, waking the autosave thread once enough keys changed. 
+    def _changed(self, key):
+        dirtyKeys = self.dirtyKeys
+        dirtyKeys.add(key)
+        if self.autosaveChanges is not None and len(dirtyKeys) >= self.autosaveChanges:
+            self.autosaveWake.set()
+            
+    #Writes the cache if anything changed since the last write (or always without autosave,
+    #which doesn't keep track). Returns whether it wrote. 
+    def flush(self):
+        with self.lock:
+            if self.dirtyKeys is not None and not self.dirtyKeys:
+                return False
+        self.writeToDisk()
+        return True
         
-    def add(self, key, value):
+    #Called by the autosave thread. A failed write is kept in autosaveError 
+    #and tried again on the next wake up. 
+    def _autosave(self):
+        try:
+            self.flush()
+            self.autosaveError = None
+        except Exception as e:
+            self.autosaveError = e
+            with self.lock:
+                self.dirtyKeys.add(_EVERYTHING)
+            
+    #Removes every entry whose expiry time is at or before now.
+    #Only the entries that are due get touched. Returns how many were removed. 
+    def expireDue(self, now=None):
+        removed = 0
+        metrics = self.metrics
+        with self.lock:
+            if metrics is not None:
+                start = time.perf_counter()
+                metrics.lastExpiryLag = 0.0
+            if now is None:
+                now = datetime.datetime.utcnow()
+            #Entries still in their stale while revalidate window stay. 
+            due = now if self.staleWindow is None else now - self.staleWindow
+            heap = self.expiryHeap
+            while heap and heap[0][0] <= due:
+                entry = heapq.heappop(heap)[2]
+                #The entry may have been removed, replaced or given a new ttl since it was scheduled. 
+                if self.entries.get(entry.key) is entry and entry.expiryTime <= due:
+                    self.expire(entry.key)
+                    removed += 1
+                    if metrics is not None:
+                        metrics.expired(entry.key, (now - entry.expiryTime).total_seconds())
+            if metrics is not None:
+                metrics.swept(time.perf_counter() - start)
+        return removed
+        
+    #Journal records are written after the change is made, so a compaction 
+    #started from here always sees the change in the cache itself. They are encoded 
+    #before it though, so a value the journal can't write raises without being added. 
+    #ttl (seconds) gives this entry its own expiry time instead of expiryTime,
+    #adding an existing key with a ttl starts its time again. 
+    def add(self, key, value, weight=None, ttl=None):
+        with self.lock:
+            return self._add(key, value, weight, ttl)
+            
+    #add without taking the lock, which is what add is without threadSafe. 
+    #expiryTime, if given, is the entry's deadline instead of ttl from now, for 
+    #entries that already had one (journal replay, keys moved between shards). 
+    def _add(self, key, value, weight=None, ttl=None, expiryTime=None):
+        metrics = self.metrics
+        if metrics is not None:
+            start = metrics.start("add")
+        if ttl is not None and expiryTime is None:
+            expiryTime = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+        if self.recording:
+            record = self._addRecord(key, value, weight, ttl, expiryTime)
+            line = None if self.journal is None else self.journal.encode(record)
+        if self.maxBytes is not None:
+            entryWeight = self.sizer(value) if weight is None else weight
+            #A value heavier than the whole budget would only push everything 
+            #else out before being removed itself, so it is never added. 
+            if entryWeight > self.maxBytes:
+                if key in self.elements:
+                    self.expire(key)
+                return self
         self.elements[key] = value 
-        self.updateLatest(key)
-        if len(self.elements) > self.size:
-            #We remove the tail i.e. the oldest entry in the cache. 
-            self.elements.pop(self.tail.key)
-            self.entries.pop(self.tail.key)
-            
-            self.tail.previous.next = None
-            self.tail = self.tail.previous 
+        entry = self._addEntry(key)
+        if expiryTime is not None:
+            self._setExpiry(self.entries[key], ttl, expiryTime)
+        if self.dirtyKeys is not None:
+            self._changed(key)
+        if self.maxBytes is not None:
+            self._setWeight(key, entryWeight)
+        #The add is journaled before the evictions it causes, see _evictOverflow. 
+        if self.recording:
+            self._log(record, line)
+        if len(self.elements) > self.size or (self.maxBytes is not None and self.totalWeight > self.maxBytes):
+            self._evictOverflow(entry)
+        if metrics is not None:
+            metrics.added(key, start)
         return self 
         
+    #The record of an add. One that leaves the entry with an expiry time, its own
+    #or expiryTime's, carries it as the deadline so replay doesn't start it again. 
+    def _addRecord(self, key, value, weight, ttl, expiryTime):
+        if expiryTime is None and self.expiring:
+            entry = self.entries.get(key)
+            if entry is not None:
+                ttl, expiryTime = entry.ttl, entry.expiryTime
+            elif self.duration:
+                expiryTime = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.duration)
+        if expiryTime is not None and expiryTime != datetime.datetime.max:
+            return ["a", key, value, weight, ttl, _timestamp(expiryTime)]
+        return ["a", key, value] if weight is None else ["a", key, value, weight]
+        
+    def _setWeight(self, key, weight):
+        entry = self.entries[key]
+        self.totalWeight += weight - entry.weight
+        entry.weight = weight
+        
+    #Adds every key, value pair (or dictionary) passed in under one lock and 
+    #evicts whatever no longer fits once at the end instead of after each add. 
+    #For LRU the result is the same as calling add for each pair in order. 
+    #A policy with admission still gets to turn down each new entry as it overflows the cache. 
+    def addMany(self, items):
+        if hasattr(items, "items"):
+            items = items.items()
+        items = list(items)
+        metrics = self.metrics
+        admission = self.policy.admission
+        with self.lock:
+            #Every record is encoded first so a batch the journal can't write changes nothing. 
+            records = [None] * len(items)
+            lines = records
+            if self.recording:
+                records = [self._addRecord(key, value, None, None, None) for key, value in items]
+            if self.journal is not None:
+                lines = [self.journal.encode(record) for record in records]
+            for (key, value), record, line in zip(items, records, lines):
+                if self.maxBytes is not None:
+                    weight = self.sizer(value)
+                    if weight > self.maxBytes:
+                        if key in self.elements:
+                            self.expire(key)
+                        continue
+                self.elements[key] = value
+                entry = self._addEntry(key)
+                if self.dirtyKeys is not None:
+                    self._changed(key)
+                if self.maxBytes is not None:
+                    self._setWeight(key, weight)
+                if self.recording:
+                    self._log(record, line)
+                if admission and (len(self.elements) > self.size 
+                        or (self.maxBytes is not None and self.totalWeight > self.maxBytes)):
+                    self._evictOverflow(entry)
+                if metrics is not None:
+                    metrics.added(key, None)
+            self._evictOverflow()
+        return self
+        
+    #Puts key in the list, at the head if it is new (returning its entry) 
+    #or wherever the policy moves it to if it was already there (returning None). 
+    def _addEntry(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.touch(self, entry)
+            return None
+        self._updateLatest(key)
+        self.policy.inserted(self, self.head)
+        return self.head
+        
+    #We remove the policy's victim, for LRU the tail i.e. the oldest entry in the cache,
+    #until we fit again. candidate is the entry just added, if any. 
+    #Every eviction is journaled as an expire: which entry goes depends on policy state 
+    #(SIEVE's visited bits, TinyLFU's sketch) that replaying the adds and gets can't 
+    #rebuild, so replay doesn't evict at all and applies these records instead. 
+    def _evictOverflow(self, candidate=None):
+        if self.replaying:
+            return
+        maxBytes = self.maxBytes
+        while self.tail is not None and (len(self.elements) > self.size 
+                or (maxBytes is not None and self.totalWeight > maxBytes)):
+            victim = self.policy.victim(self, candidate)
+            if victim is candidate:
+                candidate = None
+            if self.evictionHook is not None:
+                value = self.elements[victim.key]
+            self._removeEntry(victim)
+            if self.recording:
+                self._log(["e", victim.key])
+            if self.evictionHook is not None:
+                self.evictionHook(victim.key, value, victim.expiryTime)
+            if self.metrics is not None:
+                self.metrics.evicted(victim.key)
+            
+    def _removeEntry(self, entry):
+        self.elements.pop(entry.key)
+        self.entries.pop(entry.key)
+        self.totalWeight -= entry.weight
+        if self.dirtyKeys is not None:
+            self._changed(entry.key)
+        self.policy.removed(self, entry)
+        self._unlink(entry)
+        
     def get(self, key):
-        if key in self.elements:
-            self.updateLatest(key)
-            return self.elements[key]
+        with self.lock:
+            return self._get(key)
+            
+    #get without taking the lock, which is what get is without threadSafe. 
+    def _get(self, key):
+        metrics = self.metrics
+        if metrics is not None:
+            start = metrics.start("get")
+        entry = self.entries.get(key)
+        if entry is not None and self.expiring and self._expiredOnRead(entry):
+            entry = None
+        if entry is not None:
+            if self.touch(self, entry) and self.recording:
+                self._log(["g", key])
+            value = self.elements[key]
         else:
-            return None
+            self.policy.missed(self, key)
+            value = None
+        if metrics is not None:
+            metrics.got(key, entry is not None, start)
+        return value
+            
+    #Returns the cached value for key or, on a miss, calls loader(key), 
+    #adds the result and returns it. Concurrent misses on the same key wait for 
+    #the first one's loader instead of calling their own. If the loader raises, 
+    #every waiting caller gets the error and nothing is cached. 
+    #Like get, a loader returning None is treated as nothing to cache. 
+    #Without a loader the cache's own is used. 
+    def getOrLoad(self, key, loader=None):
+        if loader is None:
+            loader = self.loader
+        value = self.get(key)
+        if value is not None:
+            return value
+            
+        with self.flightLock:
+            flight = self.flights.get(key)
+            if flight is None:
+                #Another thread may have finished loading just before we got the lock. 
+                value = self.get(key)
+                if value is not None:
+                    return value
+                flight = _Flight()
+                self.flights[key] = flight
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            return flight.wait()
+            
+        try:
+            flight.value = loader(key)
+            if flight.value is not None:
+                self.add(key, flight.value)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.flightLock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.value
+        
+    #Looks up every key under one lock, promoting the ones found in order. 
+    #Returns a dictionary of the keys that were in the cache and their values, 
+    #missing keys are left out. 
+    def getMany(self, keys):
+        found = {}
+        with self.lock:
+            entries = self.entries
+            for key in keys:
+                entry = entries.get(key)
+                if entry is not None and self.expiring and self._expiredOnRead(entry):
+                    entry = None
+                if entry is not None:
+                    promoted = self.touch(self, entry)
+                    if self.recording and promoted:
+                        self._log(["g", key])
+                    found[key] = self.elements[key]
+                else:
+                    self.policy.missed(self, key)
+                if self.metrics is not None:
+                    self.metrics.got(key, entry is not None, None)
+        return found
+        
+    #Removes every key passed in that is in the cache under one lock.
+    #Unlike expire, missing keys are skipped. Returns how many were removed. 
+    def expireMany(self, keys):
+        removed = 0
+        with self.lock:
+            for key in keys:
+                if key in self.elements:
+                    self.expire(key)
+                    removed += 1
+        return removed
             
     #removes a key from the cache. 
     def expire(self, key):
-        self.elements.pop(key)
-        self.entries.pop(key)
-        
-        if self.head.key == key:
-            self.head = self.head.next
-            if self.head is not None:
-                self.head.previous = None
-        if self.tail.key == key:
-            self.tail = self.tail.previous 
-            if self.tail is not None:
-                self.tail.next = None
+        with self.lock:
+            self._removeEntry(self.entries[key])
+            if self.recording:
+                self._log(["e", key])
+                
+    #Passes a record to the changeHook and appends it to the journal, starting 
+    #a compaction once the journal has grown past compactThreshold. Without a real 
+    #lock the cache can't be copied from another thread so the compaction happens 
+    #right here instead. 
+    def _log(self, record, line=None):
+        if self.changeHook is not None:
+            self.changeHook(record)
+        if self.journal is None:
+            return
+        self.journal.append(record, line)
+        if (self.compactThreshold and not self.compacting 
+                and self.journal.records >= self.compactThreshold):
+            self.compacting = True
+            if isinstance(self.lock, _NoLock):
+                self.compact()
+            else:
+                compactor = Thread(target=self.compact)
+                compactor.daemon = True
+                compactor.start()
+                
+    #Folds the journal into a fresh snapshot, see writeToDisk. 
+    def compact(self):
+        try:
+            self.writeToDisk()
+        finally:
+            self.compacting = False
+            
+    #Takes an entry out of the linked list, joining its neighbours together. 
+    def _unlink(self, entry):
+        if entry.previous is not None:
+            entry.previous.next = entry.next
+        else:
+            self.head = entry.next
+        if entry.next is not None:
+            entry.next.previous = entry.previous
+        else:
+            self.tail = entry.previous
+        entry.previous = None
+        entry.next = None
         
     def expireAll(self):
-        self.elements = {}
-        self.entries = {}
-        self.head = None 
-        self.tail = None 
+        with self.lock:
+            self.elements = {}
+            self.entries = {}
+            self.expiryHeap = []
+            self.totalWeight = 0
+            self.head = None 
+            self.tail = None 
+            self.policy.clear(self)
+            if self.dirtyKeys is not None:
+                self._changed(_EVERYTHING)
+            if self.recording:
+                self._log(["x"])
+            
+    #Creates a linked list entry for a new key and schedules its expiry. 
+    def _newEntry(self, key, previousEntry, nextEntry):
+        entry = CacheEntry(key, previousEntry, nextEntry, self.duration)
+        if self.duration:
+            self._schedule(entry)
+        return entry
+        
+    def _schedule(self, entry):
+        #Without regular sweeps the heap would keep growing with entries that left 
+        #the cache early, so once they outnumber the live ones it is built again. 
+        if len(self.expiryHeap) > 2 * len(self.entries) + 1024:
+            never = datetime.datetime.max
+            self.expiryHeap = [(live.expiryTime, next(self.expirySequence), live) 
+                for live in self.entries.values() if live.expiryTime != never]
+            heapq.heapify(self.expiryHeap)
+        heapq.heappush(self.expiryHeap, (entry.expiryTime, next(self.expirySequence), entry))
+            
+    #Gives an entry its own expiry time, ttl seconds from now unless expiryTime 
+    #is given. The first time this happens on a threadSafe cache without expiryTime 
+    #the expiry thread is started. Without a lock for it to take, expired entries 
+    #are only removed as they are read or by expireDue. 
+    def _setExpiry(self, entry, ttl, expiryTime=None):
+        entry.ttl = ttl
+        if expiryTime is None:
+            expiryTime = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+        entry.expiryTime = expiryTime
+        self._schedule(entry)
+        #Once stopped with stopTimer the thread only comes back with restartTimer. 
+        if not self.expiring:
+            self.expiring = True
+            if self.sweep and self.timer is None and not isinstance(self.lock, _NoLock):
+                self._startTimer()
+            
+    #Entries past their expiry time are treated as missing by get, even before 
+    #the expiry thread gets to them. Removes the entry and returns True if it expired. 
+    #Entries close to expiring, or just past it within the stale window, are reloaded instead. 
+    def _expiredOnRead(self, entry):
+        now = datetime.datetime.utcnow()
+        if entry.expiryTime > now:
+            if self.refreshAhead is not None and entry.expiryTime - now <= self.refreshAhead:
+                self._refresh(entry)
+            return False
+        if self.staleWindow is not None and now - entry.expiryTime < self.staleWindow:
+            self._refresh(entry)
+            return False
+        self.expire(entry.key)
+        if self.metrics is not None:
+            self.metrics.expired(entry.key, (now - entry.expiryTime).total_seconds())
+        return True
         
+    #Starts reloading an entry in the background unless it is already being reloaded. 
+    def _refresh(self, entry):
+        if entry.key in self.refreshing:
+            return
+        self.refreshing.add(entry.key)
+        if self.refresher is None:
+            if isinstance(self.refreshWorkers, int):
+                self.refresher = ThreadPoolExecutor(max_workers=self.refreshWorkers)
+            else:
+                self.refresher = self.refreshWorkers
+        self.refresher.submit(self._reload, entry, self.elements[entry.key])
+        
+    #Runs on the refresh pool. old is the value being reloaded, if the key 
+    #has another one by the end it was added again meanwhile. 
+    def _reload(self, entry, old):
+        key = entry.key
+        value = None
+        error = None
+        try:
+            value = self.loader(key)
+        except Exception as e:
+            error = e
+        with self.lock:
+            self.refreshing.discard(key)
+            #Only a reload of the same key clears its error. 
+            errors = self.refreshErrors
+            if error is not None:
+                errors.pop(key, None)
+                errors[key] = error
+                self.refreshError = error
+                #The oldest errors go once there are more than the cache holds. 
+                if len(errors) > self.size:
+                    del errors[next(iter(errors))]
+            elif errors.pop(key, None) is self.refreshError:
+                self.refreshError = None
+            if value is not None and self.entries.get(key) is entry and self.elements[key] is old:
+                self.add(key, value, ttl=entry.ttl or self.duration)
+                
     def updateLatest(self, key):
+        with self.lock:
+            self._updateLatest(key)
+            
+    def _updateLatest(self, key):
         #We change the position of the head to be whatever was passed in. 
         #If we don't have a head, i.e. the cache is empty, we just set it.
         if self.head is None:
-            self.head = CacheEntry(key, None, None, self.duration)
+            self.head = self._newEntry(key, None, None)
             self.tail = self.head
             self.entries[key] = self.head
             return
@@ -165,7 +1555,7 @@ class Cache():
             return 
         
         if key not in self.entries:
-            newEntry = CacheEntry(key=key, previous=None, next=self.head, duration=self.duration)
+            newEntry = self._newEntry(key, None, self.head)
             self.head.previous = newEntry
             self.entries[key] = newEntry
             self.head = newEntry
@@ -182,6 +1572,7 @@ class Cache():
         entry.previous.next = entry.next 
         
         self.head.previous = entry
+        entry.previous = None
         entry.next = self.head
         self.head = entry
         
@@ -189,12 +1580,23 @@ class Cache():
     #in as a tuple of the dictionary and a list for the order.
     #Mostly used for testing.
     def getCacheValues(self):
-        cache_order = [entry.key for entry in self.iterate()]
-        
-        return (self.elements, cache_order, 
-            None if not self.head else self.head.key, 
-            None if not self.tail else self.tail.key)
+        with self.lock:
+            cache_order = [entry.key for entry in self.iterate()]
+            
+            return (self.elements, cache_order, 
+                None if not self.head else self.head.key, 
+                None if not self.tail else self.tail.key)
         
+    #A snapshot of the cache's size and, when it was created with metrics=True, 
+    #its counters. Latency histograms map a bucket's upper bound in microseconds
+    #to the number of sampled calls that took less than it. 
+    def stats(self):
+        with self.lock:
+            stats = {"size": len(self.elements), "totalWeight": self.totalWeight}
+            if self.metrics is not None:
+                stats.update(self.metrics.snapshot())
+            return stats
+            
     #We write the entire cache to disk.
     #Note: We assume the values being stored are json compliant,
     #if this assumption is false, we can implement a custom serializer, use pickle or 
@@ -209,29 +1611,82 @@ class Cache():
         temp_file = self.fileName + "_tmp"
         perm_file = self.fileName
         
-        cache_in_order = [entry.key for entry in self.iterate()]
-        values = [self.elements[key] for key in cache_in_order]
-        backup = {
-            'keys': cache_in_order,
-            'values': values
-        }
+        with self.snapshotLock:
+            if self.metrics is not None:
+                start = time.perf_counter()
+            #We only hold the lock while copying, the file writing happens after. 
+            #Changes made after the copy go to a new journal generation. 
+            #Only references are copied, the serializer writes each value 
+            #from there straight to the file. 
+            #The old journal is synced after, so callers never wait on the disk. 
+            generation = None
+            with self.lock:
+                cache_in_order = [entry.key for entry in self.iterate()]
+                values = [self.elements[key] for key in cache_in_order]
+                expiries = self._expiries()
+                if self.journal is not None:
+                    generation, oldJournal = self.journal.rotate()
+                if self.dirtyKeys is not None:
+                    self.dirtyKeys.clear()
+            if self.journal is not None:
+                self.journal.retire(oldJournal)
+                    
+            with open(temp_file, "wb") as f:
+                self.serializer.write(f, cache_in_order, values, generation, expiries)
+                
+            #We try to rename the tmp file. 
+            try:
+                os.rename(temp_file, perm_file)
+            except OSError:
+                #The file already exists
+                #note: this operation is not atomic
+                os.remove(perm_file)
+                os.rename(temp_file, perm_file)
+                
+            #The snapshot covers the older journals now. 
+            if self.journal is not None:
+                self.journal.removeBefore(generation)
+                
+            if self.metrics is not None:
+                seconds = time.perf_counter() - start
+                size = os.path.getsize(perm_file)
+                with self.lock:
+                    self.metrics.wrote(seconds, size)
+            
+        return (self.elements, cache_in_order)
         
-        with open(temp_file, "w") as f:
-            json.dump(backup, f)
+    #[key, ttl, deadline] for every entry that expires, for the snapshot. 
+    #Snapshots keep the deadlines rather than the ttls so a reload doesn't start them again. 
+    def _expiries(self):
+        if not self.expiring:
+            return []
+        never = datetime.datetime.max
+        return [[entry.key, entry.ttl, _timestamp(entry.expiryTime)] 
+            for entry in self.entries.values() if entry.expiryTime != never]
             
-        #We try to rename the tmp file. 
-        try:
-            os.rename(temp_file, perm_file)
-        except OSError:
-            #The file already exists
-            #note: this operation is not atomic
-            os.remove(perm_file)
-            os.rename(temp_file, perm_file)
+    #Puts the (key, value) pairs read from a snapshot straight into the cache. 
+    #Each pair is the most recently used so far, so it becomes the new head.
+    def _loadPairs(self, pairs):
+        elements = self.elements
+        entries = self.entries
+        for key, value in pairs:
+            elements[key] = value
             
-        return (self.elements, cache_in_order)
+            #The same as _updateLatest for a new key, without the checks. 
+            if key in entries:
+                self._unlink(entries[key])
+            entry = self._newEntry(key, None, self.head)
+            if self.head is None:
+                self.tail = entry
+            else:
+                self.head.previous = entry
+            self.head = entry
+            entries[key] = entry
         
     #A python generator that 
     #iterates through the nodes and yields each one.
+    #Note: this does not take the lock, callers sharing the cache 
+    #between threads should hold cache.lock while iterating. 
     def iterate(self):
         if self.head is None:
             return None 
@@ -258,14 +1713,657 @@ class Cache():
     def loadFromDisk(self):
         persistent_file = self.fileName
         
-        with open(persistent_file, 'r') as f:
-            #We load up a file in case we crashed or what have you.
-            data = json.load(f)
+        with self.lock:
+            self.elements = {}
+            self.entries = {}
+            self.expiryHeap = []
+            self.totalWeight = 0
+            self.head = None
+            self.tail = None
+            self.policy.clear(self)
+            
+            #Creating lots of entries at once makes the garbage collector run over 
+            #and over while there is nothing for it to free, so it is paused while loading. 
+            gcWasEnabled = gc.isenabled()
+            gc.disable()
+            try:
+                self._load(persistent_file)
+            finally:
+                if gcWasEnabled:
+                    gc.enable()
+                    
+            #What was just loaded is already on disk. 
+            if self.dirtyKeys is not None:
+                self.dirtyKeys.clear()
+                    
+    def _load(self, persistent_file):
+        #With a journal we may have crashed before ever writing a snapshot, 
+        #in which case everything is in the journal. 
+        #The journal is detached while loading so neither the replay nor what 
+        #doesn't fit at the end is journaled again. 
+        generation = 0
+        journal = self.journal
+        self.journal = None
+        try:
+            if journal is None or os.path.exists(persistent_file):
+                with open(persistent_file, 'rb') as f:
+                    #We load up a file in case we crashed or what have you.
+                    #The snapshot's first bytes tell which format it was written in. 
+                    serializer = _snapshotSerializer(f)
+                    generation, pairs = serializer.read(f)
+                    self._loadPairs(pairs)
+                    for key, ttl, deadline in serializer.expiries:
+                        if key in self.entries:
+                            self._setExpiry(self.entries[key], ttl, _fromTimestamp(deadline))
+                    
+                if self.maxBytes is not None:
+                    for key, value in self.elements.items():
+                        self._setWeight(key, self.sizer(value))
+                
+            #We then redo everything that happened after the snapshot was written.
+            if journal is not None:
+                for record in journal.replay(generation):
+                    self._applyRecord(record)
+                    
+            #The journal holds the evictions, anything still over the limits was 
+            #written with a bigger cache or by a version that didn't journal them. 
+            self._evictOverflow()
+        finally:
+            self.journal = journal
+                
+    #Applies one journal record to the cache, without evicting anything since the 
+    #evictions are records of their own. An add whose deadline has passed by now 
+    #only removes what the key had before. 
+    def _applyRecord(self, record):
+        self.replaying = True
+        try:
+            self._apply(record)
+        finally:
+            self.replaying = False
+            
+    def _apply(self, record):
+        operation = record[0]
+        if operation == "a":
+            if len(record) < 6:
+                self.add(*record[1:])
+                return
+            key, value, weight, ttl, deadline = record[1:]
+            expiryTime = _fromTimestamp(deadline)
+            if expiryTime <= datetime.datetime.utcnow():
+                if key in self.elements:
+                    self.expire(key)
+                return
+            with self.lock:
+                self._add(key, value, weight, ttl, expiryTime)
+        elif operation == "g":
+            self.get(record[1])
+        elif operation == "e":
+            if record[1] in self.elements:
+                self.expire(record[1])
+        elif operation == "x":
+            self.expireAll()
+            
+#A cache made of several independent Caches (shards), each with its own lock.
+#A key always goes to the same shard so threads working on different keys
+#mostly end up on different locks instead of all waiting on one. 
+#Note: the LRU order is kept per shard, so the least recently used entry 
+#of the whole cache is not always the one removed. 
+class ShardedCache():
+
+    def __init__(self, cacheSize=10, expiryTime=None, fileName="cache.json", shards=8,
+        tickResolution=1.0, sweep=True, journal=False, fsyncPolicy="os", fsyncInterval=100,
+        snapshotFormat="json", compactThreshold=None, maxBytes=None, sizer=sys.getsizeof,
+        policy="lru", metrics=False, latencySampleEvery=0, metricsHook=None,
+        autosaveInterval=None, autosaveChanges=None, loader=None, refreshAhead=None,
+        staleWhileRevalidate=None, refreshWorkers=4):
+        """
+            Same arguments as Cache plus shards, the number of independent 
+            caches to spread the keys over. cacheSize, maxBytes and autosaveChanges 
+            are split evenly between them, the refresh pool is shared.
+            Each shard writes to its own file named fileName.<shard number>
+            (and its own journal next to it). Each shard needs its own eviction policy
+            so policy has to be a name or a class here, not an instance. 
+        """
+        self.size = cacheSize
+        self.duration = expiryTime
+        self.fileName = fileName
+        
+        shardSize = max(1, -(-cacheSize // shards))
+        shardBytes = None if maxBytes is None else maxBytes // shards
+        if isinstance(refreshWorkers, int) and (refreshAhead is not None or staleWhileRevalidate is not None):
+            refreshWorkers = ThreadPoolExecutor(max_workers=refreshWorkers)
+        self.refresher = refreshWorkers
+        #The shards don't get their own expiry threads, one thread sweeps all of them.
+        self.shards = [Cache(shardSize, expiryTime, "%s.%d" % (fileName, i), threadSafe=True, sweep=False,
+            journal=journal, fsyncPolicy=fsyncPolicy, fsyncInterval=fsyncInterval,
+            snapshotFormat=snapshotFormat, compactThreshold=compactThreshold, maxBytes=shardBytes, sizer=sizer,
+            policy=policy, metrics=metrics, latencySampleEvery=latencySampleEvery, metricsHook=metricsHook,
+            autosaveInterval=autosaveInterval, 
+            autosaveChanges=None if autosaveChanges is None else max(1, autosaveChanges // shards),
+            loader=loader, refreshAhead=refreshAhead, staleWhileRevalidate=staleWhileRevalidate,
+            refreshWorkers=refreshWorkers) 
+            for i in range(shards)]
+            
+        self.tickResolution = tickResolution
+        self.sweep = sweep
+        self.timer = None
+        self.expiring = bool(expiryTime)
+        if expiryTime and sweep:
+            self._startTimer()
+        
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+        
+    def _startTimer(self):
+        self.stopSignal = Event()
+        self.timer = _CacheThread(self.stopSignal, self, self.tickResolution)
+        self.timer.daemon = True
+        self.timer.start()
+        
+    #Also stops the shards' autosave threads, see Cache.stopTimer. 
+    def stopTimer(self):
+        if self.timer is not None:
+            self.stopSignal.set()
+            self.timer = None
+        for shard in self.shards:
+            shard.stopTimer()
+            
+    def restartTimer(self):
+        self.expiring = self.expiring or any(shard.expiring for shard in self.shards)
+        if self.expiring and self.sweep and self.timer is None:
+            self._startTimer()
+        for shard in self.shards:
+            shard.restartTimer()
+            
+    def close(self):
+        self.stopTimer()
+        for shard in self.shards:
+            shard.close()
+        if isinstance(self.refresher, ThreadPoolExecutor):
+            self.refresher.shutdown(wait=False)
+            
+    #Returns whether any shard wrote. 
+    def flush(self):
+        return any([shard.flush() for shard in self.shards])
+            
+    def expireDue(self, now=None):
+        return sum(shard.expireDue(now) for shard in self.shards)
+        
+    def add(self, key, value, weight=None, ttl=None):
+        self._shard(key).add(key, value, weight, ttl)
+        #The shards have no expiry threads of their own. 
+        if ttl is not None and not self.expiring:
+            self.expiring = True
+            if self.sweep and self.timer is None:
+                self._startTimer()
+        return self
+        
+    @property
+    def totalWeight(self):
+        return sum(shard.totalWeight for shard in self.shards)
+        
+    def get(self, key):
+        return self._shard(key).get(key)
+        
+    def getOrLoad(self, key, loader=None):
+        return self._shard(key).getOrLoad(key, loader)
+        
+    def expire(self, key):
+        self._shard(key).expire(key)
+        
+    #Groups the keys (or pairs) by shard so each shard's lock is taken once per batch. 
+    def _byShard(self, keys, keyOf=None):
+        grouped = {}
+        for item in keys:
+            shard = self._shard(item if keyOf is None else keyOf(item))
+            if shard in grouped:
+                grouped[shard].append(item)
+            else:
+                grouped[shard] = [item]
+        return grouped
+        
+    def addMany(self, items):
+        if hasattr(items, "items"):
+            items = items.items()
+        for shard, shardItems in self._byShard(items, lambda item: item[0]).items():
+            shard.addMany(shardItems)
+        return self
+        
+    def getMany(self, keys):
+        found = {}
+        for shard, shardKeys in self._byShard(keys).items():
+            found.update(shard.getMany(shardKeys))
+        return found
+        
+    def expireMany(self, keys):
+        return sum(shard.expireMany(shardKeys) for shard, shardKeys in self._byShard(keys).items())
+        
+    def expireAll(self):
+        for shard in self.shards:
+            shard.expireAll()
+            
+    #Same as Cache.getCacheValues but the order is shard by shard. 
+    def getCacheValues(self):
+        elements = {}
+        order = []
+        for shard in self.shards:
+            shardElements, shardOrder, head, tail = shard.getCacheValues()
+            elements.update(shardElements)
+            order += shardOrder
+        return (elements, order)
+        
+    #The shards' stats added together. The last/max timings are the largest 
+    #of any shard and the hit ratio is worked out again from the totals. 
+    def stats(self):
+        total = {}
+        for shard in self.shards:
+            for name, value in shard.stats().items():
+                if isinstance(value, dict):
+                    histogram = total.setdefault(name, {})
+                    for bucket, count in value.items():
+                        histogram[bucket] = histogram.get(bucket, 0) + count
+                elif name.startswith("last") or name.startswith("max"):
+                    total[name] = max(total.get(name, value), value)
+                else:
+                    total[name] = total.get(name, 0) + value
+        if "hits" in total:
+            lookups = total["hits"] + total["misses"]
+            total["hitRatio"] = total["hits"] / float(lookups) if lookups else 0.0
+        return total
+        
+    def writeToDisk(self):
+        elements = {}
+        order = []
+        for shard in self.shards:
+            shardElements, shardOrder = shard.writeToDisk()
+            elements.update(shardElements)
+            order += shardOrder
+        return (elements, order)
+        
+    #Python randomizes string hashes between runs so a key may not belong
+    #to the same shard it was saved from. Each shard loads its own file 
+    #and then any key that now belongs elsewhere is moved, oldest first
+    #so the moved keys keep their relative order. 
+    def loadFromDisk(self):
+        for shard in self.shards:
+            shard.loadFromDisk()
+            
+        for shard in self.shards:
+            with shard.lock:
+                misplaced = [entry.key for entry in shard.reverse_iterate() 
+                    if self._shard(entry.key) is not shard]
+            #A moved key keeps its weight and its expiry time. 
+            for key in misplaced:
+                entry = shard.entries[key]
+                value = shard.elements[key]
+                shard.expire(key)
+                target = self._shard(key)
+                with target.lock:
+                    target._add(key, value, entry.weight if shard.maxBytes is not None else None, entry.ttl,
+                        None if entry.expiryTime == datetime.datetime.max else entry.expiryTime)
+                        
+        #Deadlines that came with the snapshots need the expiry thread as much as new ttls. 
+        if not self.expiring and any(shard.expiring for shard in self.shards):
+            self.expiring = True
+            if self.sweep and self.timer is None:
+                self._startTimer()
+
+
+#Wraps a cache (Cache, ShardedCache...) for use from asyncio code.
+#get and add don't wait on anything so they are the wrapped cache's own, 
+#get_or_load is the asyncio version of Cache.getOrLoad: concurrent misses 
+#on the same key await a single call of the loader coroutine. 
+#Note: this is meant to be used from one event loop. 
+class AsyncCache():
+
+    def __init__(self, cache=None, **cacheArguments):
+        """
+            Either pass in the cache to wrap or the arguments to create a Cache with
+            e.g. AsyncCache(cacheSize=100, expiryTime=60)
+            value = await cache.get_or_load(key, REMOTE_CALL)
+        """
+        self.cache = cache if cache is not None else Cache(**cacheArguments)
+        self.flights = {}
+        
+    def get(self, key):
+        return self.cache.get(key)
+        
+    def add(self, key, value, weight=None, ttl=None):
+        if ttl is not None:
+            self.cache.add(key, value, weight, ttl)
+        elif weight is None:
+            self.cache.add(key, value)
+        else:
+            self.cache.add(key, value, weight)
+        return self
+        
+    def expire(self, key):
+        self.cache.expire(key)
+        
+    async def get_or_load(self, key, loader):
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+            
+        flight = self.flights.get(key)
+        if flight is not None:
+            #Shielded so one waiter being cancelled doesn't cancel the load for the rest. 
+            return await asyncio.shield(flight)
             
-        self.elements = dict(zip(data['keys'], data['values']))
+        flight = asyncio.get_event_loop().create_future()
+        #Nobody may be waiting to see an error, this keeps asyncio from warning about it.
+        flight.add_done_callback(_retrieveError)
+        self.flights[key] = flight
+        try:
+            value = await loader(key)
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            del self.flights[key]
+        if value is not None:
+            self.cache.add(key, value)
+        flight.set_result(value)
+        return value
+        
+def _retrieveError(future):
+    if not future.cancelled():
+        future.exception()
+        
+#Same fields as functools.lru_cache's cache_info(). 
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+#Separates the positional arguments from the keyword ones in memoization keys. 
+#Pickled by name so keys loaded from a persisted cache still contain this same object. 
+class _KeywordMark():
+    def __reduce__(self):
+        return "_KEYWORDS"
+        
+_KEYWORDS = _KeywordMark()
+
+#Memoizes a function in a Cache, like functools.lru_cache but with expiry and persistence. 
+#    @cached(cacheSize=1000, ttl=60)
+#    def lookup(name): ...
+#A call with the same arguments within ttl seconds returns the remembered result. 
+#Arguments have to be hashable. The key is the single argument itself when the function 
+#is called with one int or str, like lru_cache, and a tuple of the arguments otherwise
+#(keyword arguments in the order given, so f(a=1, b=2) and f(b=2, a=1) are remembered apart).
+#None results aren't remembered, since Cache.get returns None for a miss. 
+#persist is a file name: the results are loaded from it when the function is decorated 
+#and written to it when the program exits (in the binary snapshot format, since the keys are 
+#tuples), so they survive restarts. Any other arguments (policy, maxBytes, threadSafe...) go to 
+#the Cache, which is threadSafe by default here and has no expiry thread, results past their 
+#ttl are dropped when they are next looked up. 
+#The decorated function gets cache_info(), cache_clear(), cache_save() and cache (the Cache). 
+def cached(cacheSize=128, ttl=None, persist=None, **cacheArguments):
+    cacheArguments.setdefault("threadSafe", True)
+    cacheArguments.setdefault("sweep", False)
+    if persist is not None:
+        cacheArguments.setdefault("snapshotFormat", "binary")
+        
+    def decorator(function):
+        cache = Cache(cacheSize, ttl, fileName=persist or "cache.json", **cacheArguments)
+        if persist is not None:
+            if os.path.exists(persist):
+                cache.loadFromDisk()
+            atexit.register(cache.writeToDisk)
+            
+        get = cache.get
+        add = cache.add
+        counts = [0, 0]
+        
+        def wrapper(*args, **kwargs):
+            if kwargs:
+                key = args + (_KEYWORDS,) + tuple(kwargs.items())
+            elif len(args) == 1 and type(args[0]) in (int, str):
+                key = args[0]
+            else:
+                key = args
+            value = get(key)
+            if value is not None:
+                counts[0] += 1
+                return value
+            counts[1] += 1
+            value = function(*args, **kwargs)
+            if value is not None:
+                add(key, value)
+            return value
+            
+        def cache_info():
+            return CacheInfo(counts[0], counts[1], cacheSize, len(cache.elements))
+            
+        def cache_clear():
+            cache.expireAll()
+            counts[0] = counts[1] = 0
+            
+        def cache_save():
+            cache.writeToDisk()
+            
+        wrapper.cache = cache
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_save = cache_save
+        return functools.update_wrapper(wrapper, function)
+    return decorator
+                
+#Marks the end of a list in CompactCache, the arrays equivalent of None.
+_NIL = -1
+
+#A cache with the same behaviour as Cache but without an object per entry.
+#Every entry lives in a slot, an index into a set of arrays preallocated to cacheSize:
+#the key and value lists, the previous/next slot of the LRU linked list and, when
+#entries expire, the expiry time as a monotonic float and a second linked list
+#in creation order (entries expire in the order they were created so the oldest
+#is always the next one due). A single dictionary maps each key to its slot and 
+#unused slots are chained together through the next array. 
+class CompactCache():
+
+    def __init__(self, cacheSize=10, expiryTime=None, fileName="cache.json", threadSafe=False,
+        tickResolution=1.0, sweep=True):
+        """
+            Same arguments as Cache. Entries whose expiry time has passed are also
+            treated as missing by get, without waiting for the expiry thread. 
+            Snapshots are written in the same json format as Cache.writeToDisk. 
+        """
+        self.size = cacheSize
+        self.duration = expiryTime
+        self.fileName = fileName
+        #The expiry thread needs a real lock, see Cache. 
+        threadSafe = threadSafe or bool(expiryTime and sweep)
+        self.lock = RLock() if threadSafe else _NoLock()
+        self._reset()
+        
+        self.tickResolution = tickResolution
+        self.sweep = sweep
+        self.timer = None
+        if expiryTime and sweep:
+            self._startTimer()
             
-        #To recreate the order and the entries, we simply reverse the read array
-        #and call update on each element. This is akin to accessing each element in the cache   
-        for key in reversed(data['keys']):
-            self.updateLatest(key)
-        
\ No newline at end of file
+    def _reset(self):
+        size = self.size
+        self.slots = {}
+        self.keys = [None] * size
+        self.values = [None] * size
+        self.previous = array("i", [_NIL]) * size
+        self.next = array("i", range(1, size + 1))
+        if size:
+            self.next[size - 1] = _NIL
+        self.freeSlot = 0 if size else _NIL
+        self.head = _NIL
+        self.tail = _NIL
+        
+        if self.duration:
+            self.expiryTimes = array("d", [0.0]) * size
+            self.older = array("i", [_NIL]) * size
+            self.newer = array("i", [_NIL]) * size
+            self.oldest = _NIL
+            self.newest = _NIL
+            
+    def _startTimer(self):
+        self.stopSignal = Event()
+        self.timer = _CacheThread(self.stopSignal, self, self.tickResolution)
+        self.timer.daemon = True
+        self.timer.start()
+        
+    def stopTimer(self):
+        if self.timer is not None:
+            self.stopSignal.set()
+            self.timer = None
+            
+    def restartTimer(self):
+        if self.duration and self.sweep and self.timer is None:
+            self._startTimer()
+            
+    def close(self):
+        self.stopTimer()
+        
+    def _unlink(self, slot):
+        previous = self.previous[slot]
+        following = self.next[slot]
+        if previous != _NIL:
+            self.next[previous] = following
+        else:
+            self.head = following
+        if following != _NIL:
+            self.previous[following] = previous
+        else:
+            self.tail = previous
+            
+    def _pushFront(self, slot):
+        self.previous[slot] = _NIL
+        self.next[slot] = self.head
+        if self.head != _NIL:
+            self.previous[self.head] = slot
+        else:
+            self.tail = slot
+        self.head = slot
+        
+    #Takes a slot out of both lists and puts it back on the free chain.
+    def _remove(self, slot):
+        del self.slots[self.keys[slot]]
+        self._unlink(slot)
+        self.keys[slot] = None
+        self.values[slot] = None
+        
+        if self.duration:
+            older = self.older[slot]
+            newer = self.newer[slot]
+            if older != _NIL:
+                self.newer[older] = newer
+            else:
+                self.oldest = newer
+            if newer != _NIL:
+                self.older[newer] = older
+            else:
+                self.newest = older
+                
+        self.next[slot] = self.freeSlot
+        self.freeSlot = slot
+        
+    def add(self, key, value):
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is not None:
+                self.values[slot] = value
+                if slot != self.head:
+                    self._unlink(slot)
+                    self._pushFront(slot)
+                return self
+                
+            #Nothing fits in a cache of size 0. 
+            if not self.size:
+                return self
+            #We remove the tail i.e. the oldest entry in the cache to free a slot. 
+            if self.freeSlot == _NIL:
+                self._remove(self.tail)
+            slot = self.freeSlot
+            self.freeSlot = self.next[slot]
+            
+            self.keys[slot] = key
+            self.values[slot] = value
+            self.slots[key] = slot
+            self._pushFront(slot)
+            
+            if self.duration:
+                self.expiryTimes[slot] = time.monotonic() + self.duration
+                self.older[slot] = self.newest
+                self.newer[slot] = _NIL
+                if self.newest != _NIL:
+                    self.newer[self.newest] = slot
+                else:
+                    self.oldest = slot
+                self.newest = slot
+        return self
+        
+    def get(self, key):
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                return None
+            if self.duration and self.expiryTimes[slot] <= time.monotonic():
+                self._remove(slot)
+                return None
+            if slot != self.head:
+                self._unlink(slot)
+                self._pushFront(slot)
+            return self.values[slot]
+            
+    def expire(self, key):
+        with self.lock:
+            self._remove(self.slots[key])
+            
+    def expireAll(self):
+        with self.lock:
+            self._reset()
+            
+    #Removes every entry whose expiry time is at or before now (a time.monotonic() value).
+    #Returns how many were removed. 
+    def expireDue(self, now=None):
+        removed = 0
+        if not self.duration:
+            return removed
+        with self.lock:
+            if now is None:
+                now = time.monotonic()
+            while self.oldest != _NIL and self.expiryTimes[self.oldest] <= now:
+                self._remove(self.oldest)
+                removed += 1
+        return removed
+        
+    #Yields the keys from the most to the least recently used. 
+    #Like Cache.iterate this does not take the lock. 
+    def iterateKeys(self):
+        slot = self.head
+        while slot != _NIL:
+            yield self.keys[slot]
+            slot = self.next[slot]
+            
+    #Same as Cache.getCacheValues, the elements dictionary is built on request. 
+    def getCacheValues(self):
+        with self.lock:
+            cache_order = list(self.iterateKeys())
+            elements = dict((key, self.values[self.slots[key]]) for key in cache_order)
+            return (elements, cache_order, 
+                None if self.head == _NIL else self.keys[self.head], 
+                None if self.tail == _NIL else self.keys[self.tail])
+                
+    #Writes the same json snapshot as Cache.writeToDisk. 
+    def writeToDisk(self):
+        temp_file = self.fileName + "_tmp"
+        with self.lock:
+            elements, cache_in_order = self.getCacheValues()[0:2]
+        with open(temp_file, "w") as f:
+            json.dump({'keys': cache_in_order, 'values': [elements[key] for key in cache_in_order]}, f)
+        os.replace(temp_file, self.fileName)
+        return (elements, cache_in_order)
+        
+    def loadFromDisk(self):
+        with open(self.fileName, 'r') as f:
+            data = json.load(f)
+        with self.lock:
+            self._reset()
+            for key, value in zip(reversed(data['keys']), reversed(data['values'])):
+                self.add(key, value)
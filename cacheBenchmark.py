@@ -0,0 +1,634 @@
+"""
+    Benchmarks for cache.py. Run with python cacheBenchmark.py
+    These print timings rather than pass/fail, see cacheTest.py for the tests.
+    python cacheBenchmark.py --json results.json only runs the suite (see suite())
+    and also saves its results as json, to compare runs over time.
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from cache import Cache, CompactCache, EVICTION_POLICIES, SNAPSHOT_FORMATS, cached
+from cacheServer import CacheServer, CacheClient
+from cacheCluster import CacheCluster
+from cacheReplication import ReplicationPrimary, CacheReplica
+from sharedCache import SharedCache
+from tieredCache import TieredCache
+
+#The expiry sweep the cache used to do, walking every entry on each tick.
+#Kept here so the heap based cache.expireDue() has something to be compared against.
+def _fullScanExpiry(cache, now):
+    expired = [entry.key for entry in cache.iterate() if entry.expiryTime <= now]
+    for key in expired:
+        cache.expire(key)
+    return len(expired)
+
+#Times one expiry sweep over caches of different sizes with a different number
+#of entries actually due. The heap should depend on the number due, the full
+#scan on the size of the cache.
+def expiryBenchmark(sizes=(10000, 100000), dueCounts=(0, 100, 1000)):
+    print("%10s %8s %10s %8s %10s" % ("entries", "due", "method", "removed", "ms"))
+    sweeps = [
+        ("heap", lambda cache, now: cache.expireDue(now)),
+        ("full scan", _fullScanExpiry),
+    ]
+    for size in sizes:
+        for due in dueCounts:
+            for name, sweep in sweeps:
+                c = Cache(cacheSize=size, expiryTime=3600, sweep=False)
+                for i in range(0, size):
+                    c.add(i, i)
+
+                #Keys were added in order so the due'th key's deadline
+                #is the cut off for the oldest due entries.
+                if due:
+                    now = c.entries[due - 1].expiryTime
+                else:
+                    now = datetime.datetime.min
+
+                start = time.perf_counter()
+                removed = sweep(c, now)
+                elapsed = (time.perf_counter() - start) * 1000
+                print("%10s %8s %10s %8s %10.3f" % (size, due, name, removed, elapsed))
+
+#Times writeToDisk and a warm restart (a new cache calling loadFromDisk) 
+#for the json and binary snapshot formats. The peak memory of the load 
+#is measured in a second load since tracemalloc slows everything down.
+def restartBenchmark(sizes=(10000, 100000, 1000000)):
+    directory = tempfile.mkdtemp()
+    print("%10s %8s %10s %10s %10s %12s" % ("entries", "format", "write ms", "load ms", "file KB", "load peak MB"))
+    for size in sizes:
+        for snapshotFormat in sorted(SNAPSHOT_FORMATS):
+            result = _restartTimes(size, snapshotFormat, directory)
+            print("%10s %8s %10.1f %10.1f %10.1f %12.1f" % (size, snapshotFormat, result["writeMs"], 
+                result["loadMs"], result["fileBytes"] / 1024.0, result["loadPeakBytes"] / (1024.0 * 1024.0)))
+                
+def _restartTimes(size, snapshotFormat, directory):
+    fileName = os.path.join(directory, "restart.%s" % snapshotFormat)
+    c = Cache(cacheSize=size, fileName=fileName, snapshotFormat=snapshotFormat)
+    for i in range(0, size):
+        c.add("key %s" % i, "value %s" % i)
+        
+    start = time.perf_counter()
+    c.writeToDisk()
+    writeTime = (time.perf_counter() - start) * 1000
+    c = None
+    
+    start = time.perf_counter()
+    c = Cache(cacheSize=size, fileName=fileName)
+    c.loadFromDisk()
+    loadTime = (time.perf_counter() - start) * 1000
+    
+    c = None
+    
+    tracemalloc.start()
+    c = Cache(cacheSize=size, fileName=fileName)
+    c.loadFromDisk()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    c = None
+    
+    fileSize = os.path.getsize(fileName)
+    os.remove(fileName)
+    return {"writeMs": writeTime, "loadMs": loadTime, "fileBytes": fileSize, "loadPeakBytes": peak}
+
+#Write and load times of each binary snapshot format for a cache of large bytes values,
+#where pickle protocol 5 writes the values without copying them into the pickle. 
+def bytesSnapshotBenchmark(count=2000, valueSize=256 * 1024):
+    directory = tempfile.mkdtemp()
+    values = [os.urandom(valueSize) for i in range(0, count)]
+    print("%10s %10s %10s %10s" % ("format", "write ms", "load ms", "file MB"))
+    for snapshotFormat in ("binary", "pickle5", "struct"):
+        fileName = os.path.join(directory, "bytes.%s" % snapshotFormat)
+        c = Cache(cacheSize=count, fileName=fileName, snapshotFormat=snapshotFormat)
+        for i, value in enumerate(values):
+            c.add(i, value)
+        start = time.perf_counter()
+        c.writeToDisk()
+        writeTime = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        Cache(cacheSize=count, fileName=fileName).loadFromDisk()
+        loadTime = (time.perf_counter() - start) * 1000
+        print("%10s %10.1f %10.1f %10.1f" % (snapshotFormat, writeTime, loadTime, os.path.getsize(fileName) / (1024.0 * 1024.0)))
+        os.remove(fileName)
+        
+#Bytes allocated per entry once a cache is full, with and without expiry times. 
+#The keys and values themselves are created before measuring so only the 
+#cache's own bookkeeping is counted. 
+def memoryBenchmark(size=100000):
+    keys = ["key %s" % i for i in range(0, size)]
+    print("%14s %10s %16s" % ("cache", "expiry", "bytes per entry"))
+    for name, cacheClass in (("Cache", Cache), ("CompactCache", CompactCache)):
+        for expiryTime in (None, 3600):
+            print("%14s %10s %16.1f" % (name, expiryTime, _bytesPerEntry(cacheClass, keys, expiryTime)))
+            
+def _bytesPerEntry(cacheClass, keys, expiryTime=None):
+    tracemalloc.start()
+    c = cacheClass(cacheSize=len(keys), expiryTime=expiryTime, sweep=False)
+    for key in keys:
+        c.add(key, key)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    c = None
+    return used / float(len(keys))
+
+#A stream of keys from 0 to keyCount - 1 where key i is requested 
+#in proportion to 1 / (i + 1) ** skew. 
+def zipfTrace(length, keyCount, skew=0.9, seed=1):
+    weights = itertools.accumulate(1.0 / (i + 1) ** skew for i in range(0, keyCount))
+    return random.Random(seed).choices(range(0, keyCount), cum_weights=list(weights), k=length)
+    
+#A zipf stream interrupted every scanEvery requests by a scan of scanLength
+#keys that are each requested once and never again, like a nightly batch job. 
+def scanTrace(length, keyCount, scanEvery, scanLength, skew=0.9, seed=1):
+    trace = zipfTrace(length, keyCount, skew, seed)
+    mixed = []
+    scanKey = keyCount
+    for start in range(0, length, scanEvery):
+        mixed += trace[start:start + scanEvery]
+        mixed += range(scanKey, scanKey + scanLength)
+        scanKey += scanLength
+    return mixed
+    
+#Replays a trace through a cache the way the Cache docstring suggests using it 
+#(get, and add on a miss). Returns the hit ratio and operations per second.
+def replay(cache, trace):
+    hits = 0
+    start = time.perf_counter()
+    for key in trace:
+        if cache.get(key) is None:
+            cache.add(key, key)
+        else:
+            hits += 1
+    elapsed = time.perf_counter() - start
+    return hits / float(len(trace)), len(trace) / elapsed
+    
+#Compares the eviction policies' hit ratio and speed on a zipf trace
+#and on the same kind of trace mixed with scans. 
+def policyBenchmark(cacheSize=1000, length=200000, keyCount=100000):
+    traces = [
+        ("zipf", zipfTrace(length, keyCount)),
+        ("zipf + scans", scanTrace(length, keyCount, scanEvery=10000, scanLength=cacheSize * 2)),
+    ]
+    print("%14s %10s %10s %12s" % ("trace", "policy", "hit ratio", "ops/sec"))
+    for traceName, trace in traces:
+        for policy in sorted(EVICTION_POLICIES):
+            hitRatio, opsPerSecond = replay(Cache(cacheSize=cacheSize, policy=policy), trace)
+            print("%14s %10s %10.3f %12.0f" % (traceName, policy, hitRatio, opsPerSecond))
+
+#Replays a trace in a worker process, through its own Cache if cache is None. 
+def _replayWorker(cache, cacheSize, trace, results):
+    if cache is None:
+        cache = Cache(cacheSize=cacheSize)
+    results.put(replay(cache, trace)[0])
+    
+#Hit ratio and total throughput of worker processes that each replay their own
+#zipf trace over the same keys, either each with its own Cache or all sharing one
+#SharedCache. Both use the same memory in total, the private caches split cacheSize
+#between them. Workers are forked so the traces aren't copied. 
+def sharedBenchmark(processCounts=(1, 4, 8), cacheSize=1000, length=100000, keyCount=100000):
+    context = multiprocessing.get_context("fork")
+    traces = [zipfTrace(length, keyCount, seed=seed) for seed in range(0, max(processCounts))]
+    print("%10s %12s %10s %12s" % ("processes", "cache", "hit ratio", "ops/sec"))
+    for processCount in processCounts:
+        for name in ("Cache", "SharedCache"):
+            shared = None
+            if name == "SharedCache":
+                shared = SharedCache(cacheSize=cacheSize, slotBytes=64, lock=context.Lock())
+            results = context.Queue()
+            workers = [context.Process(target=_replayWorker, args=(shared, cacheSize // processCount, traces[i], results))
+                for i in range(0, processCount)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            hitRatios = [results.get() for worker in workers]
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            if shared is not None:
+                shared.close()
+                shared.unlink()
+            print("%10s %12s %10.3f %12.0f" % (processCount, name, 
+                sum(hitRatios) / processCount, processCount * length / elapsed))
+
+#The caches compared by suite(), each as a function of the size returning get(key) and add(key, value). 
+def _cacheOperations(size):
+    c = Cache(cacheSize=size)
+    return c.get, c.add
+    
+#The same with the lock, so the cost of threadSafe shows up next to the unlocked calls. 
+def _lockedCacheOperations(size):
+    c = Cache(cacheSize=size, threadSafe=True)
+    return c.get, c.add
+    
+def _compactCacheOperations(size):
+    c = CompactCache(cacheSize=size)
+    return c.get, c.add
+    
+#The usual LRU built on an OrderedDict, the baseline for the caches here. 
+def _orderedDictOperations(size):
+    entries = collections.OrderedDict()
+    def get(key):
+        if key in entries:
+            entries.move_to_end(key)
+            return entries[key]
+        return None
+    def add(key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        if len(entries) > size:
+            entries.popitem(last=False)
+    return get, add
+    
+#functools.lru_cache has no add, calling the wrapped function on a new key is the add
+#and on a cached key the get. 
+def _lruCacheOperations(size):
+    cached = functools.lru_cache(maxsize=size)(lambda key: key)
+    return cached, lambda key, value: cached(key)
+    
+SUITE_CACHES = [
+    ("Cache", _cacheOperations),
+    ("Cache threadSafe", _lockedCacheOperations),
+    ("CompactCache", _compactCacheOperations),
+    ("OrderedDict", _orderedDictOperations),
+    ("lru_cache", _lruCacheOperations),
+]
+
+def _percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(fraction * len(sortedValues)))]
+    
+#Fills a cache of the given size, then times adding as many new keys (each one 
+#evicting the least recently used) and getting all of those keys back in a random order. 
+#Throughput is measured in one pass and the per call latencies in a second one, 
+#as timing each call slows the calls down. 
+def _operationTimes(operationsFactory, size, seed=1):
+    newKeys = list(range(size, 2 * size))
+    lookups = list(newKeys)
+    random.Random(seed).shuffle(lookups)
+    
+    results = {}
+    for measureLatency in (False, True):
+        get, add = operationsFactory(size)
+        for key in range(0, size):
+            add(key, key)
+        for name, calls in (("add", [(add, (key, key)) for key in newKeys]), ("get", [(get, (key,)) for key in lookups])):
+            if not measureLatency:
+                start = time.perf_counter()
+                for operation, arguments in calls:
+                    operation(*arguments)
+                results[name] = {"opsPerSecond": len(calls) / (time.perf_counter() - start)}
+            else:
+                clock = time.perf_counter_ns
+                latencies = []
+                for operation, arguments in calls:
+                    start = clock()
+                    operation(*arguments)
+                    latencies.append(clock() - start)
+                latencies.sort()
+                results[name]["p50Microseconds"] = _percentile(latencies, 0.5) / 1000.0
+                results[name]["p99Microseconds"] = _percentile(latencies, 0.99) / 1000.0
+    return results
+    
+#Throughput of a get and add mix on a cache with expiry times, with the expiry thread 
+#ticking every tickResolution seconds and without it, the best of a few runs. 
+def _expiryOverhead(size, tickResolution=0.01, length=200000, repeats=3):
+    trace = zipfTrace(length, size * 10)
+    results = {}
+    for name, sweep in (("noSweep", False), ("sweep", True)):
+        best = 0
+        for repeat in range(0, repeats):
+            c = Cache(cacheSize=size, expiryTime=3600, tickResolution=tickResolution, sweep=sweep, metrics=True)
+            best = max(best, replay(c, trace)[1])
+            c.close()
+        results[name] = {"opsPerSecond": best}
+        stats = c.stats()
+        if stats["sweeps"]:
+            results[name]["sweeps"] = stats["sweeps"]
+            results[name]["meanSweepMicroseconds"] = stats["sweepSeconds"] / stats["sweeps"] * 1000000
+    results["overheadPercent"] = (1 - results["sweep"]["opsPerSecond"] / results["noSweep"]["opsPerSecond"]) * 100
+    return results
+    
+#Hit ratio and speed of a memory only Cache against TieredCaches with the same 
+#memory tier and disk tiers of different sizes, on a zipf trace. Disk hits are 
+#timed separately since they are what the disk tier adds. 
+def tieredBenchmark(cacheSize=1000, diskSizes=(10000, 50000), length=200000, keyCount=100000):
+    directory = tempfile.mkdtemp()
+    trace = zipfTrace(length, keyCount)
+    print("%10s %10s %12s %10s %12s" % ("memory", "disk", "hit ratio", "ops/sec", "disk hit us"))
+    hitRatio, opsPerSecond = replay(Cache(cacheSize=cacheSize), trace)
+    print("%10s %10s %12.3f %10.0f %12s" % (cacheSize, 0, hitRatio, opsPerSecond, "-"))
+    for diskSize in diskSizes:
+        fileName = os.path.join(directory, "benchmark.tier")
+        c = TieredCache(cacheSize=cacheSize, diskSize=diskSize, fileName=fileName, slotBytes=64)
+        hitRatio, opsPerSecond = replay(c, trace)
+        
+        #Keys that were just pushed out of memory are on disk. 
+        onDisk = c.disk.getCacheValues()[1][:cacheSize]
+        start = time.perf_counter()
+        for key in onDisk:
+            c.get(key)
+        diskHit = (time.perf_counter() - start) / max(1, len(onDisk)) * 1000000
+        c.close()
+        c.disk.unlink()
+        print("%10s %10s %12.3f %10.0f %12.1f" % (cacheSize, diskSize, hitRatio, opsPerSecond, diskHit))
+
+#Time per call of a function memoized with cache.cached and with functools.lru_cache, 
+#for hits and misses, with a single int argument (the fast key path) and with several. 
+def memoizeBenchmark(calls=200000, size=1000):
+    print("%12s %14s %10s %10s" % ("memoizer", "arguments", "hit ns", "miss ns"))
+    memoizers = [
+        ("lru_cache", lambda function: functools.lru_cache(maxsize=size)(function)),
+        ("cached", lambda function: cached(cacheSize=size)(function)),
+        ("cached unsafe", lambda function: cached(cacheSize=size, threadSafe=False)(function)),
+    ]
+    for name, memoize in memoizers:
+        for arguments, call in (("one int", lambda f, i: f(i)), ("int, str, kw", lambda f, i: f(i, "text", flag=True))):
+            function = memoize(lambda *args, **kwargs: args)
+            hitKeys = [i % size for i in range(0, calls)]
+            for i in range(0, size):
+                call(function, i)
+            start = time.perf_counter()
+            for i in hitKeys:
+                call(function, i)
+            hit = (time.perf_counter() - start) / calls * 1e9
+            start = time.perf_counter()
+            for i in range(size, size + calls):
+                call(function, i)
+            miss = (time.perf_counter() - start) / calls * 1e9
+            print("%12s %14s %10.0f %10.0f" % (name, arguments, hit, miss))
+
+def _serverProcess(cacheSize, ports):
+    async def serve():
+        server = await CacheServer(port=0, cacheSize=cacheSize).start()
+        ports.put(server.port)
+        await server.serveForever()
+    asyncio.run(serve())
+
+#Starts a CacheServer in another process for each port number wanted and returns the 
+#processes and the ports they listen on. 
+def _startServers(count, cacheSize):
+    context = multiprocessing.get_context("fork")
+    ports = context.Queue()
+    servers = [context.Process(target=_serverProcess, args=(cacheSize, ports), daemon=True) for i in range(0, count)]
+    for server in servers:
+        server.start()
+    return servers, [ports.get() for server in servers]
+
+def _stopServers(servers):
+    for server in servers:
+        server.terminate()
+        server.join()
+
+#concurrency coroutines sharing one connected client (a CacheClient or CacheCluster) 
+#each send requests one after another, 90% gets and 10% sets over zipf keys. 
+#Returns the requests per second and every request's latency in nanoseconds. 
+async def _loadTest(client, concurrency, requests, keyCount, seed=1):
+    trace = zipfTrace(requests, keyCount, seed=seed)
+    isSet = [random.Random(seed).random() < 0.1 for i in range(0, requests)]
+    latencies = []
+    async def worker(offset):
+        clock = time.perf_counter_ns
+        for i in range(offset, requests, concurrency):
+            start = clock()
+            if isSet[i]:
+                await client.set(trace[i], i)
+            else:
+                await client.get(trace[i])
+            latencies.append(clock() - start)
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(offset) for offset in range(0, concurrency)])
+    return requests / (time.perf_counter() - start), latencies
+
+#Requests per second and latency percentiles of a CacheServer running in another 
+#process, loaded by a client in this one at different concurrencies. 
+def serverBenchmark(concurrencies=(1, 16, 64), requests=50000, cacheSize=10000, keyCount=100000, poolSize=4):
+    servers, ports = _startServers(1, cacheSize)
+    print("%12s %12s %10s %10s %10s" % ("concurrency", "requests/s", "p50 us", "p99 us", "p999 us"))
+    async def load(concurrency):
+        async with CacheClient(port=ports[0], poolSize=poolSize) as client:
+            return await _loadTest(client, concurrency, requests, keyCount, seed=concurrency)
+    try:
+        for concurrency in concurrencies:
+            requestsPerSecond, latencies = asyncio.run(load(concurrency))
+            latencies.sort()
+            print("%12s %12.0f %10.1f %10.1f %10.1f" % (concurrency, requestsPerSecond, 
+                _percentile(latencies, 0.5) / 1000.0, _percentile(latencies, 0.99) / 1000.0, 
+                _percentile(latencies, 0.999) / 1000.0))
+    finally:
+        _stopServers(servers)
+
+def _clusterClient(ports):
+    return CacheCluster({port: CacheClient(port=port, poolSize=2) for port in ports})
+
+def _clusterLoadWorker(ports, concurrency, requests, keyCount, seed, results):
+    async def load():
+        async with _clusterClient(ports) as cluster:
+            return (await _loadTest(cluster, concurrency, requests, keyCount, seed))[0]
+    results.put(asyncio.run(load()))
+
+#Aggregate requests per second of clusters of 1 to max(nodeCounts) CacheServers, each 
+#in its own process, loaded by clientProcesses processes with a CacheCluster each. 
+#Then the cost of growing each cluster by one node: the share of keys that move 
+#(and so miss until they are set again) and the time to set them again. 
+def clusterBenchmark(nodeCounts=(1, 2, 4), clientProcesses=4, concurrency=32, requests=20000,
+    keyCount=20000, cacheSize=100000):
+    servers, ports = _startServers(max(nodeCounts) + 1, cacheSize)
+    context = multiprocessing.get_context("fork")
+    print("%6s %12s %12s %14s" % ("nodes", "requests/s", "keys moved", "refill ms"))
+    async def rebalance(nodePorts, newPort):
+        #Keys no earlier round has set, so the new node doesn't have any of them yet. 
+        keys = [("rebalance", len(nodePorts), i) for i in range(0, keyCount)]
+        async with _clusterClient(nodePorts) as cluster:
+            await asyncio.gather(*[cluster.set(key, key) for key in keys])
+            newNode = await CacheClient(port=newPort, poolSize=2).connect()
+            cluster.addNode(newPort, newNode)
+            found = await cluster.mget(keys)
+            missing = [key for key in keys if key not in found]
+            start = time.perf_counter()
+            await asyncio.gather(*[cluster.set(key, key) for key in missing])
+            refill = time.perf_counter() - start
+            await cluster.removeNode(newPort).close()
+            return len(missing) / len(keys), refill
+    try:
+        for nodeCount in nodeCounts:
+            results = context.Queue()
+            clients = [context.Process(target=_clusterLoadWorker, 
+                args=(ports[:nodeCount], concurrency, requests, keyCount, seed, results)) for seed in range(0, clientProcesses)]
+            for client in clients:
+                client.start()
+            requestsPerSecond = sum(results.get() for client in clients)
+            for client in clients:
+                client.join()
+            moved, refill = asyncio.run(rebalance(ports[:nodeCount], ports[-1]))
+            print("%6s %12.0f %12.3f %14.1f" % (nodeCount, requestsPerSecond, moved, refill * 1000))
+    finally:
+        _stopServers(servers)
+
+def _replicaProcess(port, cacheSize, fileName, ready, targets, results):
+    lags = []
+    replica = CacheReplica(port=port, cacheSize=cacheSize, fileName=fileName, retryInterval=0.1,
+        applyHook=lambda sequence, lag: lags.append(lag)).start()
+    while not replica.snapshots:
+        time.sleep(0.01)
+    ready.put(True)
+    caughtUp = replica.waitFor(targets.get(), 30)
+    replica.stop()
+    lags.sort()
+    results.put((caughtUp, replica.snapshots, [_percentile(lags, fraction) if lags else 0 for fraction in (0.5, 0.99, 1)]))
+
+#Replication lag of replicas in other processes while the primary is written to 
+#for some seconds at each rate (None for as fast as it goes). The lag of a batch 
+#of changes is the time between the newest of them being made on the primary 
+#and the batch being applied on the replica. 
+def replicationBenchmark(replicaCounts=(1, 2), rates=(10000, 50000, None), seconds=2.0, cacheSize=100000, keyCount=200000):
+    context = multiprocessing.get_context("fork")
+    directory = tempfile.mkdtemp()
+    trace = zipfTrace(1000000, keyCount)
+    print("%9s %10s %10s %10s %10s %10s" % ("replicas", "rate", "writes/s", "p50 ms", "p99 ms", "max ms"))
+    for replicaCount in replicaCounts:
+        for rate in rates:
+            primary = ReplicationPrimary(port=0, cacheSize=cacheSize).start()
+            ready, targets, results = context.Queue(), context.Queue(), context.Queue()
+            replicas = [context.Process(target=_replicaProcess, args=(primary.port, cacheSize, 
+                os.path.join(directory, "replica%d.bin" % i), ready, targets, results)) for i in range(0, replicaCount)]
+            for replica in replicas:
+                replica.start()
+            for replica in replicas:
+                ready.get()
+                
+            add = primary.cache.add
+            written = 0
+            start = time.perf_counter()
+            while True:
+                elapsed = time.perf_counter() - start
+                if elapsed >= seconds:
+                    break
+                #Writes in blocks of 100, waiting whenever we're ahead of the rate. 
+                if rate is not None and written > elapsed * rate:
+                    time.sleep(0.001)
+                    continue
+                for i in range(written, written + 100):
+                    add(trace[i % len(trace)], i)
+                written += 100
+                
+            for replica in replicas:
+                targets.put(primary.sequence)
+            for replica in replicas:
+                caughtUp, snapshots, (p50, p99, worst) = results.get()
+                print("%9s %10s %10.0f %10.2f %10.2f %10.2f%s" % (replicaCount, rate or "max", written / elapsed,
+                    p50 * 1000, p99 * 1000, worst * 1000, "" if caughtUp and snapshots == 1 else " (fell behind)"))
+            for replica in replicas:
+                replica.join()
+            primary.stop()
+            primary.cache.close()
+
+#Latency of getOrLoad reading a few hot keys for some seconds, with entries that 
+#expire every expiryTime seconds and a loader standing in for a remote call, with 
+#and without refreshes. Without them every expiry makes one reader wait for the load. 
+def refreshBenchmark(seconds=3.0, expiryTime=0.2, loadTime=0.005, keyCount=20):
+    loads = []
+    def loader(key):
+        loads.append(key)
+        time.sleep(loadTime)
+        return key
+    modes = [
+        ("expire", {}),
+        ("refreshAhead", {"refreshAhead": expiryTime / 4}),
+        ("stale", {"staleWhileRevalidate": expiryTime}),
+    ]
+    trace = zipfTrace(1000000, keyCount)
+    print("%14s %10s %10s %10s %10s %8s" % ("mode", "gets", "p50 us", "p99 us", "p999 us", "loads"))
+    for name, arguments in modes:
+        c = Cache(cacheSize=keyCount, expiryTime=expiryTime, threadSafe=True, loader=loader, **arguments)
+        del loads[:]
+        latencies = []
+        clock = time.perf_counter_ns
+        end = time.perf_counter() + seconds
+        i = 0
+        while time.perf_counter() < end:
+            start = clock()
+            c.getOrLoad(trace[i % len(trace)])
+            latencies.append(clock() - start)
+            i += 1
+            #Leaves the pool's threads some time, as a real caller would between reads. 
+            time.sleep(0)
+        c.close()
+        latencies.sort()
+        print("%14s %10d %10.1f %10.1f %10.1f %8d" % (name, len(latencies), _percentile(latencies, 0.5) / 1000.0,
+            _percentile(latencies, 0.99) / 1000.0, _percentile(latencies, 0.999) / 1000.0, len(loads)))
+
+#Runs every measurement at each size and returns the results as one dictionary, 
+#saved as json to jsonFile if one is given. Printed as it goes. 
+def suite(sizes=(1000, 10000, 100000), jsonFile=None):
+    results = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "time": datetime.datetime.utcnow().isoformat(),
+        "sizes": {},
+    }
+    directory = tempfile.mkdtemp()
+    print("%10s %16s %10s %12s %10s %10s" % ("entries", "cache", "operation", "ops/sec", "p50 us", "p99 us"))
+    for size in sizes:
+        sizeResults = {"operations": {}, "persistence": {}, "memoryBytesPerEntry": {}}
+        for name, operationsFactory in SUITE_CACHES:
+            times = _operationTimes(operationsFactory, size)
+            sizeResults["operations"][name] = times
+            for operation in ("add", "get"):
+                print("%10s %16s %10s %12.0f %10.2f %10.2f" % (size, name, operation, times[operation]["opsPerSecond"],
+                    times[operation]["p50Microseconds"], times[operation]["p99Microseconds"]))
+                    
+        sizeResults["expiry"] = _expiryOverhead(size)
+        print("%10s expiry thread overhead %.1f%%" % (size, sizeResults["expiry"]["overheadPercent"]))
+        
+        for snapshotFormat in sorted(SNAPSHOT_FORMATS):
+            restart = _restartTimes(size, snapshotFormat, directory)
+            sizeResults["persistence"][snapshotFormat] = restart
+            print("%10s %8s snapshot: write %.1f ms, load %.1f ms, %d bytes" % (size, snapshotFormat,
+                restart["writeMs"], restart["loadMs"], restart["fileBytes"]))
+                
+        keys = ["key %s" % i for i in range(0, size)]
+        for name, cacheClass in (("Cache", Cache), ("CompactCache", CompactCache)):
+            sizeResults["memoryBytesPerEntry"][name] = _bytesPerEntry(cacheClass, keys)
+        print("%10s bytes per entry: %s" % (size, ", ".join("%s %.1f" % item 
+            for item in sorted(sizeResults["memoryBytesPerEntry"].items()))))
+            
+        results["sizes"][str(size)] = sizeResults
+        
+    if jsonFile is not None:
+        with open(jsonFile, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cache benchmarks")
+    parser.add_argument("--json", metavar="FILE", help="only run the suite and save its results to FILE")
+    arguments = parser.parse_args()
+    if arguments.json:
+        suite(jsonFile=arguments.json)
+        sys.exit()
+        
+    suite()
+    expiryBenchmark()
+    restartBenchmark()
+    bytesSnapshotBenchmark()
+    memoryBenchmark()
+    policyBenchmark()
+    sharedBenchmark()
+    tieredBenchmark()
+    memoizeBenchmark()
+    serverBenchmark()
+    clusterBenchmark()
+    replicationBenchmark()
+    refreshBenchmark()
@@ -0,0 +1,152 @@
+#Spreads keys over several cache nodes with consistent hashing, so the cluster holds
+#as much as all of its nodes together and adding or removing a node only moves
+#about 1/N of the keys. A node is a CacheClient talking to a CacheServer, or a
+#Cache in this process wrapped in LocalNode.
+#    cluster = CacheCluster({"a": CacheClient(port=7070), "b": CacheClient(port=7071)})
+#    await cluster.connect()
+#    await cluster.set("key", value)
+#    values = await cluster.mget(keys)
+
+import asyncio
+import bisect
+import hashlib
+import pickle
+
+from cache import Cache, _PICKLE_PROTOCOL
+
+#A 64 bit hash of some bytes that is the same in every process, unlike hash().
+def _hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+#Places each node at virtualNodes points of a ring of 64 bit hashes. A key belongs to
+#the first node point at or after its own hash, so a node that joins only takes the
+#keys just before its points and one that leaves only gives its own keys away.
+class HashRing():
+
+    def __init__(self, nodeNames=(), virtualNodes=160):
+        self.virtualNodes = virtualNodes
+        self.points = []
+        self.owners = []
+        self.nodeNames = set()
+        for name in nodeNames:
+            self.addNode(name)
+
+    def addNode(self, name, virtualNodes=None):
+        if name in self.nodeNames:
+            raise KeyError("%s is already in the ring" % (name,))
+        self.nodeNames.add(name)
+        label = str(name).encode("utf-8")
+        for i in range(0, virtualNodes or self.virtualNodes):
+            point = _hash(b"%s#%d" % (label, i))
+            index = bisect.bisect_left(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, name)
+
+    def removeNode(self, name):
+        self.nodeNames.remove(name)
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != name]
+        self.points = [point for point, owner in kept]
+        self.owners = [owner for point, owner in kept]
+
+    #The node for a key already turned into bytes.
+    def nodeFor(self, keyBytes):
+        if not self.points:
+            raise KeyError("The ring has no nodes")
+        index = bisect.bisect_left(self.points, _hash(keyBytes))
+        return self.owners[index if index < len(self.points) else 0]
+
+#Gives an in process Cache the interface of CacheClient so it can be a cluster node.
+class LocalNode():
+
+    def __init__(self, cache=None, **cacheArguments):
+        self.cache = cache if cache is not None else Cache(**cacheArguments)
+
+    async def connect(self):
+        return self
+
+    async def close(self):
+        pass
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def set(self, key, value, ttl=None):
+        if ttl is None:
+            self.cache.add(key, value)
+        else:
+            self.cache.add(key, value, ttl=ttl)
+
+    async def delete(self, key):
+        try:
+            self.cache.expire(key)
+        except KeyError:
+            return False
+        return True
+
+    async def mget(self, keys):
+        return self.cache.getMany(keys)
+
+class CacheCluster():
+
+    def __init__(self, nodes=None, virtualNodes=160, dumps=lambda key: pickle.dumps(key, _PICKLE_PROTOCOL)):
+        """
+            nodes maps a name to each node. Keys are placed by the hash of dumps(key),
+            which has to give equal keys equal bytes in every process using the
+            cluster. Nothing is moved when nodes are added or removed: the keys
+            that now belong to another node are misses there until they are set again.
+        """
+        self.nodes = {}
+        self.ring = HashRing(virtualNodes=virtualNodes)
+        self.dumps = dumps
+        for name, node in (nodes or {}).items():
+            self.nodes[name] = node
+            self.ring.addNode(name)
+
+    async def connect(self):
+        await asyncio.gather(*[node.connect() for node in self.nodes.values()])
+        return self
+
+    async def close(self):
+        await asyncio.gather(*[node.close() for node in self.nodes.values()])
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    #Adds a node that is already connected.
+    def addNode(self, name, node):
+        self.ring.addNode(name)
+        self.nodes[name] = node
+
+    #Removes a node from the ring and returns it, it is left to the caller to close.
+    def removeNode(self, name):
+        self.ring.removeNode(name)
+        return self.nodes.pop(name)
+
+    def nodeName(self, key):
+        return self.ring.nodeFor(self.dumps(key))
+
+    def node(self, key):
+        return self.nodes[self.nodeName(key)]
+
+    async def get(self, key):
+        return await self.node(key).get(key)
+
+    async def set(self, key, value, ttl=None):
+        await self.node(key).set(key, value, ttl=ttl)
+
+    async def delete(self, key):
+        return await self.node(key).delete(key)
+
+    #Returns a dictionary of the keys that were found and their values. The keys
+    #are grouped by node and every node is asked for its group at the same time.
+    async def mget(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.nodeName(key), []).append(key)
+        found = {}
+        for values in await asyncio.gather(*[self.nodes[name].mget(group) for name, group in groups.items()]):
+            found.update(values)
+        return found
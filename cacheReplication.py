@@ -0,0 +1,266 @@
+#Keeps read only copies of a Cache (replicas) in other processes or on other machines.
+#The primary sends every change to its cache (adds, promotions, expires and expireAll,
+#the records of the journal, see cache._Journal) to each replica as it happens and
+#the replicas apply them in order, a little behind the primary.
+#    primary = ReplicationPrimary(port=7071, cacheSize=100000).start()
+#    primary.cache.add("key", value)
+#and in another process
+#    replica = CacheReplica(port=7071, cacheSize=100000, fileName="replica.json").start()
+#    value = replica.get("key")
+#
+#A replica that connects first gets a snapshot of the primary's cache, written by the
+#same serializers as writeToDisk and loaded with loadFromDisk, and then every change
+#made since that snapshot was taken. One that falls more than backlog changes behind
+#is disconnected and starts again from a new snapshot.
+#Entries removed to make space are sent as expires like in the journal, so the replicas
+#remove the same ones whatever their policy, as long as nothing but the primary adds to
+#them. A replica only evicts by itself if it is smaller than the primary, and reads on a
+#replica reorder it, so a smaller one can come to hold a different set of entries.
+
+import io
+import pickle
+import socket
+import struct
+import threading
+import time
+
+from cache import Cache, SNAPSHOT_FORMATS, _NoLock, _PICKLE_PROTOCOL
+
+#Closes a socket, waking up any thread blocked on it first. 
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+SNAPSHOT, RECORDS = range(1, 3)
+
+#Message type, the primary's change count after the message, the time.time() on the
+#primary when its newest change was made and the length of the body.
+_MESSAGE = struct.Struct("<BQdI")
+
+class ReplicationPrimary():
+
+    def __init__(self, cache=None, host="127.0.0.1", port=7071, backlog=100000, batchSize=1000,
+        snapshotFormat="binary", **cacheArguments):
+        """
+            Sends the changes of the given cache, or of a Cache created with
+            cacheArguments, to the replicas that connect to host:port (port 0
+            picks a free one, see self.port once started). The cache has to be
+            threadSafe since the replicas are served from their own threads.
+            backlog is the number of changes kept for replicas that are behind,
+            batchSize the most sent in one message. snapshotFormat is the
+            SNAPSHOT_FORMATS name new replicas are sent the cache in, "json"
+            only works with string keys.
+        """
+        if cache is None:
+            cacheArguments.setdefault("threadSafe", True)
+            cache = Cache(**cacheArguments)
+        if isinstance(cache.lock, _NoLock):
+            raise ValueError("Replication reads the cache from other threads so it needs threadSafe=True")
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self.backlogSize = backlog
+        self.batchSize = batchSize
+        self.serializer = SNAPSHOT_FORMATS[snapshotFormat]()
+
+        #The changes not yet dropped from the backlog as (time, record),
+        #the first of them being change number firstSequence.
+        self.condition = threading.Condition()
+        self.changes = []
+        self.firstSequence = 0
+        self.sequence = 0
+
+        self.listener = None
+        self.connections = set()
+        self.stopped = False
+        with cache.lock:
+            if cache.changeHook is not None:
+                raise ValueError("The cache already has a changeHook")
+            cache.changeHook = self._record
+            cache.recording = True
+
+    #Called by the cache, under its lock, with every change.
+    def _record(self, record):
+        with self.condition:
+            changes = self.changes
+            changes.append((time.time(), record))
+            self.sequence += 1
+            #Dropping the old half at once keeps this cheap.
+            if len(changes) >= 2 * self.backlogSize:
+                dropped = len(changes) - self.backlogSize
+                del changes[:dropped]
+                self.firstSequence += dropped
+            self.condition.notify_all()
+
+    def start(self):
+        self.listener = socket.create_server((self.host, self.port))
+        self.port = self.listener.getsockname()[1]
+        accepter = threading.Thread(target=self._accept)
+        accepter.daemon = True
+        accepter.start()
+        return self
+
+    #Disconnects the replicas and stops sending the cache's changes.
+    def stop(self):
+        self.stopped = True
+        _shutdown(self.listener)
+        with self.condition:
+            self.condition.notify_all()
+        for connection in list(self.connections):
+            _shutdown(connection)
+        with self.cache.lock:
+            self.cache.changeHook = None
+            self.cache.recording = self.cache.journal is not None
+
+    def _accept(self):
+        while not self.stopped:
+            try:
+                connection = self.listener.accept()[0]
+            except OSError:
+                break
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections.add(connection)
+            sender = threading.Thread(target=self._serve, args=(connection,))
+            sender.daemon = True
+            sender.start()
+
+    def _serve(self, connection):
+        try:
+            position = self._sendSnapshot(connection)
+            while not self.stopped:
+                with self.condition:
+                    while self.sequence == position and not self.stopped:
+                        self.condition.wait(1.0)
+                    if position < self.firstSequence:
+                        #The changes this replica still needs are gone,
+                        #it will come back for a new snapshot.
+                        break
+                    start = position - self.firstSequence
+                    batch = self.changes[start:start + self.batchSize]
+                if not batch:
+                    continue
+                position += len(batch)
+                body = pickle.dumps([record for stamp, record in batch], _PICKLE_PROTOCOL)
+                connection.sendall(_MESSAGE.pack(RECORDS, position, batch[-1][0], len(body)) + body)
+        except OSError:
+            pass
+        finally:
+            self.connections.discard(connection)
+            connection.close()
+
+    #Sends a snapshot of the cache and returns the number of changes it includes.
+    def _sendSnapshot(self, connection):
+        cache = self.cache
+        with cache.lock:
+            keys = [entry.key for entry in cache.iterate()]
+            values = [cache.elements[key] for key in keys]
+            expiries = cache._expiries()
+            #The cache's lock is held by every _record so no change can come in between.
+            with self.condition:
+                position = self.sequence
+        f = io.BytesIO()
+        self.serializer.write(f, keys, values, None, expiries)
+        body = f.getvalue()
+        connection.sendall(_MESSAGE.pack(SNAPSHOT, position, time.time(), len(body)) + body)
+        return position
+
+class CacheReplica():
+
+    def __init__(self, host="127.0.0.1", port=7071, cache=None, retryInterval=1.0, applyHook=None,
+        **cacheArguments):
+        """
+            Follows the ReplicationPrimary at host:port from a background thread,
+            keeping the given cache, or a Cache created with cacheArguments, a
+            copy of the primary's. Snapshots from the primary are written to the
+            cache's fileName before being loaded. A lost connection is tried again
+            every retryInterval seconds.
+            applyHook, if given, is called as applyHook(sequence, lag) after each
+            batch of changes, lag being how many seconds ago the newest of them was
+            made on the primary (by this machine's clock).
+        """
+        if cache is None:
+            cacheArguments.setdefault("threadSafe", True)
+            cache = Cache(**cacheArguments)
+        if cache.journal is not None:
+            raise ValueError("A replica can't have a journal, the primary's changes replace it")
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self.retryInterval = retryInterval
+        self.applyHook = applyHook
+
+        #The number of the primary's changes applied and the lag as of the last batch.
+        self.sequence = 0
+        self.lag = None
+        self.snapshots = 0
+        self.condition = threading.Condition()
+        self.connection = None
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        if self.connection is not None:
+            _shutdown(self.connection)
+        self.thread.join()
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def getMany(self, keys):
+        return self.cache.getMany(keys)
+
+    #Blocks until the replica has applied sequence changes, returns whether it did
+    #within timeout seconds.
+    def waitFor(self, sequence, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.sequence >= sequence, timeout)
+
+    def _run(self):
+        while not self.stopped:
+            try:
+                self.connection = socket.create_connection((self.host, self.port))
+                self._follow(self.connection.makefile("rb"))
+            except (OSError, EOFError):
+                pass
+            finally:
+                if self.connection is not None:
+                    self.connection.close()
+            if not self.stopped:
+                time.sleep(self.retryInterval)
+
+    def _follow(self, f):
+        cache = self.cache
+        while True:
+            header = f.read(_MESSAGE.size)
+            if len(header) < _MESSAGE.size:
+                raise EOFError()
+            messageType, sequence, stamp, length = _MESSAGE.unpack(header)
+            body = f.read(length)
+            if len(body) < length:
+                raise EOFError()
+            if messageType == SNAPSHOT:
+                with open(cache.fileName, "wb") as snapshot:
+                    snapshot.write(body)
+                cache.loadFromDisk()
+                self.snapshots += 1
+            else:
+                with cache.lock:
+                    for record in pickle.loads(body):
+                        cache._applyRecord(record)
+                    cache._evictOverflow()
+                self.lag = time.time() - stamp
+                if self.applyHook is not None:
+                    self.applyHook(sequence, self.lag)
+            with self.condition:
+                self.sequence = sequence
+                self.condition.notify_all()
@@ -0,0 +1,277 @@
+#Runs a Cache as a local service that other processes talk to over TCP.
+#    python cacheServer.py --port 7070 --cacheSize 100000
+#and from asyncio code
+#    client = CacheClient(port=7070)
+#    await client.connect()
+#    await client.set("key", value)
+#    value = await client.get("key")
+#
+#Protocol: every request is a header of (opcode, request id, body length) followed by
+#the body, every response a header of (status, request id, body length) and its body.
+#The server answers the requests on a connection in the order they arrive, and the
+#ids let a client send many requests without waiting for each answer (pipelining).
+#Bodies:
+#   GET     the key                                 -> the value
+#   SET     key length, ttl (0 for none), key, value -> nothing
+#   DEL     the key                                 -> nothing, NOT_FOUND if it wasn't there
+#   MGET    (key length, key) for each key          -> (value length or -1 if missing, value) for each key
+#The server stores keys and values as the bytes it is sent and never decodes them,
+#the client pickles them by default.
+
+import argparse
+import asyncio
+import itertools
+import pickle
+import struct
+
+from cache import Cache, _PICKLE_PROTOCOL
+
+GET, SET, DEL, MGET = range(1, 5)
+OK, NOT_FOUND, ERROR = range(0, 3)
+
+_HEADER = struct.Struct("<BII")
+_SET = struct.Struct("<Id")
+_LENGTH = struct.Struct("<I")
+_VALUE_LENGTH = struct.Struct("<i")
+#The server waits for a client to read its responses once this many bytes are waiting to be sent.
+_HIGH_WATER = 1 << 16
+
+#Raised by CacheClient when the server answers a request with ERROR.
+class CacheServerError(Exception):
+    pass
+
+def _packKeys(keys):
+    parts = []
+    for key in keys:
+        parts.append(_LENGTH.pack(len(key)))
+        parts.append(key)
+    return b"".join(parts)
+
+def _unpackKeys(body):
+    keys = []
+    offset = 0
+    while offset < len(body):
+        length = _LENGTH.unpack_from(body, offset)[0]
+        offset += _LENGTH.size
+        keys.append(body[offset:offset + length])
+        offset += length
+    return keys
+
+class CacheServer():
+
+    def __init__(self, cache=None, host="127.0.0.1", port=7070, **cacheArguments):
+        """
+            Serves the given cache, or a Cache created with cacheArguments
+            (threadSafe since the expiry thread runs beside the event loop).
+            port 0 picks a free port, see self.port once started.
+        """
+        if cache is None:
+            cacheArguments.setdefault("threadSafe", True)
+            cache = Cache(**cacheArguments)
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self.server = None
+        #The task serving each open connection and its writer.
+        self.connections = {}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def serveForever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    #Stops accepting connections and closes the open ones once their current request is answered.
+    async def stop(self):
+        self.server.close()
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while True:
+                opcode, requestId, length = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                body = await reader.readexactly(length) if length else b""
+                try:
+                    status, response = self._handle(opcode, body)
+                except Exception as e:
+                    status, response = ERROR, repr(e).encode("utf-8")
+                writer.write(_HEADER.pack(status, requestId, len(response)))
+                if response:
+                    writer.write(response)
+                #Only waits on the client when it is slow to read, so pipelined
+                #responses go out together.
+                if writer.transport.get_write_buffer_size() > _HIGH_WATER:
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.connections[task]
+            writer.close()
+
+    def _handle(self, opcode, body):
+        cache = self.cache
+        if opcode == GET:
+            value = cache.get(body)
+            return (NOT_FOUND, b"") if value is None else (OK, value)
+        elif opcode == SET:
+            keyLength, ttl = _SET.unpack_from(body)
+            key = body[_SET.size:_SET.size + keyLength]
+            cache.add(key, body[_SET.size + keyLength:], ttl=ttl if ttl > 0 else None)
+            return OK, b""
+        elif opcode == DEL:
+            try:
+                cache.expire(body)
+            except KeyError:
+                return NOT_FOUND, b""
+            return OK, b""
+        elif opcode == MGET:
+            keys = _unpackKeys(body)
+            found = cache.getMany(keys)
+            parts = []
+            for key in keys:
+                value = found.get(key)
+                if value is None:
+                    parts.append(_VALUE_LENGTH.pack(-1))
+                else:
+                    parts.append(_VALUE_LENGTH.pack(len(value)))
+                    parts.append(value)
+            return OK, b"".join(parts)
+        return ERROR, b"unknown opcode %d" % opcode
+
+#One connection of a CacheClient. Requests are written as they are made and a
+#reader task hands each response to the future waiting on its request id.
+class _Connection():
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.ids = itertools.count()
+        self.readerTask = asyncio.ensure_future(self._readResponses())
+
+    async def request(self, opcode, body):
+        if self.readerTask.done():
+            raise ConnectionError("Lost the connection to the cache server")
+        requestId = next(self.ids) & 0xFFFFFFFF
+        future = asyncio.get_event_loop().create_future()
+        self.pending[requestId] = future
+        self.writer.write(_HEADER.pack(opcode, requestId, len(body)))
+        if body:
+            self.writer.write(body)
+        if self.writer.transport.get_write_buffer_size() > _HIGH_WATER:
+            await self.writer.drain()
+        return await future
+
+    #A response to a request we don't know is skipped. However this ends, even 
+    #cancelled by close, the requests still waiting are failed instead of left hanging. 
+    async def _readResponses(self):
+        try:
+            while True:
+                status, requestId, length = _HEADER.unpack(await self.reader.readexactly(_HEADER.size))
+                body = await self.reader.readexactly(length) if length else b""
+                future = self.pending.pop(requestId, None)
+                if future is not None and not future.done():
+                    future.set_result((status, body))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            error = ConnectionError("Lost the connection to the cache server")
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.readerTask.cancel()
+
+#Talks to a CacheServer over poolSize connections, taking them in turn. Every
+#connection pipelines, so many coroutines can share one client.
+#Keys and values are turned into bytes with dumps and back with loads, pickle by
+#default. Both ends have to agree, and equal keys have to dump to equal bytes.
+class CacheClient():
+
+    def __init__(self, host="127.0.0.1", port=7070, poolSize=4,
+        dumps=lambda item: pickle.dumps(item, _PICKLE_PROTOCOL), loads=pickle.loads):
+        self.host = host
+        self.port = port
+        self.poolSize = poolSize
+        self.dumps = dumps
+        self.loads = loads
+        self.connections = []
+        self.turn = itertools.count()
+
+    async def connect(self):
+        for i in range(0, self.poolSize):
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            self.connections.append(_Connection(reader, writer))
+        return self
+
+    async def close(self):
+        for connection in self.connections:
+            await connection.close()
+        self.connections = []
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _request(self, opcode, body):
+        connection = self.connections[next(self.turn) % len(self.connections)]
+        status, response = await connection.request(opcode, body)
+        if status == ERROR:
+            raise CacheServerError(response.decode("utf-8"))
+        return status, response
+
+    async def get(self, key):
+        status, value = await self._request(GET, self.dumps(key))
+        return None if status == NOT_FOUND else self.loads(value)
+
+    async def set(self, key, value, ttl=None):
+        key = self.dumps(key)
+        await self._request(SET, _SET.pack(len(key), ttl or 0) + key + self.dumps(value))
+
+    #Returns whether the key was there.
+    async def delete(self, key):
+        status = (await self._request(DEL, self.dumps(key)))[0]
+        return status == OK
+
+    #Returns a dictionary of the keys that were found and their values.
+    async def mget(self, keys):
+        keys = list(keys)
+        body = (await self._request(MGET, _packKeys([self.dumps(key) for key in keys])))[1]
+        found = {}
+        offset = 0
+        for key in keys:
+            length = _VALUE_LENGTH.unpack_from(body, offset)[0]
+            offset += _VALUE_LENGTH.size
+            if length >= 0:
+                found[key] = self.loads(body[offset:offset + length])
+                offset += length
+        return found
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves a Cache over TCP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7070)
+    parser.add_argument("--cacheSize", type=int, default=10000)
+    parser.add_argument("--expiryTime", type=float, default=None)
+    arguments = parser.parse_args()
+    server = CacheServer(host=arguments.host, port=arguments.port,
+        cacheSize=arguments.cacheSize, expiryTime=arguments.expiryTime)
+    try:
+        asyncio.run(server.serveForever())
+    except KeyboardInterrupt:
+        pass
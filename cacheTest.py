@@ -1,4 +1,6 @@
-from cache import Cache
+from cache import Cache, ShardedCache, CompactCache, AsyncCache, cached, _NoLock
+from sharedCache import SharedCache
+from tieredCache import TieredCache
 
 def basicVisualTests():
     c = Cache()
@@ -116,7 +118,7 @@ def deleteTest():
     c.expire(5)
     
     values = c.getCacheValues()[1]
-    expectedValues = list(range(8,0,-1))
+    expectedValues = [8, 7, 6, 4, 3, 2, 1]
     if values != expectedValues:
         print('values and expected values dont match')
         print('cache ', values)
@@ -185,7 +187,9 @@ def timerTest():
     print("Sleeping for 6 seconds.")
     time.sleep(6)
     
-    if c.get(4) is None:
+    #get treats expired entries as missing even without the timer,
+    #so we look at what is actually still stored. 
+    if 4 not in c.elements:
         print("Failure: timer deleted key 4 when it was turned off.") 
     else:
         print("Stopping the timer successful")
@@ -194,7 +198,7 @@ def timerTest():
     c.restartTimer()
     time.sleep(2)
     
-    if c.get(4) is not None:
+    if 4 in c.elements:
         print("Failure: timer did not delete key 4 when it was restarted.") 
     else:
         print("Restarting the timer successful")
@@ -205,14 +209,1282 @@ def timerTest():
     print("Sleeping for 6 seconds.")
     time.sleep(6)
     
-    if c.get(5) is None:
+    if 5 not in c.elements:
         print("Failure: timer deleted key 5 when it was turned off.") 
+    elif c.get(5) is not None:
+        print("Failure: get returned key 5 after it expired.") 
     else:
         print("Stopping the timer successful")
     
     
+#Tests that a sharded cache can be hammered from several threads at once 
+#and that every shard's linked list still agrees with its dictionary afterwards.
+def shardedThreadTest():
+    import threading
+    
+    c = ShardedCache(cacheSize=200, shards=4)
+    errors = []
+    
+    def worker(offset):
+        try:
+            for i in range(0, 2000):
+                key = (i * 7 + offset) % 300
+                c.add(key, key)
+                value = c.get((key + 1) % 300)
+                if value is not None and value != (key + 1) % 300:
+                    errors.append("wrong value %s for key %s" % (value, (key + 1) % 300))
+                if i % 50 == 0:
+                    try:
+                        c.expire(key)
+                    except KeyError:
+                        pass
+        except Exception as e:
+            errors.append(repr(e))
+            
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(0, 8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+        
+    for shard in c.shards:
+        order = shard.getCacheValues()[1]
+        if len(order) != len(shard.elements) or set(order) != set(shard.elements):
+            errors.append("shard linked list and elements differ")
+        if len(order) > shard.size:
+            errors.append("shard grew past its size")
+            
+    c.writeToDisk()
+    saved = c.getCacheValues()[0]
+    c = ShardedCache(cacheSize=200, shards=4)
+    c.loadFromDisk()
+    if c.getCacheValues()[0] != saved:
+        errors.append("sharded cache did not reload the same values")
+            
+    if errors:
+        print("Sharded thread test failed.")
+        print(errors[:5])
+    else:
+        print("Sharded thread test successful")
+    
+#Tests that expireDue only removes the entries that are due, including 
+#after keys have been removed and re-added (which leaves stale heap entries).
+def expireDueTest():
+    import datetime
+    
+    c = Cache(cacheSize=10, expiryTime=60, sweep=False)
+    for i in range(0, 5):
+        c.add(i, i)
+    c.expire(2)
+    c.add(2, "two again")
+    
+    #Nothing is due yet. 
+    if c.expireDue() != 0 or len(c.elements) != 5:
+        print("expireDue removed entries before they were due.")
+        print(c.getCacheValues())
+        return
+    
+    #Everything but the re-added 2 is due just after 4's deadline. 
+    removed = c.expireDue(c.entries[4].expiryTime)
+    if removed != 4 or list(c.elements) != [2]:
+        print("expireDue did not remove exactly the due entries.")
+        print(removed, c.getCacheValues())
+        return
+        
+    if c.expireDue(datetime.datetime.max) != 1 or c.getCacheValues()[1] != []:
+        print("expireDue did not remove the last entry.")
+        print(c.getCacheValues())
+        return
+        
+    #The expiry thread changes the cache from its own thread, so a cache with one 
+    #gets a real lock even without threadSafe. 
+    for cache in (Cache(cacheSize=10, expiryTime=60), CompactCache(cacheSize=10, expiryTime=60)):
+        cache.close()
+        if isinstance(cache.lock, _NoLock):
+            print("%s with an expiry thread has no lock." % type(cache).__name__)
+            return
+    if not isinstance(Cache(cacheSize=10, expiryTime=60, sweep=False).lock, _NoLock):
+        print("A cache without an expiry thread took a lock it doesn't need.")
+        return
+        
+    print("expireDue test successful")
+    
+#Tests that with the journal on, changes made after the last writeToDisk 
+#survive a "crash" (the cache being dropped without writing) and that a half 
+#written last record is ignored.
+def journalTest():
+    import os
+    import random
+    import struct
+    import threading
+    import tempfile
+    
+    fileName = os.path.join(tempfile.mkdtemp(), "journal.json")
+    c = Cache(cacheSize=5, fileName=fileName, journal=True, fsyncPolicy="always")
+    for i in range(0, 4):
+        c.add(i, str(i))
+    c.writeToDisk()
+    c.add(4, "four")
+    c.add(5, "five")
+    c.get(2)
+    c.expire(3)
+    #A value the journal can't write must not be added either, with add or addMany. 
+    for add in (lambda: c.add("unwritable", lambda: None), lambda: c.addMany([(6, "six"), ("unwritable", lambda: None)])):
+        try:
+            add()
+            print("Adding a value the journal can't write did not raise.")
+            return
+        except Exception:
+            pass
+    if "unwritable" in c.elements or 6 in c.elements:
+        print("A value the journal couldn't write was added anyway.")
+        return
+    expected = c.getCacheValues()
+    c.close()
+    
+    #A record cut short by a crash. 
+    with open(c.journal.path(c.journal.generation), "ab") as f:
+        f.write(struct.pack("<I", 100) + b"\x80\x04")
+    
+    c = Cache(cacheSize=5, fileName=fileName, journal=True)
+    c.loadFromDisk()
+    newValues = c.getCacheValues()
+    if newValues[0] != expected[0] or newValues[1] != expected[1]:
+        print("Journal replay differs from the cache before the crash.")
+        print(expected)
+        print(newValues)
+        return
+        
+    #A snapshot should fold the old journals in and remove them. 
+    c.writeToDisk()
+    c.close()
+    if c.journal.generations() != [c.journal.generation]:
+        print("Old journals were not removed after writeToDisk.")
+        print(c.journal.generations())
+        return
+    c = Cache(cacheSize=5, fileName=fileName, journal=True)
+    c.loadFromDisk()
+    if c.getCacheValues()[1] != expected[1]:
+        print("Reloading after a snapshot with a journal failed.")
+        print(c.getCacheValues())
+        return
+        
+    #Replay ends up with the same entries as the live cache whatever the policy, 
+    #the journal has the evictions instead of leaving replay to pick the same victims. 
+    random.seed(3)
+    for policy in ("lru", "sieve", "tinylfu"):
+        policyFile = os.path.join(os.path.dirname(fileName), "%s.json" % policy)
+        live = Cache(cacheSize=8, fileName=policyFile, journal=True, policy=policy)
+        for i in range(0, 2000):
+            key = random.randrange(0, 30)
+            operation = random.random()
+            if operation < 0.4:
+                live.add(key, i)
+            elif operation < 0.5:
+                live.addMany((random.randrange(0, 30), i) for j in range(0, 5))
+            else:
+                live.get(key)
+        live.close()
+        replayed = Cache(cacheSize=8, fileName=policyFile, journal=True, policy=policy)
+        replayed.loadFromDisk()
+        replayed.close()
+        if replayed.elements != live.elements:
+            print("Replaying the journal of a %s cache gave different entries." % policy)
+            print(sorted(live.elements), sorted(replayed.elements))
+            return
+            
+    #writeToDisk syncs the old journal without holding the cache's lock. 
+    synced = Cache(cacheSize=5, fileName=fileName + ".synced", journal=True, threadSafe=True)
+    synced.add(1, "one")
+    blocked = []
+    def fsync(fileno):
+        reader = threading.Thread(target=synced.get, args=(1,))
+        reader.start()
+        reader.join(1)
+        blocked.append(reader.is_alive())
+        realFsync(fileno)
+    realFsync = os.fsync
+    os.fsync = fsync
+    try:
+        synced.writeToDisk()
+    finally:
+        os.fsync = realFsync
+    synced.close()
+    if blocked != [False]:
+        print("writeToDisk synced the journal while holding the cache's lock.")
+        print(blocked)
+        return
+        
+    #Keys and values json can't keep come back as they were. 
+    c.add(("tuple", 1), b"\x00bytes")
+    c.close()
+    c = Cache(cacheSize=5, fileName=fileName, journal=True, snapshotFormat="binary")
+    c.loadFromDisk()
+    if c.get(("tuple", 1)) != b"\x00bytes":
+        print("The journal did not keep a tuple key and a bytes value.")
+        print(c.getCacheValues())
+        return
+    c.close()
+        
+    print("Journal test successful")
+    
+#Tests the binary snapshot format and that the journal gets compacted 
+#into a fresh snapshot once it passes compactThreshold.
+def binarySnapshotTest():
+    import os
+    import tempfile
+    
+    fileName = os.path.join(tempfile.mkdtemp(), "binary.cache")
+    c = Cache(cacheSize=20, fileName=fileName, snapshotFormat="binary")
+    for i in range(0, 10):
+        c.add(i, {"value": i, "list": [i, str(i)]})
+    c.add("text key", None)
+    c.get(3)
+    expected = c.getCacheValues()
+    c.writeToDisk()
+    
+    #loadFromDisk does not need to be told which format the file is in. 
+    c = Cache(cacheSize=20, fileName=fileName)
+    c.loadFromDisk()
+    newValues = c.getCacheValues()
+    if newValues != expected:
+        print("Binary snapshot reloaded different values.")
+        print(expected)
+        print(newValues)
+        return
+        
+    c = Cache(cacheSize=20, fileName=fileName, journal=True, snapshotFormat="binary", compactThreshold=10)
+    c.loadFromDisk()
+    for i in range(0, 25):
+        c.add(i % 15, i)
+    expected = c.getCacheValues()
+    c.close()
+    if c.journal.generations() == [0] or c.journal.records >= 10:
+        print("The journal was never compacted.")
+        return
+        
+    c = Cache(cacheSize=20, fileName=fileName, journal=True)
+    c.loadFromDisk()
+    newValues = c.getCacheValues()
+    if newValues != expected:
+        print("Compacted snapshot and journal reloaded different values.")
+        print(expected)
+        print(newValues)
+        return
+        
+    print("Binary snapshot test successful")
+    
+def serializerTest():
+    import os
+    import tempfile
+    
+    directory = tempfile.mkdtemp()
+    values = [None, True, False, 0, -5, 1 << 70, 2.5, "text", "ünïcode", b"bytes", bytearray(b"array"),
+        memoryview(b"view"), (1, "tuple"), {"nested": [1, 2]}, "long" * 100, b"long" * 100]
+    for snapshotFormat in ("pickle5", "struct", "binary", "json"):
+        fileName = os.path.join(directory, "cache." + snapshotFormat)
+        c = Cache(cacheSize=5000, fileName=fileName, snapshotFormat=snapshotFormat)
+        #Enough entries for more than one block. 
+        for i in range(0, 4500):
+            c.add("key %s" % i, i)
+        for i, value in enumerate(values):
+            #json has no bytes or tuples and protocol 4 pickles can't hold memoryviews. 
+            if snapshotFormat == "json" and isinstance(value, (bytes, bytearray, memoryview, tuple)):
+                continue
+            if snapshotFormat == "binary" and isinstance(value, memoryview):
+                continue
+            c.add(i, value)
+        c.get("key 7")
+        expected = c.getCacheValues()
+        c.writeToDisk()
+        
+        c = Cache(cacheSize=5000, fileName=fileName)
+        c.loadFromDisk()
+        newValues = c.getCacheValues()
+        #memoryviews come back as bytes, which compare equal. 
+        if newValues != expected or (snapshotFormat != "json" and type(c.get(10)) is not bytearray):
+            print("The %s snapshot reloaded different values." % snapshotFormat)
+            print(expected[1][:20])
+            print(newValues[1][:20])
+            return
+            
+    print("Serializer test successful")
+    
+#Runs the same random operations against Cache and CompactCache 
+#and checks they always agree on the contents and the order. 
+def compactCacheTest():
+    import random
+    
+    random.seed(5)
+    c = Cache(cacheSize=8)
+    compact = CompactCache(cacheSize=8, expiryTime=60, sweep=False)
+    for i in range(0, 5000):
+        key = random.randrange(0, 20)
+        operation = random.random()
+        if operation < 0.5:
+            c.add(key, i)
+            compact.add(key, i)
+        elif operation < 0.8:
+            if c.get(key) != compact.get(key):
+                print("CompactCache returned a different value for %s" % key)
+                return
+        elif key in c.elements:
+            c.expire(key)
+            compact.expire(key)
+        if c.getCacheValues() != compact.getCacheValues():
+            print("CompactCache and Cache differ.")
+            print(c.getCacheValues())
+            print(compact.getCacheValues())
+            return
+            
+    #Everything was created well within a minute so nothing is due yet.
+    import time
+    if compact.expireDue() != 0 or compact.expireDue(time.monotonic() + 61) != len(c.elements):
+        print("CompactCache did not expire entries in order.")
+        return
+        
+    #The snapshot is the same format as Cache's. 
+    c.writeToDisk()
+    compact = CompactCache(cacheSize=8)
+    compact.loadFromDisk()
+    if compact.getCacheValues() != c.getCacheValues():
+        print("CompactCache could not load a Cache snapshot.")
+        return
+        
+    #A cache of size 0 holds nothing, like Cache. 
+    c = Cache(cacheSize=0)
+    compact = CompactCache(cacheSize=0, expiryTime=60, sweep=False)
+    c.add(1, 1)
+    compact.add(1, 1)
+    if compact.get(1) is not None or compact.getCacheValues() != c.getCacheValues():
+        print("CompactCache of size 0 kept an entry.")
+        print(compact.getCacheValues())
+        return
+    
+    print("CompactCache test successful")
+    
+#Tests that the batch operations leave the cache exactly as the 
+#equivalent single operations would.
+def batchTest():
+    single = Cache(cacheSize=6)
+    batch = Cache(cacheSize=6)
+    pairs = [(i % 9, str(i)) for i in range(0, 12)]
+    for key, value in pairs:
+        single.add(key, value)
+    batch.addMany(pairs)
+    if single.getCacheValues() != batch.getCacheValues():
+        print("addMany differs from calling add for each pair.")
+        print(single.getCacheValues())
+        print(batch.getCacheValues())
+        return
+        
+    keys = [5, 100, 1, 8]
+    expected = {}
+    for key in keys:
+        value = single.get(key)
+        if value is not None:
+            expected[key] = value
+    if batch.getMany(keys) != expected or single.getCacheValues() != batch.getCacheValues():
+        print("getMany differs from calling get for each key.")
+        print(single.getCacheValues())
+        print(batch.getCacheValues())
+        return
+        
+    if batch.expireMany([1, 100, 2]) != 2 or 1 in batch.elements or 2 in batch.elements:
+        print("expireMany did not remove the keys in the cache.")
+        print(batch.getCacheValues())
+        return
+        
+    sharded = ShardedCache(cacheSize=100, shards=4)
+    sharded.addMany(dict((i, i * 2) for i in range(0, 50)))
+    if sharded.getMany(range(45, 55)) != dict((i, i * 2) for i in range(45, 50)):
+        print("ShardedCache getMany returned the wrong values.")
+        return
+    if sharded.expireMany(range(0, 10)) != 10 or sharded.get(3) is not None:
+        print("ShardedCache expireMany did not remove the keys.")
+        return
+        
+    print("Batch test successful")
+    
+#Tests that concurrent misses on one key only call the loader once, 
+#that loader errors reach every caller and are not cached, 
+#and the same for the asyncio version.
+def getOrLoadTest():
+    import asyncio
+    import threading
+    import time
+    
+    c = Cache(cacheSize=10, threadSafe=True)
+    calls = []
+    def slowLoader(key):
+        calls.append(key)
+        time.sleep(0.2)
+        return "loaded %s" % key
+        
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(c.getOrLoad(1, slowLoader))) 
+        for i in range(0, 10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if len(calls) != 1 or results != ["loaded 1"] * 10 or c.get(1) != "loaded 1":
+        print("getOrLoad did not share one load between threads.")
+        print(calls, results)
+        return
+        
+    def failingLoader(key):
+        time.sleep(0.1)
+        raise ValueError("remote call failed")
+    errors = []
+    def failingCall():
+        try:
+            c.getOrLoad(2, failingLoader)
+        except ValueError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=failingCall) for i in range(0, 5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if len(errors) != 5 or c.get(2) is not None or c.getOrLoad(2, slowLoader) != "loaded 2":
+        print("getOrLoad did not pass the loader error on without caching it.")
+        print(errors)
+        return
+        
+    asyncCalls = []
+    async def asyncLoader(key):
+        asyncCalls.append(key)
+        await asyncio.sleep(0.1)
+        if key == "bad":
+            raise ValueError("remote call failed")
+        return "async %s" % key
+        
+    async def run():
+        cache = AsyncCache(cacheSize=10)
+        values = await asyncio.gather(*[cache.get_or_load("a", asyncLoader) for i in range(0, 10)])
+        failures = await asyncio.gather(*[cache.get_or_load("bad", asyncLoader) for i in range(0, 3)], 
+            return_exceptions=True)
+        return cache, values, failures
+        
+    loop = asyncio.new_event_loop()
+    cache, values, failures = loop.run_until_complete(run())
+    loop.close()
+    if (asyncCalls != ["a", "bad"] or values != ["async a"] * 10 or cache.get("a") != "async a" 
+            or not all(isinstance(f, ValueError) for f in failures) or cache.get("bad") is not None):
+        print("AsyncCache get_or_load did not share one load between tasks.")
+        print(asyncCalls, values, failures)
+        return
+        
+    print("getOrLoad test successful")
+    
+#Tests that maxBytes evicts by the total weight of the entries 
+#and that the running total follows adds, replacements and removals. 
+def weightTest():
+    c = Cache(cacheSize=100, maxBytes=100, sizer=len)
+    c.add(1, "a" * 40)
+    c.add(2, "b" * 40)
+    if c.totalWeight != 80:
+        print("Wrong total weight %s, expected 80." % c.totalWeight)
+        return
+    #Going over the budget removes the oldest entry. 
+    c.add(3, "c" * 30)
+    if c.get(1) is not None or c.totalWeight != 70:
+        print("maxBytes did not evict the oldest entry.")
+        print(c.getCacheValues(), c.totalWeight)
+        return
+    #Replacing a value replaces its weight, an explicit weight wins over the sizer. 
+    c.add(2, "small", weight=10)
+    if c.totalWeight != 40:
+        print("Replacing a value did not update the total weight.")
+        print(c.totalWeight)
+        return
+    c.expire(3)
+    c.add(4, "d" * 500)
+    if c.totalWeight != 10 or c.get(4) is not None or c.get(2) is None:
+        print("A value heavier than maxBytes was kept.")
+        print(c.getCacheValues(), c.totalWeight)
+        return
+    c.addMany([(5, "e" * 60), (6, "f" * 60)])
+    if c.totalWeight != 60 or c.getCacheValues()[1] != [6]:
+        print("addMany did not evict down to maxBytes.")
+        print(c.getCacheValues(), c.totalWeight)
+        return
+    
+    c.writeToDisk()
+    c = Cache(cacheSize=100, maxBytes=100, sizer=len)
+    c.loadFromDisk()
+    if c.totalWeight != 60:
+        print("Weights were not recreated on load.")
+        return
+    c.expireAll()
+    if c.totalWeight != 0:
+        print("expireAll did not reset the total weight.")
+        return
+        
+    print("Weight test successful")
+    
+#Tests the SIEVE and TinyLFU eviction policies on small hand checked cases. 
+def policyTest():
+    c = Cache(cacheSize=4, policy="sieve")
+    for i in range(0, 4):
+        c.add(i, i)
+    #SIEVE doesn't move entries on a hit, it marks them as visited. 
+    c.get(0)
+    c.get(1)
+    if c.getCacheValues()[1] != [3, 2, 1, 0]:
+        print("SIEVE moved entries on a hit.")
+        print(c.getCacheValues())
+        return
+    #The hand skips the visited 0 and 1 (clearing them) and removes 2. 
+    c.add(4, 4)
+    if c.getCacheValues()[1] != [4, 3, 1, 0]:
+        print("SIEVE removed the wrong entry.")
+        print(c.getCacheValues())
+        return
+    #The hand carries on from where it stopped, 3 is next. 
+    c.add(5, 5)
+    if c.getCacheValues()[1] != [5, 4, 1, 0]:
+        print("SIEVE hand did not carry on from its last position.")
+        print(c.getCacheValues())
+        return
+        
+    #A scan of keys used once shouldn't push out keys that are used all the time. 
+    c = Cache(cacheSize=10, policy="tinylfu")
+    for repeat in range(0, 5):
+        for key in range(0, 10):
+            if c.get(key) is None:
+                c.add(key, key)
+    for key in range(100, 200):
+        if c.get(key) is None:
+            c.add(key, key)
+    kept = [key for key in range(0, 10) if key in c.elements]
+    if len(kept) < 9:
+        print("TinyLFU let a scan push out the frequently used keys.")
+        print(c.getCacheValues())
+        return
+    #The same through addMany. 
+    c = Cache(cacheSize=10, policy="tinylfu")
+    for repeat in range(0, 5):
+        for key in range(0, 10):
+            if c.get(key) is None:
+                c.add(key, key)
+    c.addMany((key, key) for key in range(100, 200))
+    kept = [key for key in range(0, 10) if key in c.elements]
+    if len(kept) < 9:
+        print("TinyLFU let addMany push out the frequently used keys.")
+        print(c.getCacheValues())
+        return
+        
+    print("Policy test successful")
+    
+def metricsTest():
+    import datetime
+    import os
+    import tempfile
+    
+    events = []
+    directory = tempfile.mkdtemp()
+    c = Cache(cacheSize=2, expiryTime=60, fileName=os.path.join(directory, "cache.json"), sweep=False,
+        metrics=True, latencySampleEvery=1, metricsHook=lambda event, value: events.append(event))
+    c.add(1, 1)
+    c.add(2, 2)
+    c.add(3, 3)
+    c.get(3)
+    c.get(1)
+    c.getMany([2, 4])
+    c.expireDue(datetime.datetime.utcnow() + datetime.timedelta(seconds=120))
+    c.writeToDisk()
+    
+    stats = c.stats()
+    expected = {"size": 0, "hits": 2, "misses": 2, "adds": 3, "capacityEvictions": 1, 
+        "expiryEvictions": 2, "sweeps": 1, "writes": 1, "hitRatio": 0.5}
+    for name, value in expected.items():
+        if stats[name] != value:
+            print("Wrong %s in stats, expected %s." % (name, value))
+            print(stats)
+            return
+    if stats["maxExpiryLag"] < 60 or sum(stats["getLatency"].values()) != 2 or sum(stats["addLatency"].values()) != 3:
+        print("Wrong expiry lag or latency samples in stats.")
+        print(stats)
+        return
+    if events != ["add", "add", "evict", "add", "hit", "miss", "hit", "miss", "expire", "expire", "sweep", "write"]:
+        print("Wrong metrics events.")
+        print(events)
+        return
+        
+    #addMany counts its adds too. 
+    events = []
+    c = Cache(cacheSize=2, metrics=True, metricsHook=lambda event, value: events.append((event, value)))
+    c.addMany([(1, 1), (2, 2), (3, 3)])
+    if c.stats()["adds"] != 3 or events != [("add", 1), ("add", 2), ("add", 3), ("evict", 1)]:
+        print("addMany was not counted in the metrics.")
+        print(c.stats(), events)
+        return
+        
+    #Without metrics only the size is kept. 
+    if set(Cache(cacheSize=2).stats()) != set(["size", "totalWeight"]):
+        print("Stats kept without metrics.")
+        return
+        
+    s = ShardedCache(cacheSize=8, shards=2, metrics=True)
+    for i in range(0, 4):
+        s.add(i, i)
+        s.get(i)
+    if s.stats()["hits"] != 4 or s.stats()["size"] != 4:
+        print("Wrong sharded stats.")
+        print(s.stats())
+        return
+        
+    print("Metrics test successful")
+    
+def _sharedWorker(cache, worker):
+    for i in range(0, 50):
+        cache.add((worker, i), "value %s" % i)
+    cache.close()
+    
+def sharedCacheTest():
+    import multiprocessing
+    import time
+    
+    c = SharedCache(cacheSize=4, expiryTime=60, sweep=False)
+    for i in range(0, 5):
+        c.add(i, i)
+    c.get(1)
+    if c.getCacheValues()[1] != [1, 4, 3, 2]:
+        print("SharedCache did not keep the LRU order.")
+        print(c.getCacheValues())
+        return
+    c.expire(3)
+    c.add(1, "one")
+    if c.getCacheValues()[1] != [1, 4, 2] or c.get(1) != "one":
+        print("SharedCache expire or replace failed.")
+        print(c.getCacheValues())
+        return
+    if c.expireDue(time.time() + 120) != 3 or len(c) != 0:
+        print("SharedCache expireDue failed.")
+        return
+        
+    #The workers attach to the segment through the pickled cache. 
+    context = multiprocessing.get_context("spawn")
+    c.close()
+    c.unlink()
+    c = SharedCache(cacheSize=200, slotBytes=64, lock=context.Lock())
+    workers = [context.Process(target=_sharedWorker, args=(c, worker)) for worker in range(0, 4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    missing = [(worker, i) for worker in range(0, 4) for i in range(0, 50) if c.get((worker, i)) != "value %s" % i]
+    c.close()
+    c.unlink()
+    if missing:
+        print("SharedCache lost entries added by other processes.")
+        print(missing)
+        return
+        
+    c = SharedCache(cacheSize=0, sweep=False)
+    c.add(1, 1)
+    if c.get(1) is not None:
+        print("SharedCache of size 0 kept an entry.")
+        return
+    c.close()
+    c.unlink()
+    
+    #Restarting a running expiry thread doesn't start a second one. 
+    c = SharedCache(cacheSize=4, expiryTime=60, tickResolution=0.05)
+    first = c.timer
+    c.stopTimer()
+    c.restartTimer()
+    second = c.timer
+    c.restartTimer()
+    running = first.is_alive(), c.timer is second
+    c.close()
+    c.unlink()
+    if running != (False, True):
+        print("SharedCache stop and restart left the wrong expiry threads running.")
+        return
+        
+    print("SharedCache test successful")
+    
+def ttlTest():
+    import datetime
+    import os
+    import tempfile
+    import time
+    
+    c = Cache(cacheSize=10, sweep=False)
+    c.add("short", 1, ttl=0.05)
+    c.add("forever", 2)
+    time.sleep(0.1)
+    #Read as missing without any sweep. 
+    if c.get("short") is not None or "short" in c.elements or c.get("forever") != 2:
+        print("An entry past its ttl was returned by get.")
+        print(c.getCacheValues())
+        return
+        
+    c = Cache(cacheSize=10, expiryTime=60, sweep=False)
+    c.add("default", 1)
+    c.add("short", 2, ttl=1)
+    c.add("extended", 3, ttl=1)
+    c.add("extended", 3, ttl=120)
+    soon = datetime.datetime.utcnow() + datetime.timedelta(seconds=2)
+    if c.expireDue(soon) != 1 or sorted(c.elements) != ["default", "extended"]:
+        print("Per entry ttls expired the wrong entries.")
+        print(c.getCacheValues())
+        return
+    if c.expireDue(soon + datetime.timedelta(seconds=60)) != 1 or list(c.elements) != ["extended"]:
+        print("The ttl of a re-added key was not restarted.")
+        print(c.getCacheValues())
+        return
+        
+    #Entries pushed out early don't pile up in the expiry heap without sweeps. 
+    c = Cache(cacheSize=10, expiryTime=60, sweep=False)
+    for i in range(0, 10000):
+        c.add(i, i)
+    if len(c.expiryHeap) > 2 * 10 + 1025:
+        print("The expiry heap kept growing without sweeps.")
+        return
+        
+    c = Cache(cacheSize=10, threadSafe=True, tickResolution=0.05)
+    if c.timer is not None:
+        print("The expiry thread started without anything to expire.")
+        return
+    c.add("short", 1, ttl=0.05)
+    time.sleep(0.3)
+    c.close()
+    if "short" in c.elements:
+        print("The expiry thread did not remove an entry with a ttl.")
+        return
+        
+    #Without a lock the expiry thread would race the caller, ttls then expire on read. 
+    c = Cache(cacheSize=10, tickResolution=0.05)
+    c.add("short", 1, ttl=0.05)
+    c.restartTimer()
+    if c.timer is not None:
+        print("A ttl started the expiry thread of a cache without a lock.")
+        return
+    time.sleep(0.1)
+    if c.get("short") is not None:
+        print("An entry past its ttl was returned without the expiry thread.")
+        return
+        
+    #A cache that only expires through ttls gets its expiry thread back from restartTimer. 
+    c = Cache(cacheSize=10, threadSafe=True, tickResolution=0.05)
+    c.add("first", 1, ttl=60)
+    c.stopTimer()
+    c.add("short", 2, ttl=0.05)
+    if c.timer is not None:
+        print("Adding an entry with a ttl started the stopped expiry thread.")
+        return
+    c.restartTimer()
+    time.sleep(0.3)
+    c.close()
+    if "short" in c.elements or c.timer is not None:
+        print("restartTimer did not bring back the expiry thread of a cache with ttls.")
+        return
+        
+    #Snapshots and the journal keep the deadlines, a reload doesn't start the ttls again. 
+    directory = tempfile.mkdtemp()
+    for snapshotFormat in ("json", "binary", "pickle5", "struct"):
+        fileName = os.path.join(directory, "%s.cache" % snapshotFormat)
+        c = Cache(cacheSize=10, fileName=fileName, sweep=False, snapshotFormat=snapshotFormat)
+        c.add("long", 1, ttl=60)
+        expected = c.entries["long"].expiryTime
+        c.writeToDisk()
+        c = Cache(cacheSize=10, fileName=fileName, sweep=False, snapshotFormat=snapshotFormat)
+        c.loadFromDisk()
+        entry = c.entries["long"]
+        if abs((entry.expiryTime - expected).total_seconds()) > 0.001 or entry.ttl != 60:
+            print("The %s snapshot did not keep the deadline of an entry." % snapshotFormat)
+            print(expected, entry.expiryTime, entry.ttl)
+            return
+    #Keys a ShardedCache finds in the wrong shard (hash() differs between runs) 
+    #are moved with their deadlines. Swapping the shard files misplaces all of them. 
+    fileName = os.path.join(directory, "sharded.cache")
+    s = ShardedCache(cacheSize=40, shards=2, fileName=fileName, sweep=False)
+    for i in range(0, 20):
+        s.add("key %d" % i, i, ttl=60)
+    expected = dict((key, shard.entries[key].expiryTime) for shard in s.shards for key in shard.elements)
+    s.writeToDisk()
+    os.rename(fileName + ".0", fileName + ".swap")
+    os.rename(fileName + ".1", fileName + ".0")
+    os.rename(fileName + ".swap", fileName + ".1")
+    s = ShardedCache(cacheSize=40, shards=2, fileName=fileName, sweep=False)
+    s.loadFromDisk()
+    for key, expiryTime in expected.items():
+        entry = s._shard(key).entries.get(key)
+        if entry is None or entry.ttl != 60 or abs((entry.expiryTime - expiryTime).total_seconds()) > 0.001:
+            print("A key moved to another shard lost its deadline.")
+            return
+            
+    fileName = os.path.join(directory, "journal.cache")
+    c = Cache(cacheSize=10, fileName=fileName, sweep=False, journal=True, snapshotFormat="binary")
+    c.add("short", 1, ttl=0.05)
+    c.add("long", 2, ttl=60)
+    expected = c.entries["long"].expiryTime
+    c.close()
+    time.sleep(0.1)
+    c = Cache(cacheSize=10, fileName=fileName, sweep=False, journal=True, snapshotFormat="binary")
+    c.loadFromDisk()
+    c.close()
+    if "short" in c.elements or abs((c.entries["long"].expiryTime - expected).total_seconds()) > 0.001:
+        print("Replaying the journal started the ttls again.")
+        print(c.getCacheValues())
+        return
+    #The same for entries that expire through expiryTime. 
+    fileName = os.path.join(directory, "duration.cache")
+    c = Cache(cacheSize=10, expiryTime=0.1, fileName=fileName, sweep=False, journal=True)
+    c.add("added", 1)
+    c.addMany([("batched", 2)])
+    c.close()
+    time.sleep(0.15)
+    c = Cache(cacheSize=10, expiryTime=0.1, fileName=fileName, sweep=False, journal=True)
+    c.loadFromDisk()
+    c.close()
+    if c.elements:
+        print("Replaying the journal started expiryTime again.")
+        print(c.getCacheValues())
+        return
+        
+    print("TTL test successful")
+    
+def tieredCacheTest():
+    import os
+    import tempfile
+    import time
+    
+    fileName = os.path.join(tempfile.mkdtemp(), "cache.tier")
+    c = TieredCache(cacheSize=3, diskSize=5, fileName=fileName, slotBytes=128)
+    for i in range(0, 10):
+        c.add(i, "value %s" % i)
+    #The three newest stay in memory, the next five were moved to disk and the rest dropped. 
+    if c.memory.getCacheValues()[1] != [9, 8, 7] or c.disk.getCacheValues()[1] != [6, 5, 4, 3, 2]:
+        print("TieredCache did not move evicted entries to disk.")
+        print(c.memory.getCacheValues())
+        print(c.disk.getCacheValues())
+        return
+    #A disk hit moves the key back to memory and the oldest in memory to disk. 
+    if c.get(5) != "value 5" or c.memory.getCacheValues()[1] != [5, 9, 8] or c.disk.getCacheValues()[1] != [7, 6, 4, 3, 2]:
+        print("TieredCache did not promote a disk hit.")
+        print(c.memory.getCacheValues())
+        print(c.disk.getCacheValues())
+        return
+    if c.get(0) is not None:
+        print("TieredCache returned an entry that fell off the disk tier.")
+        return
+    #Adding a key that is on disk replaces it there. 
+    c.add(3, "new")
+    if 3 in c.disk.getCacheValues()[1] or c.get(3) != "new":
+        print("TieredCache kept a stale disk copy.")
+        return
+    c.add("too big", "x" * 500)
+    for i in range(0, 3):
+        c.add(("filler", i), i)
+    if c.get("too big") is not None or c.stats()["dropped"] != 1:
+        print("TieredCache did not drop an entry too big for the disk tier.")
+        return
+    c.close()
+        
+    #The disk tier keeps its entries between runs and ttls carry over. 
+    c = TieredCache(cacheSize=3, diskSize=5, fileName=fileName, slotBytes=128)
+    if c.get(("filler", 0)) != 0:
+        print("TieredCache lost its disk tier on reopening.")
+        print(c.disk.getCacheValues())
+        return
+    c.add("short", 1, ttl=0.1)
+    for i in range(0, 3):
+        c.add(("more", i), i)
+    time.sleep(0.2)
+    if c.get("short") is not None:
+        print("An expired entry came back from the disk tier.")
+        return
+    c.close()
+    
+    print("TieredCache test successful")
+    
+def cachedTest():
+    import os
+    import tempfile
+    import time
+    
+    calls = []
+    @cached(cacheSize=2)
+    def square(x, power=2):
+        calls.append(x)
+        return x ** power
+        
+    results = [square(2), square(2), square(3), square(3, power=3), square(2), square(3, power=3)]
+    if results != [4, 4, 9, 27, 4, 27] or calls != [2, 3, 3, 2]:
+        print("cached called the function when it shouldn't have.")
+        print(results, calls)
+        return
+    if tuple(square.cache_info()) != (2, 4, 2, 2) or square.__name__ != "square":
+        print("Wrong cache_info for a cached function.")
+        print(square.cache_info())
+        return
+    square.cache_clear()
+    square(2)
+    if tuple(square.cache_info()) != (0, 1, 2, 1):
+        print("cache_clear did not empty the cache.")
+        return
+        
+    @cached(ttl=0.05)
+    def now(key):
+        return time.time()
+    first = now("a")
+    time.sleep(0.1)
+    if now("a") == first:
+        print("cached returned a result past its ttl.")
+        return
+        
+    #The results persisted by one run are there for the next. 
+    fileName = os.path.join(tempfile.mkdtemp(), "memo.cache")
+    def slow(x, y=1):
+        calls.append(x)
+        return (x, y)
+    calls = []
+    first = cached(persist=fileName)(slow)
+    first(1, y=2)
+    first(5)
+    first.cache_save()
+    second = cached(persist=fileName)(slow)
+    if second(1, y=2) != (1, 2) or second(5) != (5, 1) or calls != [1, 5]:
+        print("cached did not persist its results.")
+        print(calls)
+        return
+        
+    print("cached test successful")
+    
+def serverTest():
+    import asyncio
+    from cacheServer import CacheServer, CacheClient, OK, _Connection, _HEADER
+    
+    async def check(client):
+        await client.set("a", [1, 2])
+        await client.set(("tuple", 1), "b")
+        if await client.get("a") != [1, 2] or await client.get(("tuple", 1)) != "b" or await client.get("missing") is not None:
+            return "GET returned the wrong values."
+        #Many requests in flight at once on the same connections. 
+        await asyncio.gather(*[client.set(i, i * 10) for i in range(0, 100)])
+        results = await asyncio.gather(*[client.get(i) for i in range(0, 100)])
+        if results != [i * 10 for i in range(0, 100)]:
+            return "Pipelined requests got the wrong answers: %s" % results
+        if await client.mget([97, 500, 99]) != {97: 970, 99: 990}:
+            return "MGET returned the wrong values."
+        if not await client.delete(99) or await client.delete(99) or await client.get(99) is not None:
+            return "DEL did not remove the key."
+        await client.set("short", 1, ttl=0.05)
+        await asyncio.sleep(0.1)
+        if await client.get("short") is not None:
+            return "SET did not apply the ttl."
+    
+    async def run():
+        server = await CacheServer(port=0, cacheSize=1000).start()
+        client = await CacheClient(port=server.port, poolSize=2).connect()
+        try:
+            return await check(client)
+        finally:
+            await client.close()
+            await server.stop()
+        
+    #A response nobody asked for is skipped and the requests still waiting 
+    #when the connection ends are failed rather than left hanging. 
+    async def lost():
+        reader = asyncio.StreamReader()
+        connection = _Connection(reader, None)
+        loop = asyncio.get_event_loop()
+        answered = connection.pending[1] = loop.create_future()
+        waiting = connection.pending[2] = loop.create_future()
+        reader.feed_data(_HEADER.pack(OK, 7, 0) + _HEADER.pack(OK, 1, 0))
+        reader.feed_eof()
+        await connection.readerTask
+        if answered.result() != (OK, b"") or not isinstance(waiting.exception(), ConnectionError):
+            return "A stray response broke the connection's other requests."
+            
+    error = asyncio.run(run()) or asyncio.run(lost())
+    if error:
+        print(error)
+        return
+    print("Server test successful")
+    
+def clusterTest():
+    import asyncio
+    from cacheCluster import CacheCluster, LocalNode
+    
+    async def run():
+        cluster = await CacheCluster({name: LocalNode(cacheSize=10000) for name in "abcd"}).connect()
+        keys = ["key %s" % i for i in range(0, 10000)]
+        for key in keys:
+            await cluster.set(key, key.upper())
+        sizes = [len(node.cache.elements) for node in cluster.nodes.values()]
+        if sum(sizes) != len(keys) or max(sizes) > 1.4 * len(keys) / 4:
+            return "Keys were not spread over the nodes: %s" % sizes
+        if await cluster.mget(keys[0:100] + ["missing"]) != {key: key.upper() for key in keys[0:100]}:
+            return "MGET over the nodes returned the wrong values."
+            
+        #A fifth node should take about a fifth of the keys, all from the other nodes. 
+        before = {key: cluster.nodeName(key) for key in keys}
+        cluster.addNode("e", LocalNode(cacheSize=10000))
+        moved = [key for key in keys if cluster.nodeName(key) != before[key]]
+        if not 0.12 < len(moved) / len(keys) < 0.3 or any(cluster.nodeName(key) != "e" for key in moved):
+            return "Adding a node moved %d keys." % len(moved)
+        if len(await cluster.mget(keys)) != len(keys) - len(moved):
+            return "Keys that did not move were lost."
+            
+        #Removing it again gives every key back to the node it was on. 
+        cluster.removeNode("e")
+        if any(cluster.nodeName(key) != before[key] for key in keys) or await cluster.get(keys[0]) != keys[0].upper():
+            return "Removing a node moved keys it did not have."
+        if not await cluster.delete(keys[0]) or await cluster.get(keys[0]) is not None:
+            return "DEL did not remove the key."
+        await cluster.close()
+        
+    error = asyncio.run(run())
+    if error:
+        print(error)
+        return
+    print("Cluster test successful")
+    
+def replicationTest():
+    import datetime
+    import os
+    import tempfile
+    from cacheReplication import ReplicationPrimary, CacheReplica
+    
+    directory = tempfile.mkdtemp()
+    primary = ReplicationPrimary(port=0, cacheSize=5).start()
+    c = primary.cache
+    #What is there before the replica connects comes with the snapshot. 
+    for i in range(0, 8):
+        c.add(("key", i), i)
+    replica = CacheReplica(port=primary.port, cacheSize=5, fileName=os.path.join(directory, "replica.bin")).start()
+    if not replica.waitFor(primary.sequence, 5) or replica.snapshots != 1:
+        print("The replica did not load the primary's snapshot.")
+        return
+    if [entry.key for entry in replica.cache.iterate()] != [entry.key for entry in c.iterate()]:
+        print("The snapshot did not keep the primary's order.")
+        return
+        
+    #The rest comes as changes. 
+    c.get(("key", 3))
+    c.add("ttl", 1, ttl=60)
+    c.expire(("key", 5))
+    if not replica.waitFor(primary.sequence, 5):
+        print("The replica did not catch up.")
+        return
+    if [entry.key for entry in replica.cache.iterate()] != ["ttl", ("key", 3), ("key", 7), ("key", 6)]:
+        print("The replica did not apply the changes in order: %s" % [entry.key for entry in replica.cache.iterate()])
+        return
+    if replica.cache.entries["ttl"].expiryTime == datetime.datetime.max:
+        print("The replica lost the ttl.")
+        return
+    c.expireAll()
+    c.add("last", 1)
+    replica.waitFor(primary.sequence, 5)
+    if replica.cache.elements != {"last": 1} or replica.lag is None:
+        print("The replica did not apply expireAll.")
+        return
+    replica.stop()
+    primary.stop()
+    print("Replication test successful")
+    
+def refreshTest():
+    import time
+    
+    #Waits until the background reloads are done, up to a few seconds. 
+    def waitForReloads(cache):
+        for i in range(0, 300):
+            with cache.lock:
+                if not cache.refreshing:
+                    return
+            time.sleep(0.01)
+    
+    calls = []
+    def loader(key):
+        calls.append(key)
+        time.sleep(0.05)
+        if key == "bad":
+            raise ValueError("remote call failed")
+        return "new %s" % key
+        
+    #Reads close to the expiry time reload the entry once, in the background. 
+    c = Cache(cacheSize=10, expiryTime=0.6, threadSafe=True, sweep=False, loader=loader, refreshAhead=0.3)
+    c.add("hot", "old")
+    if c.get("hot") != "old" or calls:
+        print("refreshAhead reloaded an entry that was far from expiring.")
+        return
+    time.sleep(0.4)
+    expiryTime = c.entries["hot"].expiryTime
+    if [c.get("hot") for i in range(0, 10)] != ["old"] * 10:
+        print("refreshAhead made get wait for the reload.")
+        return
+    time.sleep(0.15)
+    if calls != ["hot"] or c.get("hot") != "new hot" or c.entries["hot"].expiryTime <= expiryTime:
+        print("refreshAhead did not reload the entry once with a new expiry time.")
+        print(calls)
+        return
+    c.close()
+    
+    #Past the expiry time the old value is still returned for a while. 
+    del calls[:]
+    c = Cache(cacheSize=10, expiryTime=0.2, threadSafe=True, sweep=False, loader=loader, staleWhileRevalidate=0.5)
+    c.add("stale", "old")
+    c.add("bad", "old")
+    c.add("cold", "old")
+    time.sleep(0.3)
+    c.expireDue()
+    if c.get("stale") != "old" or c.get("bad") != "old":
+        print("staleWhileRevalidate did not return the old value.")
+        return
+    waitForReloads(c)
+    if c.get("stale") != "new stale" or c.get("bad") != "old" or not isinstance(c.refreshErrors.get("bad"), ValueError):
+        print("staleWhileRevalidate did not reload the entry.")
+        print(calls, c.refreshErrors)
+        return
+    time.sleep(0.5)
+    c.expireDue()
+    if "cold" in c.elements or c.get("bad") is not None:
+        print("Entries outside the stale window were not removed.")
+        return
+        
+    #A reload doesn't replace a value added meanwhile. 
+    c.add("replaced", "old", ttl=0.1)
+    time.sleep(0.15)
+    c.get("replaced")
+    c.add("replaced", "new")
+    time.sleep(0.1)
+    if c.get("replaced") != "new" or c.getOrLoad("loaded") != "new loaded":
+        print("A reload replaced a newer value.")
+        return
+    c.close()
+    
+    #A reload of another key doesn't clear the error of one that failed, a reload 
+    #of the same key does. The reloads run right away on this thread to keep the order. 
+    class Inline():
+        def submit(self, function, *args):
+            function(*args)
+    fail = set(["bad"])
+    def flaky(key):
+        if key in fail:
+            raise ValueError("remote call failed")
+        return "new %s" % key
+    c = Cache(cacheSize=10, expiryTime=30, threadSafe=True, sweep=False, loader=flaky, refreshAhead=60,
+        refreshWorkers=Inline())
+    c.add("bad", "old")
+    c.add("good", "old")
+    c.get("bad")
+    c.get("good")
+    if list(c.refreshErrors) != ["bad"] or c.refreshError is not c.refreshErrors["bad"]:
+        print("A reload of another key lost the refresh error.")
+        print(c.refreshErrors, c.refreshError)
+        return
+    fail.clear()
+    c.get("bad")
+    if c.refreshErrors or c.refreshError is not None or c.elements["bad"] != "new bad":
+        print("A successful reload did not clear its key's refresh error.")
+        print(c.refreshErrors, c.refreshError)
+        return
+    c.close()
+    print("Refresh test successful")
+    
+def autosaveTest():
+    import os
+    import tempfile
+    import threading
+    import time
+    
+    directory = tempfile.mkdtemp()
+    fileName = os.path.join(directory, "autosave.json")
+    
+    #Bad arguments are turned down before any thread is started or file opened. 
+    threads = threading.active_count()
+    try:
+        Cache(expiryTime=5, sweep=False, fileName=fileName, journal=True, fsyncPolicy="interval", autosaveInterval=1)
+        print("Autosave without threadSafe was allowed.")
+        return
+    except ValueError:
+        pass
+    try:
+        Cache(expiryTime=5, fileName=fileName, journal=True, fsyncPolicy="interval", refreshAhead=1)
+        print("refreshAhead without a loader was allowed.")
+        return
+    except ValueError:
+        pass
+    if os.listdir(directory) or threading.active_count() != threads:
+        print("A cache that failed to be created left threads or files behind.")
+        print(os.listdir(directory))
+        return
+        
+    writes = []
+    c = Cache(cacheSize=100, fileName=fileName, threadSafe=True, autosaveChanges=10,
+        metrics=True, metricsHook=lambda event, value: writes.append(value) if event == "write" else None)
+    #The same key over and over only counts as one change. 
+    for i in range(0, 50):
+        c.add("same", i)
+    for i in range(0, 8):
+        c.add(i, i)
+    time.sleep(0.2)
+    if writes or os.path.exists(fileName):
+        print("Autosave wrote before enough keys changed.")
+        return
+    c.add(8, 8)
+    for wait in range(0, 50):
+        if writes:
+            break
+        time.sleep(0.1)
+    if len(writes) != 1:
+        print("Autosave did not write once enough keys changed.")
+        return
+        
+    #Nothing changed since so flush has nothing to do. 
+    if c.flush():
+        print("flush wrote an unchanged cache.")
+        return
+    c.add("last", "value")
+    c.stopTimer()
+    reloaded = Cache(cacheSize=100, fileName=fileName)
+    reloaded.loadFromDisk()
+    if reloaded.get("last") != "value" or reloaded.get("same") != 49:
+        print("stopTimer did not save the last changes.")
+        print(reloaded.getCacheValues())
+        return
+        
+    c = Cache(cacheSize=100, fileName=fileName, threadSafe=True, autosaveInterval=0.05)
+    c.add("timed", True)
+    for wait in range(0, 50):
+        if os.path.exists(fileName) and "timed" in open(fileName).read():
+            break
+        time.sleep(0.1)
+    else:
+        print("Autosave did not write after its interval.")
+        return
+    c.close()
+    
+    print("Autosave test successful")
+    
 if __name__ == "__main__":
     testOverflow()
     writeReadTest()
     deleteTest()
+    shardedThreadTest()
+    expireDueTest()
+    journalTest()
+    binarySnapshotTest()
+    serializerTest()
+    compactCacheTest()
+    batchTest()
+    getOrLoadTest()
+    weightTest()
+    policyTest()
+    metricsTest()
+    sharedCacheTest()
+    ttlTest()
+    tieredCacheTest()
+    cachedTest()
+    serverTest()
+    clusterTest()
+    replicationTest()
+    refreshTest()
+    autosaveTest()
     timerTest()
\ No newline at end of file
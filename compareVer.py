@@ -8,8 +8,17 @@
         last resort do fallback to string length if the numbers are the same e.g. 1.2 loses to 1.2rev)
     If we don't have an answer, the function returns None.
     See tests() for sample formats we can compare.
+    To sort or find the newest of many versions use sort_versions(labels) and 
+    max_version(labels), or version_key(label) as a sort key. They parse each 
+    label once instead of on every comparison. benchmark() compares the two.
+    VersionIndex keeps versions sorted to answer range, floor/ceiling and 
+    newest n questions without going through all of them.
 """
+import bisect
+import functools
+import random
 import re 
+import time
 
 intFinder = re.compile("\d+")
     
@@ -35,39 +44,203 @@ def extractInts(label):
         ints += extractInt(s)
     
     return [int(x) for x in ints]
+    
+#The label as something Python compares the way compareVersions does: 
+#the integers first, where 1.3 loses to 1.3.1 as a shorter tuple loses to a 
+#longer one it starts, and then the length of the stripped label so 1.2 loses to 1.2rev. 
+#Labels with equal keys are the ones compareVersions has no answer for. 
+#The delimiters never split a number, so findall on the whole label gives 
+#the same integers as extractInts. 
+#The most recently parsed labels are kept so catalogs with many repeats parse each once. 
+@functools.lru_cache(maxsize=1 << 16)
+def version_key(label):
+    return (tuple(map(int, intFinder.findall(label))), len(label.strip()))
    
 def compareVersions(v1, v2):
-    v1_integers = extractInts(v1)
-    v2_integers = extractInts(v2)
-    #our iteration length is the smaller of the two versions.
-    length = len(v1_integers) if len(v1_integers) < len(v2_integers) else len(v2_integers)
-    bigger = None
-    for i in range(0,length):
-        if v1_integers[i] == v2_integers[i]:
-            continue
-        if v1_integers[i] > v2_integers[i]:
-            bigger = v1
-            break
-        else:
-            bigger = v2
-            break
-    if bigger is None:
-        if len(v1_integers) > len(v2_integers):
-            #They are initially the same, but v1
-            #has another revision e.g. 1.3.1 vs 1.3
-            bigger = v1
-        if len(v2_integers) > len(v1_integers):
-            bigger = v2
-        #If we have the same number of numbers, but
-        #have something else tacked on, we assume it 
-        #is text denoting an upgrade e.g. 1.2 and 1.2Revised
-        elif len(v1_integers) == len(v2_integers):
-            if len(v1.strip()) > len(v2.strip()):
-                bigger = v1
-            if len(v1.strip()) < len(v2.strip()):
-                bigger = v2
-            
-    return bigger
+    v1_key = version_key(v1)
+    v2_key = version_key(v2)
+    #The integers decide first, e.g. 1.3.1 beats 1.3. If they 
+    #are the same but one label has something else tacked on, we assume it 
+    #is text denoting an upgrade e.g. 1.2 and 1.2Revised
+    if v1_key > v2_key:
+        return v1
+    if v2_key > v1_key:
+        return v2
+    return None
+    
+#Sorts the labels oldest first (newest first with reverse=True). 
+#Labels compareVersions can't tell apart keep their order. 
+def sort_versions(labels, reverse=False):
+    return sorted(labels, key=version_key, reverse=reverse)
+    
+#The newest of the labels, the first of them if several are equally new. 
+#None if there are no labels. 
+def max_version(labels):
+    return max(labels, key=version_key, default=None)
+    
+#A sorted collection of version labels, oldest first. 
+#Versions are ordered by version_key, so "newer" means what it does for compareVersions
+#and labels it can't tell apart (e.g. 1.2 and 1_2) sit next to each other in the 
+#order they were added. Queries take bounds as labels too. 
+#Lookups are a binary search, add is a binary search and a list insert. 
+class VersionIndex():
+    
+    def __init__(self, labels=()):
+        pairs = sorted(((version_key(label), label) for label in labels), key=lambda pair: pair[0])
+        self.keys = [pair[0] for pair in pairs]
+        self.labels = [pair[1] for pair in pairs]
+        
+    def __len__(self):
+        return len(self.labels)
+        
+    def __iter__(self):
+        return iter(self.labels)
+        
+    def __contains__(self, label):
+        key = version_key(label)
+        start = bisect.bisect_left(self.keys, key)
+        return label in self.labels[start:bisect.bisect_right(self.keys, key, start)]
+        
+    def add(self, label):
+        key = version_key(label)
+        index = bisect.bisect_right(self.keys, key)
+        self.keys.insert(index, key)
+        self.labels.insert(index, label)
+        
+    #Adds many labels, sorting everything again when that is quicker than inserting them one by one. 
+    def update(self, labels):
+        labels = list(labels)
+        if len(labels) * 8 < len(self.labels):
+            for label in labels:
+                self.add(label)
+            return
+        pairs = sorted(list(zip(self.keys, self.labels)) + [(version_key(label), label) for label in labels],
+            key=lambda pair: pair[0])
+        self.keys = [pair[0] for pair in pairs]
+        self.labels = [pair[1] for pair in pairs]
+        
+    #Removes one label equal to label, raises ValueError if there is none. 
+    def remove(self, label):
+        key = version_key(label)
+        start = bisect.bisect_left(self.keys, key)
+        index = self.labels.index(label, start, bisect.bisect_right(self.keys, key, start))
+        del self.keys[index]
+        del self.labels[index]
+        
+    #The versions from low to high, oldest first. Either bound can be None for no bound, 
+    #by default low is included and high is not, e.g. range("1.2", "2.0") for >= 1.2 and < 2.0. 
+    def range(self, low=None, high=None, includeLow=True, includeHigh=False):
+        start = 0
+        if low is not None:
+            lowKey = version_key(low)
+            start = (bisect.bisect_left if includeLow else bisect.bisect_right)(self.keys, lowKey)
+        end = len(self.keys)
+        if high is not None:
+            highKey = version_key(high)
+            end = (bisect.bisect_right if includeHigh else bisect.bisect_left)(self.keys, highKey)
+        return self.labels[start:end] if start < end else []
+        
+    #The newest version older than label (or as new, when inclusive), None if there is none. 
+    def floor(self, label, inclusive=True):
+        key = version_key(label)
+        index = (bisect.bisect_right if inclusive else bisect.bisect_left)(self.keys, key)
+        return self.labels[index - 1] if index > 0 else None
+        
+    #The oldest version newer than label (or as new, when inclusive), None if there is none. 
+    def ceiling(self, label, inclusive=True):
+        key = version_key(label)
+        index = (bisect.bisect_left if inclusive else bisect.bisect_right)(self.keys, key)
+        return self.labels[index] if index < len(self.labels) else None
+        
+    #The n newest versions, newest first. 
+    def latest(self, n=1):
+        return self.labels[:-n - 1:-1] if n > 0 else []
+        
+#compareVersions as the -1, 0, 1 comparison function functools.cmp_to_key wants,
+#parsing both labels on every call as compareVersions did before version_key. 
+def _compare(v1, v2):
+    v1_key = version_key.__wrapped__(v1)
+    v2_key = version_key.__wrapped__(v2)
+    return (v1_key > v2_key) - (v1_key < v2_key)
+    
+def _randomVersions(count, seed=1):
+    generator = random.Random(seed)
+    versions = []
+    for i in range(0, count):
+        parts = [str(generator.randint(0, 20)) for part in range(0, generator.randint(1, 4))]
+        label = generator.choice(['.', '-', '_']).join(parts)
+        if generator.random() < 0.2:
+            label += generator.choice(['rev', 'beta', 'rc1'])
+        versions.append(label)
+    return versions
+    
+#Times sorting count random labels with a comparison function that parses on 
+#every comparison against sort_versions, then max_version against a loop doing the same. 
+#The parse cache is cleared first so sort_versions parses every label. 
+def benchmark(count=100000):
+    versions = _randomVersions(count)
+    print("%12s %12s %12s %10s" % ("operation", "compare s", "key s", "speedup"))
+    
+    start = time.perf_counter()
+    expected = sorted(versions, key=functools.cmp_to_key(_compare))
+    compareTime = time.perf_counter() - start
+    version_key.cache_clear()
+    start = time.perf_counter()
+    result = sort_versions(versions)
+    keyTime = time.perf_counter() - start
+    if [version_key(v) for v in result] != [version_key(v) for v in expected]:
+        print("sort_versions did not sort the same way")
+    print("%12s %12.3f %12.3f %9.1fx" % ("sort", compareTime, keyTime, compareTime / keyTime))
+    
+    start = time.perf_counter()
+    newest = versions[0]
+    for version in versions[1:]:
+        if _compare(version, newest) > 0:
+            newest = version
+    compareTime = time.perf_counter() - start
+    version_key.cache_clear()
+    start = time.perf_counter()
+    result = max_version(versions)
+    keyTime = time.perf_counter() - start
+    if result != newest:
+        print("max_version did not find the same version")
+    print("%12s %12.3f %12.3f %9.1fx" % ("max", compareTime, keyTime, compareTime / keyTime))
+    
+#Times answering queries range and floor questions on count versions by going through 
+#all of them with compareVersions and with a VersionIndex (including building it). 
+def indexBenchmark(count=500000, queries=100):
+    versions = _randomVersions(count)
+    bounds = _randomVersions(2 * queries, seed=2)
+    print("%12s %12s %12s %12s" % ("operation", "scan ms", "index ms", "build ms"))
+    start = time.perf_counter()
+    index = VersionIndex(versions)
+    build = (time.perf_counter() - start) * 1000
+    
+    low, high = sort_versions(bounds[0:2])
+    start = time.perf_counter()
+    scanned = [v for v in versions if compareVersions(v, low) != low and compareVersions(v, high) == high]
+    scan = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    for i in range(0, queries):
+        found = index.range(low, high)
+    indexed = (time.perf_counter() - start) * 1000 / queries
+    if sorted(scanned, key=version_key) != found:
+        print("VersionIndex.range did not find the same versions")
+    print("%12s %12.1f %12.4f %12.1f" % ("range", scan, indexed, build))
+    
+    start = time.perf_counter()
+    below = None
+    for v in versions:
+        if compareVersions(v, bounds[2]) == bounds[2] and (below is None or compareVersions(v, below) == v):
+            below = v
+    scan = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    for bound in bounds:
+        index.floor(bound, inclusive=False)
+    indexed = (time.perf_counter() - start) * 1000 / len(bounds)
+    if below != index.floor(bounds[2], inclusive=False) and compareVersions(below, index.floor(bounds[2], inclusive=False)) is not None:
+        print("VersionIndex.floor did not find the same version")
+    print("%12s %12.1f %12.4f %12.1f" % ("floor", scan, indexed, build))
     
 def test():
     test_versions = [
@@ -94,4 +267,40 @@ def test():
             print("Failed test %s " % index)
         print("Comparison of %s and %s expected to get %s and got" % test + " %s" % bigger) 
         print("**************")
+        
+    #Sorting by version_key has to agree with compareVersions on every pair. 
+    labels = [label for test in test_versions for label in test[:2]] + _randomVersions(200)
+    ordered = sort_versions(labels)
+    if all(compareVersions(ordered[i], ordered[i + 1]) in (None, ordered[i + 1]) for i in range(0, len(ordered) - 1)):
+        print("Passed sort_versions test")
+    else:
+        print("Failed sort_versions test")
+    if max_version(labels) == ordered[-1] or compareVersions(max_version(labels), ordered[-1]) is None:
+        print("Passed max_version test")
+    else:
+        print("Failed max_version test")
+    if max_version([]) is None and sort_versions(['1.10', '1.9', '1.9rev'], reverse=True) == ['1.10', '1.9rev', '1.9']:
+        print("Passed empty and reverse test")
+    else:
+        print("Failed empty and reverse test")
+        
+    #VersionIndex has to give the same answers as going through every label. 
+    index = VersionIndex(labels[:100])
+    index.update(labels[100:110])
+    index.update(labels[110:])
+    index.add('1.2rev')
+    index.remove('1.2rev')
+    newer = lambda v1, v2: compareVersions(v1, v2) == v1
+    scan = [v for v in ordered if not newer('1.2', v) and newer('2.0', v)]
+    if list(index) == ordered and index.range('1.2', '2.0') == scan and '1.3' in index and '1.3.0' not in index:
+        print("Passed VersionIndex range test")
+    else:
+        print("Failed VersionIndex range test")
+    below = [v for v in ordered if newer('7.5', v)]
+    above = [v for v in ordered if not newer('7.5', v)]
+    if (index.floor('7.5', inclusive=False) == below[-1] and index.ceiling('7.5') == above[0] 
+            and index.latest(3) == ordered[:-4:-1] and index.latest(0) == [] and VersionIndex().floor('1') is None):
+        print("Passed VersionIndex floor, ceiling and latest test")
+    else:
+        print("Failed VersionIndex floor, ceiling and latest test")
         
\ No newline at end of file
@@ -0,0 +1,382 @@
+#A Cache that lives in shared memory so several worker processes on one host
+#can share a single cache instead of each keeping its own copy.
+
+import json
+import multiprocessing
+import os
+import pickle
+import time
+import zlib
+from multiprocessing import shared_memory
+from threading import Event
+
+from cache import _CacheThread, _NIL, _PICKLE_PROTOCOL
+
+#The segment starts with a header of 64 bit integers.
+_MAGIC = 0x4C525553    #"LRUS"
+_HEADER_FIELDS = 16
+(_H_MAGIC, _H_CAPACITY, _H_SLOT_BYTES, _H_BUCKETS, _H_EXPIRY_MICROSECONDS, _H_HEAD, _H_TAIL,
+    _H_FREE, _H_OLDEST, _H_NEWEST, _H_COUNT, _H_HITS, _H_MISSES) = range(0, 13)
+
+#The per slot arrays that follow the header, in order, with their array type code.
+#Like CompactCache each entry is a slot index into these arrays:
+#previous/next make the LRU list (next also chains the free slots), chain links the
+#slots sharing a hash bucket, older/newer are the creation order used for expiry
+#and data holds the pickled key followed by the pickled value.
+_SLOT_ARRAYS = (("previous", "i"), ("next", "i"), ("chain", "i"), ("older", "i"), ("newer", "i"),
+    ("hashes", "I"), ("keyLengths", "I"), ("valueLengths", "I"), ("expiryTimes", "d"))
+_ITEM_SIZES = {"i": 4, "I": 4, "d": 8, "q": 8}
+
+def _aligned(size):
+    return (size + 7) & ~7
+
+def _bucketCount(capacity):
+    return 1 << max(4, (2 * capacity - 1).bit_length())
+    
+def _segmentSize(capacity, slotBytes):
+    return _layout(capacity, slotBytes, _bucketCount(capacity))[1]
+
+def _layout(capacity, slotBytes, buckets):
+    offsets = {}
+    offset = _HEADER_FIELDS * 8
+    offsets["buckets"] = offset
+    offset += _aligned(buckets * 4)
+    for name, typeCode in _SLOT_ARRAYS:
+        offsets[name] = offset
+        offset += _aligned(capacity * _ITEM_SIZES[typeCode])
+    offsets["data"] = offset
+    offset += capacity * slotBytes
+    return offsets, offset
+
+#The same LRU cache as cache.Cache with add/get/expire, expiry and json snapshots,
+#kept in a multiprocessing.shared_memory segment and guarded by a multiprocessing lock.
+#Keys and values are pickled into fixed size slots of slotBytes bytes.
+#Keys are found through a hash table of crc32s of the pickled key since hash()
+#of a string differs between processes.
+#Note: keys are matched by their pickled bytes, not by ==, so keys that are equal
+#but pickle differently, like 1, 1.0 and True, are different keys here, unlike in Cache.
+#Create the cache in the parent process, then either fork the workers or pass the
+#cache to them as a multiprocessing.Process argument, which attaches them to the same segment.
+class SharedCache():
+
+    def __init__(self, cacheSize=10, expiryTime=None, slotBytes=256, name=None, create=True, lock=None,
+        fileName="cache.json", tickResolution=1.0, sweep=True):
+        """
+            cacheSize, expiryTime (seconds), fileName, tickResolution and sweep are the
+            same as for Cache. slotBytes is the room for each pickled key and value, adding
+            anything bigger raises ValueError.
+            name is the shared memory segment's name, one is chosen if it is None.
+            With create=False the cache attaches to the existing segment called name,
+            its sizes are read from the segment and lock must be the creator's lock.
+            The expiry thread only runs in the process that created the cache.
+            The creator should call unlink() once every process is done with it.
+        """
+        if create:
+            self.memory = shared_memory.SharedMemory(name=name, create=True, size=_segmentSize(cacheSize, slotBytes))
+            self.lock = lock if lock is not None else multiprocessing.Lock()
+            self._format(cacheSize, expiryTime, slotBytes)
+        else:
+            if lock is None:
+                raise ValueError("Attaching to an existing SharedCache needs its lock.")
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.lock = lock
+            self._attach()
+            if self.header[_H_MAGIC] != _MAGIC:
+                self.close()
+                raise ValueError("%s is not a SharedCache segment." % name)
+
+        self.name = self.memory.name
+        self.fileName = fileName
+        self.owner = create
+        self.tickResolution = tickResolution
+        self.sweep = sweep
+        self.timer = None
+        if create and self.duration and sweep:
+            self._startTimer()
+
+    #Writes the header of an empty cache to a new segment. 
+    def _format(self, cacheSize, expiryTime, slotBytes):
+        header = self.memory.buf[0:_HEADER_FIELDS * 8].cast("q")
+        header[_H_CAPACITY] = cacheSize
+        header[_H_SLOT_BYTES] = slotBytes
+        header[_H_BUCKETS] = _bucketCount(cacheSize)
+        header[_H_EXPIRY_MICROSECONDS] = -1 if not expiryTime else int(expiryTime * 1000000)
+        header.release()
+        self._attach()
+        self._reset()
+        self.header[_H_MAGIC] = _MAGIC
+        
+    #Maps the header and the slot arrays onto the segment.
+    def _attach(self):
+        buffer = self.memory.buf
+        self.header = buffer[0:_HEADER_FIELDS * 8].cast("q")
+        self.size = self.header[_H_CAPACITY]
+        self.slotBytes = self.header[_H_SLOT_BYTES]
+        expiry = self.header[_H_EXPIRY_MICROSECONDS]
+        self.duration = None if expiry <= 0 else expiry / 1000000.0
+        buckets = self.header[_H_BUCKETS]
+        self.bucketMask = buckets - 1
+        offsets = _layout(self.size, self.slotBytes, buckets)[0]
+        self.buckets = buffer[offsets["buckets"]:offsets["buckets"] + buckets * 4].cast("i")
+        for name, typeCode in _SLOT_ARRAYS:
+            start = offsets[name]
+            setattr(self, name, buffer[start:start + self.size * _ITEM_SIZES[typeCode]].cast(typeCode))
+        self.data = buffer[offsets["data"]:offsets["data"] + self.size * self.slotBytes]
+
+    def _reset(self):
+        header = self.header
+        for bucket in range(0, len(self.buckets)):
+            self.buckets[bucket] = _NIL
+        for slot in range(0, self.size):
+            self.next[slot] = slot + 1
+        if self.size:
+            self.next[self.size - 1] = _NIL
+        header[_H_FREE] = 0 if self.size else _NIL
+        header[_H_HEAD] = header[_H_TAIL] = _NIL
+        header[_H_OLDEST] = header[_H_NEWEST] = _NIL
+        header[_H_COUNT] = 0
+
+    #Passing the cache to another process attaches that process to the same segment.
+    def __getstate__(self):
+        return {"name": self.name, "lock": self.lock, "fileName": self.fileName}
+
+    def __setstate__(self, state):
+        self.__init__(name=state["name"], create=False, lock=state["lock"], fileName=state["fileName"])
+
+    def _startTimer(self):
+        self.stopSignal = Event()
+        self.timer = _CacheThread(self.stopSignal, self, self.tickResolution)
+        self.timer.daemon = True
+        self.timer.start()
+
+    #Waits for the expiry thread to finish so close can release the views it uses.
+    def stopTimer(self):
+        if self.timer is not None:
+            self.stopSignal.set()
+            self.timer.join()
+            self.timer = None
+
+    def restartTimer(self):
+        if self.duration and self.sweep and self.owner and self.timer is None:
+            self._startTimer()
+
+    #Detaches this process from the segment. The views onto it have to be
+    #released first or the segment refuses to close.
+    def close(self):
+        self.stopTimer()
+        views = [self.header, self.buckets, self.data] + [getattr(self, name) for name, typeCode in _SLOT_ARRAYS]
+        for view in views:
+            view.release()
+        self.memory.close()
+
+    #Removes the segment itself, call it from the creator once every process has closed it.
+    def unlink(self):
+        self.memory.unlink()
+
+    def _find(self, keyBytes, keyHash):
+        keyLength = len(keyBytes)
+        slot = self.buckets[keyHash & self.bucketMask]
+        while slot != _NIL:
+            if self.hashes[slot] == keyHash and self.keyLengths[slot] == keyLength:
+                start = slot * self.slotBytes
+                if self.data[start:start + keyLength] == keyBytes:
+                    return slot
+            slot = self.chain[slot]
+        return _NIL
+
+    def _unlinkLRU(self, slot):
+        header = self.header
+        previous = self.previous[slot]
+        following = self.next[slot]
+        if previous != _NIL:
+            self.next[previous] = following
+        else:
+            header[_H_HEAD] = following
+        if following != _NIL:
+            self.previous[following] = previous
+        else:
+            header[_H_TAIL] = previous
+
+    def _pushFront(self, slot):
+        header = self.header
+        head = header[_H_HEAD]
+        self.previous[slot] = _NIL
+        self.next[slot] = head
+        if head != _NIL:
+            self.previous[head] = slot
+        else:
+            header[_H_TAIL] = slot
+        header[_H_HEAD] = slot
+
+    #Takes a slot out of its bucket and both lists and puts it back on the free chain.
+    def _remove(self, slot):
+        header = self.header
+        bucket = self.hashes[slot] & self.bucketMask
+        if self.buckets[bucket] == slot:
+            self.buckets[bucket] = self.chain[slot]
+        else:
+            previous = self.buckets[bucket]
+            while self.chain[previous] != slot:
+                previous = self.chain[previous]
+            self.chain[previous] = self.chain[slot]
+
+        self._unlinkLRU(slot)
+
+        if self.duration:
+            older = self.older[slot]
+            newer = self.newer[slot]
+            if older != _NIL:
+                self.newer[older] = newer
+            else:
+                header[_H_OLDEST] = newer
+            if newer != _NIL:
+                self.older[newer] = older
+            else:
+                header[_H_NEWEST] = older
+
+        self.next[slot] = header[_H_FREE]
+        header[_H_FREE] = slot
+        header[_H_COUNT] -= 1
+
+    def _read(self, slot):
+        start = slot * self.slotBytes + self.keyLengths[slot]
+        return bytes(self.data[start:start + self.valueLengths[slot]])
+
+    #expiresAt (a time.time() value) replaces expiryTime for this entry. get never
+    #returns it once that time has passed but expireDue, which removes entries in the
+    #order they were added, only gets to it when the entries added before it are gone.
+    def add(self, key, value, expiresAt=None):
+        keyBytes = pickle.dumps(key, _PICKLE_PROTOCOL)
+        valueBytes = pickle.dumps(value, _PICKLE_PROTOCOL)
+        if len(keyBytes) + len(valueBytes) > self.slotBytes:
+            raise ValueError("Key and value take %d bytes, more than slotBytes (%d)."
+                % (len(keyBytes) + len(valueBytes), self.slotBytes))
+        keyHash = zlib.crc32(keyBytes)
+        #Nothing fits in a cache of size 0, like Cache. 
+        if not self.size:
+            return self
+
+        with self.lock:
+            header = self.header
+            #Adding an existing key makes it a new entry. Unlike Cache.add this restarts
+            #its expiry too: entries expire in the order they were added, so it can't keep its old time.
+            slot = self._find(keyBytes, keyHash)
+            if slot != _NIL:
+                self._remove(slot)
+            #We remove the tail i.e. the least recently used entry to free a slot.
+            elif header[_H_FREE] == _NIL:
+                self._remove(header[_H_TAIL])
+            slot = header[_H_FREE]
+            header[_H_FREE] = self.next[slot]
+            header[_H_COUNT] += 1
+
+            start = slot * self.slotBytes
+            self.data[start:start + len(keyBytes)] = keyBytes
+            self.data[start + len(keyBytes):start + len(keyBytes) + len(valueBytes)] = valueBytes
+            self.keyLengths[slot] = len(keyBytes)
+            self.valueLengths[slot] = len(valueBytes)
+            self.hashes[slot] = keyHash
+            bucket = keyHash & self.bucketMask
+            self.chain[slot] = self.buckets[bucket]
+            self.buckets[bucket] = slot
+            self._pushFront(slot)
+
+            if self.duration:
+                newest = header[_H_NEWEST]
+                self.expiryTimes[slot] = time.time() + self.duration if expiresAt is None else expiresAt
+                self.older[slot] = newest
+                self.newer[slot] = _NIL
+                if newest != _NIL:
+                    self.newer[newest] = slot
+                else:
+                    header[_H_OLDEST] = slot
+                header[_H_NEWEST] = slot
+        return self
+
+    #Entries whose expiry time has passed are treated as missing without waiting for the sweep.
+    def get(self, key):
+        keyBytes = pickle.dumps(key, _PICKLE_PROTOCOL)
+        keyHash = zlib.crc32(keyBytes)
+        with self.lock:
+            header = self.header
+            slot = self._find(keyBytes, keyHash)
+            if slot != _NIL and self.duration and self.expiryTimes[slot] <= time.time():
+                self._remove(slot)
+                slot = _NIL
+            if slot == _NIL:
+                header[_H_MISSES] += 1
+                return None
+            header[_H_HITS] += 1
+            if slot != header[_H_HEAD]:
+                self._unlinkLRU(slot)
+                self._pushFront(slot)
+            valueBytes = self._read(slot)
+        return pickle.loads(valueBytes)
+
+    def expire(self, key):
+        keyBytes = pickle.dumps(key, _PICKLE_PROTOCOL)
+        with self.lock:
+            slot = self._find(keyBytes, zlib.crc32(keyBytes))
+            if slot == _NIL:
+                raise KeyError(key)
+            self._remove(slot)
+
+    def expireAll(self):
+        with self.lock:
+            self._reset()
+
+    #Removes every entry whose expiry time is at or before now (a time.time() value).
+    #Returns how many were removed.
+    def expireDue(self, now=None):
+        removed = 0
+        if not self.duration:
+            return removed
+        with self.lock:
+            if now is None:
+                now = time.time()
+            header = self.header
+            while header[_H_OLDEST] != _NIL and self.expiryTimes[header[_H_OLDEST]] <= now:
+                self._remove(header[_H_OLDEST])
+                removed += 1
+        return removed
+
+    def __len__(self):
+        return self.header[_H_COUNT]
+
+    #Hits and misses counted by get in every process attached to the cache.
+    def stats(self):
+        with self.lock:
+            return {"size": self.header[_H_COUNT], "hits": self.header[_H_HITS], "misses": self.header[_H_MISSES]}
+
+    #Same as Cache.getCacheValues, the elements dictionary is built on request.
+    def getCacheValues(self):
+        with self.lock:
+            cache_order = []
+            elements = {}
+            slot = self.header[_H_HEAD]
+            while slot != _NIL:
+                start = slot * self.slotBytes
+                key = pickle.loads(self.data[start:start + self.keyLengths[slot]])
+                cache_order.append(key)
+                elements[key] = pickle.loads(self._read(slot))
+                slot = self.next[slot]
+        return (elements, cache_order,
+            cache_order[0] if cache_order else None,
+            cache_order[-1] if cache_order else None)
+
+    #Writes the same json snapshot as Cache.writeToDisk.
+    def writeToDisk(self):
+        elements, cache_in_order = self.getCacheValues()[0:2]
+        temp_file = self.fileName + "_tmp"
+        with open(temp_file, "w") as f:
+            json.dump({'keys': cache_in_order, 'values': [elements[key] for key in cache_in_order]}, f)
+        os.replace(temp_file, self.fileName)
+        return (elements, cache_in_order)
+
+    def loadFromDisk(self):
+        with open(self.fileName, 'r') as f:
+            data = json.load(f)
+        with self.lock:
+            self._reset()
+        for key, value in zip(reversed(data['keys']), reversed(data['values'])):
+            self.add(key, value)
@@ -0,0 +1,189 @@
+#A Cache whose evicted entries move to a larger, memory mapped file instead of
+#being dropped, so the cache can hold more than fits in memory.
+
+import datetime
+import mmap
+import os
+import pickle
+import time
+import zlib
+from threading import RLock
+
+from cache import Cache, _NoLock, _NIL, _PICKLE_PROTOCOL
+from sharedCache import (SharedCache, _segmentSize, _MAGIC, _H_MAGIC, _H_CAPACITY, _H_SLOT_BYTES,
+    _H_HITS, _H_MISSES)
+
+#Entries of the disk tier always have an expiry time, the ones that never expire get this long.
+_FOREVER = 100 * 365 * 24 * 3600.0
+
+#Gives a file the interface SharedCache expects from its shared memory segment.
+class _MappedFile():
+    def __init__(self, fileName, size):
+        mode = "r+b" if os.path.exists(fileName) else "w+b"
+        self.file = open(fileName, mode)
+        if os.path.getsize(fileName) != size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.buf = memoryview(self.map)
+        self.name = fileName
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.buf.release()
+        self.map.close()
+        self.file.close()
+
+#The disk tier of TieredCache: SharedCache's slots, hash index and LRU list laid out
+#in a memory mapped file rather than shared memory, so only the pages being used
+#need to be in memory. An existing file with the same sizes is opened with its entries.
+class DiskTier(SharedCache):
+
+    def __init__(self, fileName="cache.tier", cacheSize=1000, slotBytes=1024, threadSafe=False):
+        self.memory = _MappedFile(fileName, _segmentSize(cacheSize, slotBytes))
+        self.lock = RLock() if threadSafe else _NoLock()
+        header = self.memory.buf[0:8 * (_H_SLOT_BYTES + 1)].cast("q")
+        reuse = (header[_H_MAGIC] == _MAGIC and header[_H_CAPACITY] == cacheSize
+            and header[_H_SLOT_BYTES] == slotBytes)
+        header.release()
+        if reuse:
+            self._attach()
+        else:
+            self._format(cacheSize, _FOREVER, slotBytes)
+
+        self.name = fileName
+        self.fileName = fileName
+        self.owner = True
+        self.sweep = False
+        self.timer = None
+
+    def flush(self):
+        self.memory.flush()
+
+    def unlink(self):
+        os.remove(self.fileName)
+
+    #Removes the key and returns its value and expiry time (a time.time() value),
+    #or None if it isn't there or has expired.
+    def pop(self, key):
+        keyBytes = pickle.dumps(key, _PICKLE_PROTOCOL)
+        with self.lock:
+            slot = self._find(keyBytes, zlib.crc32(keyBytes))
+            if slot == _NIL:
+                self.header[_H_MISSES] += 1
+                return None
+            expiresAt = self.expiryTimes[slot]
+            valueBytes = self._read(slot)
+            self._remove(slot)
+            if expiresAt <= time.time():
+                self.header[_H_MISSES] += 1
+                return None
+            self.header[_H_HITS] += 1
+        return pickle.loads(valueBytes), expiresAt
+
+    #Removes the key if it is there.
+    def discard(self, key):
+        keyBytes = pickle.dumps(key, _PICKLE_PROTOCOL)
+        with self.lock:
+            slot = self._find(keyBytes, zlib.crc32(keyBytes))
+            if slot != _NIL:
+                self._remove(slot)
+
+#An in memory Cache in front of a DiskTier. Entries the memory tier removes to make
+#space are written to the disk tier, and a get that misses memory but finds the key
+#on disk moves it back into memory (which may in turn move another entry to disk).
+#A key is only ever in one of the two tiers.
+class TieredCache():
+
+    def __init__(self, cacheSize=10, diskSize=1000, fileName="cache.tier", slotBytes=1024,
+        expiryTime=None, threadSafe=False, **cacheArguments):
+        """
+            cacheSize is the number of entries kept in memory and diskSize the number
+            kept in the memory mapped file fileName, each pickled key and value taking
+            up to slotBytes bytes on disk. Entries too big for a slot are dropped when
+            they leave memory, as they would be without the disk tier.
+            expiryTime and per entry ttls carry over between the tiers: an entry
+            keeps the expiry time it had when it moves.
+            Any other arguments (policy, maxBytes, ...) go to the memory tier's Cache.
+            close() moves the memory tier to disk and the disk tier keeps its entries 
+            when the cache is created again with the same fileName and sizes.
+        """
+        self.lock = RLock() if threadSafe else _NoLock()
+        self.memory = Cache(cacheSize, expiryTime, threadSafe=threadSafe,
+            evictionHook=self._demote, **cacheArguments)
+        self.disk = DiskTier(fileName, diskSize, slotBytes)
+        self.demoted = 0
+        self.promoted = 0
+        self.dropped = 0
+
+    #Called by the memory tier, under its lock, for each entry it removes to make space.
+    def _demote(self, key, value, expiryTime):
+        if expiryTime == datetime.datetime.max:
+            expiresAt = time.time() + _FOREVER
+        else:
+            expiresAt = time.time() + (expiryTime - datetime.datetime.utcnow()).total_seconds()
+        try:
+            self.disk.add(key, value, expiresAt)
+            self.demoted += 1
+        except (ValueError, TypeError, pickle.PicklingError):
+            self.dropped += 1
+
+    def get(self, key):
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                return value
+            found = self.disk.pop(key)
+            if found is None:
+                return None
+            value, expiresAt = found
+            self.promoted += 1
+            ttl = expiresAt - time.time()
+            if ttl >= _FOREVER / 2:
+                self.memory.add(key, value)
+            else:
+                self.memory.add(key, value, ttl=ttl)
+            return value
+
+    def add(self, key, value, ttl=None):
+        with self.lock:
+            self.disk.discard(key)
+            if ttl is None:
+                self.memory.add(key, value)
+            else:
+                self.memory.add(key, value, ttl=ttl)
+        return self
+
+    def expire(self, key):
+        with self.lock:
+            if key in self.memory.elements:
+                self.memory.expire(key)
+            else:
+                self.disk.expire(key)
+
+    def expireAll(self):
+        with self.lock:
+            self.memory.expireAll()
+            self.disk.expireAll()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "memory": self.memory.stats(),
+                "disk": self.disk.stats(),
+                "demoted": self.demoted,
+                "promoted": self.promoted,
+                "dropped": self.dropped,
+            }
+
+    #Moves what is in memory to the disk tier, least recently used first so 
+    #the order is kept, and closes the file. 
+    def close(self):
+        self.memory.close()
+        with self.lock:
+            for entry in list(self.memory.reverse_iterate()):
+                self._demote(entry.key, self.memory.elements[entry.key], entry.expiryTime)
+            self.memory.expireAll()
+        self.disk.flush()
+        self.disk.close()
@@ -1,11 +1,25 @@
+import heapq
+import random
 import sys
+import time
 
 """this checks if two coordinates on the x-axis intercept.
     Check tests() for seeing how this works in code or run this file
     to get the user prompts.
     checkIfOverlap is the function we call and use. 
+    checkIfOverlapMany does the same for whole columns of pairs at once,
+    with NumPy if it is installed. benchmark() compares the two.
+    allOverlappingPairs finds every overlapping pair in a list of coordinates 
+    without trying all of them, IntervalTree answers which stored coordinates 
+    overlap a new one. scalingBenchmark() times both. 
 """
 
+#NumPy is optional, checkIfOverlapMany falls back to plain Python without it. 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def checkIfOverlap(co_ord1, co_ord2):
 
     #We change the coordinates to make sure the first number is 
@@ -36,6 +50,250 @@ def checkIfOverlap(co_ord1, co_ord2):
     print("Ran into a missing case. Should not happen.")
     return True 
 
+#checkIfOverlap for every pair of rows of two columns of coordinates, each a list 
+#of (x1, x2) tuples or an array of shape (n, 2). The rows of one column can point 
+#either way, as in checkIfOverlap. Returns a NumPy array of booleans, or a list of 
+#them without NumPy (or with useNumpy=False). 
+def checkIfOverlapMany(co_ords1, co_ords2, useNumpy=True):
+    if len(co_ords1) != len(co_ords2):
+        raise ValueError("Both columns need the same number of coordinates")
+    if numpy is not None and useNumpy:
+        co_ords1 = numpy.asarray(co_ords1).reshape(-1, 2)
+        co_ords2 = numpy.asarray(co_ords2).reshape(-1, 2)
+        #Turning every line to point the same way is the same as taking 
+        #the smaller and bigger end. 
+        start1 = numpy.minimum(co_ords1[:, 0], co_ords1[:, 1])
+        end1 = numpy.maximum(co_ords1[:, 0], co_ords1[:, 1])
+        start2 = numpy.minimum(co_ords2[:, 0], co_ords2[:, 1])
+        end2 = numpy.maximum(co_ords2[:, 0], co_ords2[:, 1])
+        #What is left of the no overlap cases, touching ends overlap. 
+        return (start2 <= end1) & (start1 <= end2)
+        
+    overlaps = []
+    for (x1, x2), (x3, x4) in zip(co_ords1, co_ords2):
+        if x2 < x1:
+            x1, x2 = x2, x1
+        if x4 < x3:
+            x3, x4 = x4, x3
+        overlaps.append(x3 <= x2 and x1 <= x4)
+    return overlaps
+
+#Every pair of coordinates in the list that overlap, as checkIfOverlap decides, 
+#as (i, j) index pairs with i < j. 
+#Sweeps the lines from left to right, keeping the ones the sweep is still 
+#inside in a heap by where they end. A line overlaps exactly the ones still 
+#there when it starts, so the time is O(n log n) plus one step per pair found. 
+def allOverlappingPairs(co_ords):
+    lines = sorted((min(co_ord), max(co_ord), index) for index, co_ord in enumerate(co_ords))
+    pairs = []
+    active = []
+    for start, end, index in lines:
+        #Lines ending exactly where this one starts still touch it. 
+        while active and active[0][0] < start:
+            heapq.heappop(active)
+        for activeEnd, other in active:
+            pairs.append((other, index) if other < index else (index, other))
+        heapq.heappush(active, (end, index))
+    return pairs
+
+class _IntervalNode():
+    def __init__(self, start, end, value):
+        self.start = start
+        self.end = end
+        self.value = value
+        #The furthest end in this node's subtree, to skip subtrees that end too early. 
+        self.maxEnd = end
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        
+    def update(self):
+        self.maxEnd = self.end
+        if self.left is not None and self.left.maxEnd > self.maxEnd:
+            self.maxEnd = self.left.maxEnd
+        if self.right is not None and self.right.maxEnd > self.maxEnd:
+            self.maxEnd = self.right.maxEnd
+        
+#Stores coordinates (and a value with each) for asking which of them overlap a 
+#coordinate or contain a point, with the same rules as checkIfOverlap. 
+#A binary search tree by start (a treap, kept balanced by random priorities), each 
+#node knowing the furthest end below it. Inserting is O(log n) and a query O(log n) 
+#per coordinate found. 
+class IntervalTree():
+    
+    def __init__(self, co_ords=(), values=None):
+        """
+            Starts with the given coordinates, with values (in the same order) 
+            or the coordinates themselves as their values. Building the tree 
+            from them at once is much quicker than inserting them one by one. 
+        """
+        co_ords = list(co_ords)
+        values = co_ords if values is None else list(values)
+        nodes = [_IntervalNode(min(co_ord), max(co_ord), value) for co_ord, value in zip(co_ords, values)]
+        nodes.sort(key=lambda node: node.start)
+        self.root = self._build(nodes, 0, len(nodes))
+        self.size = len(nodes)
+        
+        #Handing out random priorities from the highest down, level by level, 
+        #makes the balanced tree a treap later inserts keep balanced. 
+        priorities = sorted((random.random() for node in nodes), reverse=True)
+        level = [self.root] if self.root is not None else []
+        index = 0
+        while level:
+            below = []
+            for node in level:
+                node.priority = priorities[index]
+                index += 1
+                below += [child for child in (node.left, node.right) if child is not None]
+            level = below
+            
+    #The balanced tree of the sorted nodes[low:high]. 
+    def _build(self, nodes, low, high):
+        if low >= high:
+            return None
+        middle = (low + high) // 2
+        node = nodes[middle]
+        node.left = self._build(nodes, low, middle)
+        node.right = self._build(nodes, middle + 1, high)
+        node.update()
+        return node
+            
+    def __len__(self):
+        return self.size
+        
+    #value defaults to the coordinate itself. 
+    def insert(self, co_ord, value=None):
+        node = _IntervalNode(min(co_ord), max(co_ord), co_ord if value is None else value)
+        self.root = self._insert(self.root, node)
+        self.size += 1
+        
+    def _insert(self, root, node):
+        if root is None:
+            return node
+        if node.start < root.start:
+            root.left = self._insert(root.left, node)
+            if root.left.priority > root.priority:
+                root = self._rotateRight(root)
+        else:
+            root.right = self._insert(root.right, node)
+            if root.right.priority > root.priority:
+                root = self._rotateLeft(root)
+        root.update()
+        return root
+        
+    def _rotateRight(self, root):
+        child = root.left
+        root.left = child.right
+        root.update()
+        child.right = root
+        child.update()
+        return child
+        
+    def _rotateLeft(self, root):
+        child = root.right
+        root.right = child.left
+        root.update()
+        child.left = root
+        child.update()
+        return child
+        
+    #The values of every stored coordinate that overlaps co_ord. 
+    def overlapping(self, co_ord):
+        start, end = min(co_ord), max(co_ord)
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            #Nothing below ends late enough to reach start. 
+            if node.maxEnd < start:
+                continue
+            if node.left is not None:
+                stack.append(node.left)
+            #Everything to the right starts after this node. 
+            if node.start <= end:
+                if start <= node.end:
+                    found.append(node.value)
+                if node.right is not None:
+                    stack.append(node.right)
+        return found
+        
+    #The values of every stored coordinate that contains x, ends included. 
+    def stabbing(self, x):
+        return self.overlapping((x, x))
+        
+def _randomCoordinates(count, seed=1):
+    generator = random.Random(seed)
+    return [(generator.randint(-1000, 1000), generator.randint(-1000, 1000)) for i in range(0, count)]
+    
+#count lines of up to length long spread over count * spacing, so each overlaps a 
+#few others whatever the count. 
+def _randomLines(count, length=20, spacing=10, seed=1):
+    generator = random.Random(seed)
+    lines = []
+    for i in range(0, count):
+        start = generator.uniform(0, count * spacing)
+        lines.append((start, start + generator.uniform(0, length)))
+    return lines
+    
+#Times finding every overlapping pair among count lines with allOverlappingPairs, 
+#with an IntervalTree (building it at once, inserting the lines one by one and asking 
+#it about each line) and, for the smaller counts, with checkIfOverlap on every pair. 
+def scalingBenchmark(counts=(1000, 10000, 100000, 1000000), bruteForceUpTo=2000):
+    print("%10s %10s %10s %10s %10s %10s %12s" % ("lines", "pairs", "sweep s", "build s", "insert s", "query s", "all pairs s"))
+    for count in counts:
+        lines = _randomLines(count)
+        start = time.perf_counter()
+        pairs = allOverlappingPairs(lines)
+        sweep = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        tree = IntervalTree(lines, range(0, count))
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        inserted = IntervalTree()
+        for index, line in enumerate(lines):
+            inserted.insert(line, index)
+        insert = time.perf_counter() - start
+        start = time.perf_counter()
+        treePairs = sum(len(tree.overlapping(line)) for line in lines)
+        query = time.perf_counter() - start
+        #Each pair is found from both of its lines and each line finds itself. 
+        if (treePairs - count) // 2 != len(pairs):
+            print("The tree found %d pairs, the sweep %d" % ((treePairs - count) // 2, len(pairs)))
+            
+        bruteForce = "-"
+        if count <= bruteForceUpTo:
+            start = time.perf_counter()
+            found = [(i, j) for i in range(0, count) for j in range(i + 1, count) if checkIfOverlap(lines[i], lines[j])]
+            bruteForce = "%.3f" % (time.perf_counter() - start)
+            if sorted(found) != sorted(pairs):
+                print("allOverlappingPairs did not find the same pairs as checkIfOverlap")
+        print("%10d %10d %10.3f %10.3f %10.3f %10.3f %12s" % (count, len(pairs), sweep, build, insert, query, bruteForce))
+        
+#Times count pairs through a loop of checkIfOverlap, checkIfOverlapMany without 
+#NumPy and with it if it is installed (from lists and from arrays already built). 
+def benchmark(count=1000000):
+    co_ords1 = _randomCoordinates(count, 1)
+    co_ords2 = _randomCoordinates(count, 2)
+    print("%24s %10s %12s" % ("method", "seconds", "pairs/s"))
+    
+    start = time.perf_counter()
+    expected = [checkIfOverlap(one, two) for one, two in zip(co_ords1, co_ords2)]
+    loop = time.perf_counter() - start
+    print("%24s %10.3f %12.0f" % ("checkIfOverlap loop", loop, count / loop))
+    
+    runs = [("many, plain Python", co_ords1, co_ords2, False)]
+    if numpy is not None:
+        runs.append(("many, NumPy from lists", co_ords1, co_ords2, True))
+        runs.append(("many, NumPy from arrays", numpy.array(co_ords1), numpy.array(co_ords2), True))
+    for name, one, two, useNumpy in runs:
+        start = time.perf_counter()
+        result = checkIfOverlapMany(one, two, useNumpy)
+        elapsed = time.perf_counter() - start
+        if list(result) != expected:
+            print("%s did not agree with checkIfOverlap" % name)
+        print("%24s %10.3f %12.0f" % (name, elapsed, count / elapsed))
+
 def tests():
     testList = [
     
@@ -78,6 +336,29 @@ def tests():
     ]
     for test in testList:
         print("got %s" % checkIfOverlap(test['one'], test['two']) + " expected %s" % test['expected'])
+        
+    #The bulk version has to agree with checkIfOverlap, with and without NumPy. 
+    co_ords1 = [test['one'] for test in testList] + _randomCoordinates(1000, 1)
+    co_ords2 = [test['two'] for test in testList] + _randomCoordinates(1000, 2)
+    expected = [checkIfOverlap(one, two) for one, two in zip(co_ords1, co_ords2)]
+    for useNumpy in (False, True):
+        print("checkIfOverlapMany useNumpy=%s agrees: got %s expected True" % (useNumpy,
+            [bool(overlap) for overlap in checkIfOverlapMany(co_ords1, co_ords2, useNumpy)] == expected))
+            
+    #So do the sweep and the tree, touching ends and reversed lines included. 
+    co_ords = [test['one'] for test in testList] + [test['two'] for test in testList] + _randomCoordinates(300, 3)
+    expected = [(i, j) for i in range(0, len(co_ords)) for j in range(i + 1, len(co_ords)) 
+        if checkIfOverlap(co_ords[i], co_ords[j])]
+    print("allOverlappingPairs agrees: got %s expected True" % (sorted(allOverlappingPairs(co_ords)) == expected))
+    #Half built at once and half inserted. 
+    half = len(co_ords) // 2
+    tree = IntervalTree(co_ords[:half], range(0, half))
+    for index in range(half, len(co_ords)):
+        tree.insert(co_ords[index], index)
+    agrees = all(sorted(tree.overlapping(co_ords[i])) == [j for j in range(0, len(co_ords)) if checkIfOverlap(co_ords[i], co_ords[j])]
+        for i in range(0, len(co_ords)))
+    print("IntervalTree agrees: got %s expected True" % (agrees and len(tree) == len(co_ords)))
+    print("IntervalTree stabbing at -5: got %s expected [(-4, -5)]" % IntervalTree(co_ords[:12]).stabbing(-5))
     
     
 if __name__ == "__main__":